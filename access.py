@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+from loguru import logger
+from state import STATE_CACHE_TTL, state_backend
+from storage import StateBackend
+
+ALLOWED_USERS_FILE = 'allowed_users.json'
+ALLOWED_GROUPS_FILE = 'allowed_groups.json'
+
+
+class AccessList:
+    """
+    Список разрешенных ID, хранящийся в JSON-файле и кэшируемый в памяти.
+
+    ID хранятся как множество целых чисел для проверки за O(1). Файл
+    перечитывается только при изменении его mtime, а изменения через
+    add/remove сразу применяются к кэшу и атомарно записываются в файл.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids: list[int] = []
+        self._id_set: set[int] = set()
+        self._mtime: Optional[int] = None
+        self._exists = False
+
+    def _refresh(self):
+        """Перечитывает файл, если он изменился с момента последней загрузки."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self._exists = False
+            self._mtime = None
+            self._ids = []
+            self._id_set = set()
+            return
+
+        if mtime == self._mtime and self._exists:
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                raw_ids = json.load(f)
+            ids = []
+            for raw_id in raw_ids:
+                try:
+                    ids.append(int(str(raw_id).strip()))
+                except ValueError:
+                    logger.warning(f"Некорректный ID в файле {self.path}: {raw_id}")
+            self._ids = ids
+            self._id_set = set(ids)
+            self._mtime = mtime
+            self._exists = True
+            logger.debug(f"Загружен список {self.path}: {len(ids)} записей")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке {self.path}: {e}")
+
+    def _save(self):
+        """Атомарно записывает список в файл."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump([str(item_id) for item_id in self._ids], f)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+        self._exists = True
+        logger.info(f"Список {self.path} успешно сохранен")
+
+    @property
+    def exists(self) -> bool:
+        with self._lock:
+            self._refresh()
+            return self._exists
+
+    def contains(self, item_id: int) -> bool:
+        with self._lock:
+            self._refresh()
+            return item_id in self._id_set
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            self._refresh()
+            return not self._ids
+
+    def list(self) -> list[int]:
+        with self._lock:
+            self._refresh()
+            return list(self._ids)
+
+    def add(self, item_id: int) -> bool:
+        """Добавляет ID в список. Возвращает False, если он уже был в списке."""
+        with self._lock:
+            self._refresh()
+            if item_id in self._id_set:
+                return False
+            self._ids.append(item_id)
+            self._id_set.add(item_id)
+            self._save()
+            return True
+
+    def remove(self, item_id: int) -> bool:
+        """Удаляет ID из списка. Возвращает False, если его не было в списке."""
+        with self._lock:
+            self._refresh()
+            if item_id not in self._id_set:
+                return False
+            self._ids.remove(item_id)
+            self._id_set.discard(item_id)
+            self._save()
+            return True
+
+
+class SharedAccessList:
+    """
+    Список разрешенных ID в общем хранилище состояния.
+
+    Используется, когда бот работает несколькими репликами: изменения через
+    add/remove видны всем процессам. Список кэшируется на STATE_CACHE_TTL
+    секунд. При первом запуске список заполняется из локального JSON-файла.
+    """
+
+    def __init__(self, backend: StateBackend, name: str, seed_file: str, ttl: float = STATE_CACHE_TTL):
+        self.backend = backend
+        self.name = name
+        self.seed_file = seed_file
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ids: Optional[list[int]] = None
+        self._id_set: set[int] = set()
+        self._loaded_at: Optional[float] = None
+
+    def _seed(self) -> Optional[list[int]]:
+        """Переносит список из JSON-файла в общее хранилище."""
+        if not os.path.exists(self.seed_file):
+            return None
+        seed = AccessList(self.seed_file)
+        ids = seed.list()
+        self.backend.set_replace(self.name, ids)
+        logger.info(f"Список {self.seed_file} перенесен в общее хранилище: {len(ids)} записей")
+        return ids
+
+    def _refresh(self, force: bool = False):
+        now = time.monotonic()
+        if not force and self._loaded_at is not None and now - self._loaded_at < self.ttl:
+            return
+        try:
+            ids = self.backend.set_members(self.name)
+            if ids is None:
+                ids = self._seed()
+            self._ids = ids
+            self._id_set = set(ids or ())
+            self._loaded_at = now
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке списка {self.name} из хранилища: {e}")
+
+    @property
+    def exists(self) -> bool:
+        with self._lock:
+            self._refresh()
+            return self._ids is not None
+
+    def contains(self, item_id: int) -> bool:
+        with self._lock:
+            self._refresh()
+            return item_id in self._id_set
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            self._refresh()
+            return not self._ids
+
+    def list(self) -> list[int]:
+        with self._lock:
+            self._refresh(force=True)
+            return list(self._ids or [])
+
+    def add(self, item_id: int) -> bool:
+        """Добавляет ID в список. Возвращает False, если он уже был в списке."""
+        with self._lock:
+            # Перед первым изменением список должен быть перенесен из файла
+            self._refresh()
+            added = self.backend.set_add(self.name, item_id)
+            self._refresh(force=True)
+            return added
+
+    def remove(self, item_id: int) -> bool:
+        """Удаляет ID из списка. Возвращает False, если его не было в списке."""
+        with self._lock:
+            # Перед первым изменением список должен быть перенесен из файла
+            self._refresh()
+            removed = self.backend.set_remove(self.name, item_id)
+            self._refresh(force=True)
+            return removed
+
+
+class AccessControl:
+    """Кэш списков разрешенных пользователей и групп."""
+
+    def __init__(self, users_file: str = ALLOWED_USERS_FILE, groups_file: str = ALLOWED_GROUPS_FILE,
+                 backend: StateBackend = state_backend):
+        if backend.shared:
+            # Реплики бота используют общие списки
+            self.users = SharedAccessList(backend, 'allowed_users', users_file)
+            self.groups = SharedAccessList(backend, 'allowed_groups', groups_file)
+        else:
+            self.users = AccessList(users_file)
+            self.groups = AccessList(groups_file)
+
+
+access_control = AccessControl()
@@ -0,0 +1,140 @@
+"""
+Бенчмарк параллельной потоковой генерации.
+
+N пользователей одновременно отправляют боту текстовое сообщение.
+Апдейты проходят через очередь Application со всеми обработчиками бота
+(маршрутизация, проверка доступа, очередь запросов пользователя), ответ
+модели эмулируется поддельным потоком. Сравнивается обработка апдейтов
+по одному (concurrent_updates=1, как было до параллельной обработки) с
+настройкой бота CONCURRENT_UPDATES: общее время и время до первой правки
+ответа у пользователей. При параллельной обработке N ответов завершаются
+примерно за время одного.
+
+Запуск:
+    python benchmarks/bench_concurrent_streams.py --streams 50 --chunks 40 --delay 0.01
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from types import SimpleNamespace
+
+from fakes import FakeAsyncOpenAI, make_client_pool, prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+
+TOKEN = "123456:STREAMS"
+FIRST_USER_ID = 820000000
+
+
+def make_bot(first_edit: dict):
+    from telegram import User
+    from telegram.ext import ExtBot
+
+    class OfflineBot(ExtBot):
+        """Бот без сети: запоминает время первой правки ответа в каждом чате."""
+
+        async def get_me(self, *args, **kwargs):
+            self._bot_user = User(id=int(TOKEN.split(":")[0]), first_name="Bot", is_bot=True, username="bench_bot")
+            return self._bot_user
+
+        async def send_message(self, chat_id, text, *args, **kwargs):
+            return SimpleNamespace(chat_id=chat_id, message_id=1, text=text)
+
+        async def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+            first_edit.setdefault(chat_id, time.perf_counter())
+            return True
+
+    return OfflineBot(TOKEN)
+
+
+def make_update(update_id: int, user_id: int, bot):
+    from telegram import Update
+
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "User"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": f"Вопрос {update_id}",
+        }
+    }, bot)
+
+
+async def run(concurrent_updates: int, streams: int, chunks: int, delay: float):
+    """Возвращает общее время и времена до первой правки (секунды)."""
+    from telegram.ext import Application
+    import bot as bot_module
+    import edit_scheduler
+
+    # Правки не ограничиваются, чтобы измерялась только обработка апдейтов
+    bot_module.edit_scheduler = edit_scheduler.EditScheduler(min_interval=0, global_rate=100000)
+    first_edit = {}
+    finished = []
+    application = (
+        Application.builder()
+        .bot(make_bot(first_edit))
+        .updater(None)
+        .concurrent_updates(concurrent_updates)
+        .build()
+    )
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.application = application
+    gpt_bot.client_pool = make_client_pool(FakeAsyncOpenAI(
+        chunks=[f"токен{i} " for i in range(chunks)],
+        chunk_delay=delay
+    ))
+    stream = gpt_bot.stream_chat_completion
+
+    async def tracked_stream(*args, **kwargs):
+        await stream(*args, **kwargs)
+        finished.append(time.perf_counter())
+
+    gpt_bot.stream_chat_completion = tracked_stream
+    application.bot_data['gpt_bot'] = gpt_bot
+    bot_module.GPTBot._setup_handlers(gpt_bot)
+    await application.initialize()
+    await application.start()
+
+    started = time.perf_counter()
+    for index in range(streams):
+        await application.update_queue.put(make_update(index + 1, FIRST_USER_ID + index, application.bot))
+    while len(finished) < streams:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    await application.stop()
+    await application.shutdown()
+    return elapsed, [moment - started for moment in first_edit.values()]
+
+
+async def main(streams, chunks, delay):
+    import bot as bot_module
+
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(streams)], f)
+
+    single, _ = await run(1, 1, chunks, delay)
+    print(f"Один ответ:            {single:.3f} с")
+    print(f"{'апдейтов одновременно':<24}{'всего, с':>10}{'первая правка p50, с':>22}{'p95, с':>10}")
+    for concurrent_updates in (1, bot_module.CONCURRENT_UPDATES):
+        elapsed, first = await run(concurrent_updates, streams, chunks, delay)
+        first.sort()
+        p95 = first[min(len(first) - 1, int(len(first) * 0.95))]
+        print(f"{concurrent_updates:<24}{elapsed:>10.3f}{statistics.median(first):>22.3f}{p95:>10.3f}")
+    print(f"({streams} ответов; при обработке по одному было бы около {single * streams:.1f} с)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--streams', type=int, default=50)
+    parser.add_argument('--chunks', type=int, default=40)
+    parser.add_argument('--delay', type=float, default=0.01)
+    args = parser.parse_args()
+    asyncio.run(main(args.streams, args.chunks, args.delay))
@@ -0,0 +1,185 @@
+"""
+Стоимость маршрутизации текстового апдейта до обработчика.
+
+Сравнивает прежний каскад из четырех MessageHandler'ов в группах 0-3
+(три обработчика ввода из меню настроек проверяют доступ и флаг в
+user_data, затем handle_text) с единым обработчиком route_text_message,
+который выбирает обработчик по ожидаемому вводу пользователя. Апдейты
+проходят через Application.process_update со всеми обработчиками бота и
+обертками метрик и request_id; запрос к модели заменен заглушкой, поэтому
+измеряется только путь апдейта до нее.
+
+Запуск:
+    python benchmarks/bench_dispatch.py --updates 20000
+"""
+import argparse
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from fakes import prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+
+TOKEN = "123456:DISPATCH"
+FIRST_USER_ID = 800000000
+
+
+def make_bot():
+    from telegram import User
+    from telegram.ext import ExtBot
+
+    class OfflineBot(ExtBot):
+        """Бот без сети: ответы пользователю никуда не отправляются."""
+
+        async def get_me(self, *args, **kwargs):
+            self._bot_user = User(id=int(TOKEN.split(":")[0]), first_name="Bot", is_bot=True, username="bench_bot")
+            return self._bot_user
+
+        async def send_message(self, chat_id, text, *args, **kwargs):
+            return None
+
+    return OfflineBot(TOKEN)
+
+
+def legacy_input_handler(flag: str):
+    """Обработчик ввода в прежнем виде: проверка доступа, затем флага."""
+    from utils import check_user_access_decorator
+
+    @check_user_access_decorator
+    async def handler(update, context):
+        if not context.user_data.get(flag):
+            return
+    handler.__name__ = f"legacy_{flag}"
+    return handler
+
+
+async def build_application(layout: str):
+    from telegram.ext import Application, MessageHandler, filters
+    import bot as bot_module
+    import handlers
+    import metrics
+    from log_config import with_request_id
+
+    application = Application.builder().bot(make_bot()).build()
+    bot_module.GPTBot._setup_handlers(SimpleNamespace(application=application))
+    if layout == "legacy":
+        group = application.handlers[0]
+        router = next(h for h in group if getattr(h, "callback", None) is handlers.route_text_message)
+        application.remove_handler(router)
+        for index, flag in enumerate(("waiting_for_custom_model", "waiting_for_base_url",
+                                      "waiting_for_image_base_url")):
+            application.add_handler(MessageHandler(
+                filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
+                legacy_input_handler(flag)
+            ), group=index)
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_text), group=3)
+    for group in application.handlers.values():
+        for handler in group:
+            handler.callback = with_request_id(metrics.track_handler(handler.callback))
+    await application.initialize()
+    return application
+
+
+def make_update(update_id: int, user_id: int, text: str, bot):
+    from telegram import Update
+
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "User"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+        }
+    }, bot)
+
+
+async def run(layout: str, updates: int, users: int):
+    import handlers
+    import metrics
+
+    submitted = []
+
+    async def submit(key, chat_id, item, process):
+        submitted.append(key)
+
+    # Запрос к модели не выполняется: измеряется только путь до него
+    handlers.chat_queue = SimpleNamespace(submit=submit)
+    application = await build_application(layout)
+    batch = [
+        make_update(i + 1, FIRST_USER_ID + i % users, f"Вопрос {i}", application.bot)
+        for i in range(updates)
+    ]
+    calls_before = sum(value for _, value in metrics.handler_calls.items())
+    # Прогрев
+    for update in batch[:100]:
+        await application.process_update(update)
+    submitted.clear()
+
+    started = time.perf_counter()
+    for update in batch:
+        await application.process_update(update)
+    elapsed = time.perf_counter() - started
+    calls = sum(value for _, value in metrics.handler_calls.items()) - calls_before
+    assert len(submitted) == updates
+    await application.shutdown()
+    return elapsed / updates * 1e6, calls / (updates + 100)
+
+
+async def check_pending_input():
+    """Ввод из меню настроек попадает в свой обработчик, а не в модель."""
+    import handlers
+    from settings import settings_manager
+
+    submitted = []
+
+    async def submit(key, chat_id, item, process):
+        submitted.append(key)
+
+    handlers.chat_queue = SimpleNamespace(submit=submit)
+    application = await build_application("router")
+    user_id = FIRST_USER_ID
+    application.user_data[user_id][handlers.PENDING_INPUT] = handlers.INPUT_CUSTOM_MODEL
+    await application.process_update(make_update(1, user_id, "my-model", application.bot))
+    assert settings_manager.get_user_settings(user_id).text_settings.custom_model == "my-model"
+    assert handlers.PENDING_INPUT not in application.user_data[user_id]
+    assert not submitted
+    await application.process_update(make_update(2, user_id, "Привет", application.bot))
+    assert submitted == [user_id]
+    await application.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=3, help="прогонов каждого варианта, берется лучший")
+    args = parser.parse_args()
+
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(args.users)], f)
+
+    asyncio.run(check_pending_input())
+    print(f"Апдейтов: {args.updates}, пользователей: {args.users}")
+    print(f"{'вариант':<22}{'мкс на апдейт':>14}{'вызовов обработчиков':>22}")
+    results = {}
+    for _ in range(args.rounds):
+        for layout in ("legacy", "router"):
+            per_update, calls = asyncio.run(run(layout, args.updates, args.users))
+            if layout not in results or per_update < results[layout][0]:
+                results[layout] = (per_update, calls)
+    names = {"legacy": "каскад (группы 0-3)", "router": "route_text_message"}
+    for layout, (per_update, calls) in results.items():
+        print(f"{names[layout]:<22}{per_update:>14.1f}{calls:>22.1f}")
+    print(f"Ускорение: {results['legacy'][0] / results['router'][0]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
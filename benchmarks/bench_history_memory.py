@@ -0,0 +1,148 @@
+"""
+Память и скорость работы с историей сообщений.
+
+Сравнивает историю в виде списка словарей (как раньше) с MessageHistory:
+ограничение длины, общие строки ролей и сжатие старых сообщений. Затем
+проверяет бюджет памяти SettingsManager: неактивные пользователи
+выгружаются и прозрачно загружаются из хранилища при обращении.
+
+Запуск:
+    python benchmarks/bench_history_memory.py --users 1000 --messages 300
+    python benchmarks/bench_history_memory.py --budget-mb 8
+"""
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+
+from fakes import prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+
+WORDS = (
+    "модель ответ вопрос история сообщение контекст токен пользователь бот "
+    "настройка запрос поток текст пример функция данные память python"
+).split()
+
+
+def make_messages(count: int, rng: random.Random) -> list[dict]:
+    messages = []
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        # Ответы модели заметно длиннее вопросов
+        length = rng.randint(5, 40) if role == "user" else rng.randint(30, 150)
+        messages.append({"role": role, "content": " ".join(rng.choices(WORDS, k=length))})
+    return messages
+
+
+def copy_str(text: str) -> str:
+    """Новая строка с тем же текстом, как после чтения из базы или JSON."""
+    return (text + " ")[:-1]
+
+
+def measure(build):
+    """Возвращает (результат, выделенная память в байтах)."""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def bench_representation(users: int, messages: int, seed: int):
+    from context_window import context_builder
+    from history import HISTORY_HOT_MESSAGES, HISTORY_MAX_MESSAGES, MessageHistory
+
+    rng = random.Random(seed)
+    source = [make_messages(messages, rng) for _ in range(users)]
+    texts = sum(len(m["content"].encode()) for history in source for m in history)
+
+    # Строки копируются: после загрузки из хранилища они не общие
+    def as_dicts():
+        return [[{"role": copy_str(m["role"]), "content": copy_str(m["content"])} for m in h] for h in source]
+
+    def as_history():
+        return [
+            MessageHistory({"role": copy_str(m["role"]), "content": copy_str(m["content"])} for m in h)
+            for h in source
+        ]
+
+    dicts, dicts_size = measure(as_dicts)
+    histories, history_size = measure(as_history)
+
+    print(f"Пользователей: {users}, сообщений у каждого: {messages}, "
+          f"лимит: {HISTORY_MAX_MESSAGES}, несжатых: {HISTORY_HOT_MESSAGES}")
+    print(f"Текст сообщений:            {texts / 1024 / 1024:8.1f} МБ")
+    print(f"Список словарей:            {dicts_size / 1024 / 1024:8.1f} МБ")
+    print(f"MessageHistory:             {history_size / 1024 / 1024:8.1f} МБ "
+          f"(оценка nbytes {sum(h.nbytes for h in histories) / 1024 / 1024:.1f} МБ)")
+
+    for name, data in (("список словарей", dicts), ("MessageHistory", histories)):
+        for model in ("gpt-4", "gpt-4o"):
+            # Первый проход заполняет кэш токенов, как на предыдущих ходах диалога
+            for history in data:
+                context_builder.build(history, model, 1000)
+            started = time.perf_counter()
+            total = 0
+            for history in data:
+                total += len(context_builder.build(history, model, 1000))
+            elapsed = (time.perf_counter() - started) / len(data) * 1e6
+            print(f"Контекст {model:<7} ({name}): {elapsed:8.1f} мкс на пользователя, "
+                  f"{total / len(data):.0f} сообщений")
+    # Тексты в кэше не хранятся, только хэши: размер ограничен cache_bytes
+    print(f"Кэш количества токенов:     {context_builder._token_cache_bytes / 1024 / 1024:8.1f} МБ "
+          f"({len(context_builder._token_cache)} записей)")
+
+
+async def bench_eviction(users: int, messages: int, budget_mb: float, seed: int):
+    from settings import SettingsManager
+    from storage import MemoryStorage
+
+    rng = random.Random(seed)
+    manager = SettingsManager(storage=MemoryStorage(), flush_delay=0, memory_budget_mb=budget_mb)
+    started = time.perf_counter()
+    for user_id in range(users):
+        for message in make_messages(messages, rng):
+            manager.append_message(user_id, message)
+        if user_id % 100 == 99:
+            await manager.drain()
+            manager._enforce_memory_budget(force=True)
+    await manager.drain()
+    manager._enforce_memory_budget(force=True)
+    elapsed = time.perf_counter() - started
+
+    print(f"\nБюджет памяти: {budget_mb} МБ, добавлено {users * messages} сообщений за {elapsed:.2f} с")
+    print(f"В памяти пользователей:     {len(manager.users)}, выгружено: {len(manager._unloaded)}")
+    print(f"Оценка занятой памяти:      {manager.memory_usage() / 1024 / 1024:.1f} МБ")
+
+    # Первый пользователь давно выгружен: загружается из хранилища при обращении
+    user_id = 0
+    started = time.perf_counter()
+    await manager.sync_user(user_id)
+    history = manager.get_user_settings(user_id).message_history
+    elapsed = (time.perf_counter() - started) * 1000
+    stored = len(manager.storage.load_user(user_id)["message_history"])
+    print(f"Загрузка выгруженного:      {elapsed:.2f} мс, в памяти {len(history)} из {stored} сообщений")
+    assert len(history) == min(stored, history.max_messages)
+    assert len(manager.user_ids()) == users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=300, help="сообщений в истории каждого пользователя")
+    parser.add_argument('--budget-mb', type=float, default=16)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    bench_representation(args.users, args.messages, args.seed)
+    asyncio.run(bench_eviction(args.users, args.messages, args.budget_mb, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Время обработки нажатий кнопок в меню настроек.
+
+Прогоняет типичные сценарии работы с меню (открыть настройки текста,
+сменить температуру и число токенов, перейти к изображениям, сменить
+качество, HDR и размер) через Application.process_update со всеми
+обработчиками бота и сравнивает прежнее построение клавиатур (из словаря
+настроек с вычисляемыми полями при каждом нажатии) с кэшем готовых
+клавиатур в utils.
+Ответы Telegram заменены заглушкой; после каждого изменения настройки
+проверяется, что отправленная клавиатура показывает новое значение.
+
+Запуск:
+    python benchmarks/bench_keyboards.py --users 200 --sessions 20
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from fakes import prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+
+TOKEN = "123456:KEYBOARDS"
+FIRST_USER_ID = 810000000
+TEMPERATURES = ["0.0", "0.3", "0.5", "0.7", "1.0"]
+TOKENS = ["500", "1000", "2000"]
+SIZES = ["1024x1024", "1024x1792", "1792x1024"]
+QUALITIES = ["standard", "hd"]
+
+
+def session(index: int) -> list[tuple[str, str]]:
+    """Нажатия кнопок одного сеанса и ожидаемый текст кнопки после них."""
+    temperature = TEMPERATURES[index % len(TEMPERATURES)]
+    tokens = TOKENS[index % len(TOKENS)]
+    size = SIZES[index % len(SIZES)]
+    quality = QUALITIES[index % len(QUALITIES)]
+    return [
+        ("text_settings", ""),
+        ("change_temperature", ""),
+        (f"set_temp_{temperature}", f"🌡 Температура: {float(temperature)}"),
+        ("change_max_tokens", ""),
+        (f"set_tokens_{tokens}", f"📊 Макс. токенов: {tokens}"),
+        ("back_to_main", ""),
+        ("image_settings", ""),
+        ("change_quality", ""),
+        (f"set_quality_{quality}", f"✨ Качество: {quality}"),
+        ("toggle_hdr", "HDR: "),
+        ("change_size", ""),
+        (f"set_size_{size}", f"📏 Размер: {size}"),
+        ("back_to_main", ""),
+    ]
+
+
+def legacy_text_settings_keyboard(current_settings: dict):
+    """create_text_settings_keyboard до кэша клавиатур."""
+    from utils import create_menu_keyboard
+
+    current_model = current_settings.get('effective_model', current_settings.get('model', 'gpt-4o-mini'))
+    current_base_url = current_settings.get('base_url', 'https://api.openai.com/v1')
+    display_base_url = current_base_url
+    if len(display_base_url) > 30:
+        display_base_url = display_base_url[:27] + "..."
+    return create_menu_keyboard([
+        [(f"🔄 Модель: {current_model}", "change_text_model")],
+        [(f"🌐 Base URL: {display_base_url}", "change_base_url")],
+        [(f"🌡 Температура: {current_settings.get('temperature', 0.7)}", "change_temperature")],
+        [(f"📊 Макс. токенов: {current_settings.get('max_tokens', 1000)}", "change_max_tokens")],
+        [("🔙 Назад", "back_to_main"), ("❌ Закрыть", "close_settings")]
+    ])
+
+
+def legacy_image_settings_keyboard(current_settings: dict):
+    """create_image_settings_keyboard до кэша клавиатур."""
+    from utils import create_menu_keyboard
+
+    current_base_url = current_settings.get('base_url', 'https://api.openai.com/v1')
+    display_base_url = current_base_url
+    if len(display_base_url) > 30:
+        display_base_url = display_base_url[:27] + "..."
+    buttons = [
+        [(f"🔄 Модель: {current_settings['model']}", "change_image_model")],
+        [(f"🌐 Base URL: {display_base_url}", "change_image_base_url")],
+        [(f"📏 Размер: {current_settings['size']}", "change_size")]
+    ]
+    if len(current_settings.get('available_qualities', [])) > 1:
+        buttons.append([(f"✨ Качество: {current_settings['quality']}", "change_quality")])
+    if current_settings.get('available_styles', []):
+        buttons.append([(f"🎨 Стиль: {current_settings['style']}", "change_style")])
+    if current_settings.get('supports_hdr', False):
+        hdr_status = 'Вкл' if current_settings['hdr'] else 'Выкл'
+        buttons.append([(f"HDR: {hdr_status}", "toggle_hdr")])
+    buttons.append([("🔙 Назад", "back_to_main"), ("❌ Закрыть", "close_settings")])
+    return create_menu_keyboard(buttons)
+
+
+def use_legacy_keyboards():
+    """Подменяет построение клавиатур в handlers прежним, без кэша."""
+    import handlers
+    import utils
+
+    handlers.create_settings_keyboard = utils._build_settings_keyboard
+    handlers.create_text_settings_keyboard = lambda settings: legacy_text_settings_keyboard(dict(
+        settings.to_dict(),
+        available_models=list(settings.available_models),
+        effective_model=settings.effective_model
+    ))
+    handlers.create_image_settings_keyboard = lambda settings: legacy_image_settings_keyboard(dict(
+        settings.to_dict(),
+        available_models=list(settings.available_models),
+        available_sizes=list(settings.available_sizes),
+        available_qualities=list(settings.available_qualities),
+        available_styles=list(settings.available_styles),
+        supports_hdr=settings.supports_hdr
+    ))
+    handlers.create_choice_keyboard = (
+        lambda options, current, prefix, back, label_prefix="":
+        utils._build_choice_keyboard(options, current, prefix, back, label_prefix)
+    )
+
+
+def make_bot(sent: list):
+    from telegram import User
+    from telegram.ext import ExtBot
+
+    class OfflineBot(ExtBot):
+        """Бот без сети: ответы на нажатия никуда не отправляются."""
+
+        async def get_me(self, *args, **kwargs):
+            self._bot_user = User(id=int(TOKEN.split(":")[0]), first_name="Bot", is_bot=True, username="bench_bot")
+            return self._bot_user
+
+        async def answer_callback_query(self, *args, **kwargs):
+            return True
+
+        async def edit_message_text(self, text, *args, reply_markup=None, **kwargs):
+            sent.append(reply_markup)
+            return True
+
+    return OfflineBot(TOKEN)
+
+
+def make_update(update_id: int, user_id: int, data: str, bot):
+    from telegram import Update
+
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": "User"},
+                "text": "⚙️ Настройки бота",
+            },
+        }
+    }, bot)
+
+
+def labels(markup) -> list[str]:
+    return [button.text for row in markup.inline_keyboard for button in row]
+
+
+async def run(mode: str, users: int, sessions: int):
+    from types import SimpleNamespace
+    from telegram.ext import Application
+    import bot as bot_module
+    import handlers
+    import metrics
+    import utils
+    from log_config import with_request_id
+
+    if mode == "legacy":
+        use_legacy_keyboards()
+    else:
+        utils.keyboard_cache = utils.KeyboardCache()
+    sent = []
+    application = Application.builder().bot(make_bot(sent)).build()
+    bot_module.GPTBot._setup_handlers(SimpleNamespace(application=application))
+    for group in application.handlers.values():
+        for handler in group:
+            handler.callback = with_request_id(metrics.track_handler(handler.callback))
+    await application.initialize()
+
+    batch = []
+    for number in range(sessions):
+        for index in range(users):
+            for data, expected in session(number + index):
+                batch.append((make_update(len(batch) + 1, FIRST_USER_ID + index, data, application.bot), expected))
+
+    started = time.perf_counter()
+    for update, _ in batch:
+        await application.process_update(update)
+    elapsed = time.perf_counter() - started
+    await application.shutdown()
+
+    assert len(sent) == len(batch), "не все нажатия обработаны"
+    for (_, expected), markup in zip(batch, sent):
+        assert not expected or any(label.startswith(expected) for label in labels(markup)), expected
+    cache = utils.keyboard_cache
+    return elapsed / len(batch) * 1e6, len(batch), (cache.hits, cache.misses) if mode == "cached" else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=10, help="сеансов работы с меню на пользователя")
+    parser.add_argument('--rounds', type=int, default=3, help="прогонов каждого варианта, берется лучший")
+    args = parser.parse_args()
+
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(args.users)], f)
+
+    # Прежний вариант подменяет функции в handlers, поэтому идет последним
+    results = {}
+    for mode in ("cached", "legacy"):
+        for _ in range(args.rounds):
+            result = asyncio.run(run(mode, args.users, args.sessions))
+            if mode not in results or result[0] < results[mode][0]:
+                results[mode] = result
+    print(f"Нажатий: {results['cached'][1]}, пользователей: {args.users}")
+    print(f"{'вариант':<24}{'мкс на нажатие':>15}")
+    names = {"legacy": "построение из словаря", "cached": "кэш клавиатур"}
+    for mode in ("legacy", "cached"):
+        print(f"{names[mode]:<24}{results[mode][0]:>15.1f}")
+    hits, misses = results["cached"][2]
+    print(f"Кэш: попаданий {hits}, построено клавиатур {misses}")
+    print(f"Ускорение: {results['legacy'][0] / results['cached'][0]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Накладные расходы логирования в обработчиках.
+
+Прогоняет текстовые запросы через handle_text (с request_id и метриками,
+как в боте) с поддельной моделью без задержек и сравнивает время
+обработчика в режиме отладки: без логов, с прежней настройкой loguru, с
+синхронной записью, с записью в фоновом потоке (LOG_ENQUEUE), в формате
+JSON (LOG_JSON) и с выборкой отладочных записей (LOG_DEBUG_SAMPLE_RATE).
+Записи пишутся в файл и в stderr, перенаправленный в /dev/null или в
+медленный поток (как pipe, который не успевает читать сборщик логов).
+После прогона проверяется, что записи обработчика и бота в JSON-логе
+связаны одним request_id.
+
+Запуск:
+    python benchmarks/bench_logging.py --requests 2000
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+from fakes import FakeAsyncOpenAI, FakeBot, make_client_pool, prepare_environment
+
+prepare_environment()
+os.environ['DEBUG'] = 'true'
+
+from loguru import logger  # noqa: E402
+
+FIRST_USER_ID = 700000000
+# Время одной записи в медленный stderr, секунды
+SLOW_WRITE = 0.001
+# (название, параметры setup_logging или "legacy"/None, медленный stderr)
+MODES = [
+    ("без логов", None, False),
+    ("прежний", "legacy", False),
+    ("текст", dict(json_logs=False, enqueue=False), False),
+    ("текст, фон", dict(json_logs=False, enqueue=True), False),
+    ("JSON, фон", dict(json_logs=True, enqueue=True), False),
+    ("JSON, фон, 10%", dict(json_logs=True, enqueue=True, debug_sample_rate=0.1), False),
+    ("прежний", "legacy", True),
+    ("текст, фон", dict(json_logs=False, enqueue=True), True),
+]
+LEGACY_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+)
+
+
+class SlowStream:
+    """Поток, каждая запись в который занимает SLOW_WRITE секунд."""
+
+    def write(self, text):
+        time.sleep(SLOW_WRITE)
+
+    def flush(self):
+        pass
+
+
+def setup_legacy_logging():
+    """Настройка логов в bot.py до LOG_JSON и LOG_ENQUEUE."""
+    logger.remove()
+    logger.add("logs/debug.log", format=LEGACY_FORMAT, level="DEBUG", rotation="500 MB",
+               compression="zip", retention="10 days")
+    logger.add(sys.stderr, format=LEGACY_FORMAT, level="DEBUG")
+
+
+def make_update(update_id, user_id, text, bot):
+    async def reply_text(reply, **kwargs):
+        return await bot.send_message(user_id, reply)
+
+    return SimpleNamespace(
+        update_id=update_id,
+        effective_user=SimpleNamespace(id=user_id, username=f"user{user_id}"),
+        effective_chat=SimpleNamespace(id=user_id, type="private"),
+        message=SimpleNamespace(text=text, reply_text=reply_text)
+    )
+
+
+async def run(options, slow: bool, requests: int, users: int):
+    import handlers
+    from chat_queue import ChatRequestQueue
+    import bot as bot_module
+    import metrics
+    from edit_scheduler import EditScheduler
+    from log_config import setup_logging, with_request_id
+    from settings import settings_manager
+
+    for path in glob.glob("logs/*.log"):
+        os.remove(path)
+    stderr, sys.stderr = sys.stderr, SlowStream() if slow else open(os.devnull, "w")
+    if options is None:
+        logger.remove()
+    elif options == "legacy":
+        setup_legacy_logging()
+    else:
+        setup_logging(debug=True, **options)
+    sys.stderr = stderr
+
+    bot_module.edit_scheduler = EditScheduler(min_interval=0, global_rate=1000000)
+    # Сообщения пользователя приходят по одному: окно объединения серий
+    # (CHAT_BURST_WINDOW) только добавило бы паузу перед каждым ответом
+    handlers.chat_queue = ChatRequestQueue(window=0)
+    client = FakeAsyncOpenAI(chunks=[f"слово{i} " for i in range(20)], chunk_delay=0)
+    fake_bot = FakeBot()
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.client_pool = make_client_pool(client)
+    gpt_bot.application = SimpleNamespace(bot=fake_bot)
+    context = SimpleNamespace(
+        application=SimpleNamespace(bot_data={'gpt_bot': gpt_bot}),
+        bot=fake_bot,
+        user_data={}
+    )
+    handle_text = with_request_id(metrics.track_handler(handlers.handle_text))
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    for user_id in user_ids:
+        settings_manager.clear_message_history(user_id)
+
+    async def converse(index, user_id):
+        for turn in range(requests // users):
+            update_id = turn * users + index + 1
+            await handle_text(make_update(update_id, user_id, f"Вопрос {turn}", fake_bot), context)
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(i, user_id) for i, user_id in enumerate(user_ids)))
+    elapsed = time.perf_counter() - started
+    # Ожидание фонового потока записи не входит во время обработчиков
+    drain_started = time.perf_counter()
+    logger.remove()
+    drained = time.perf_counter() - drain_started
+    cpu = time.process_time() - cpu_started
+
+    lines = []
+    for path in glob.glob("logs/*.log"):
+        with open(path, encoding="utf-8") as f:
+            lines.extend(f)
+    return {
+        "per_request": elapsed / requests * 1e6,
+        "cpu": cpu / requests * 1e6,
+        "drain": drained,
+        "lines": len(lines),
+        "json": isinstance(options, dict) and options.get("json_logs"),
+        "log": lines,
+    }
+
+
+def check_correlation(lines: list[str]):
+    """Записи обработчика, запроса к модели и правок связаны request_id."""
+    records = [json.loads(line) for line in lines]
+    by_request = {}
+    for record in records:
+        if "request_id" in record:
+            by_request.setdefault(record["request_id"], set()).add(record["logger"])
+    assert by_request, "в логе нет записей с request_id"
+    complete = sum(1 for modules in by_request.values() if {"handlers", "bot"} <= modules)
+    return len(by_request), complete
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=3, help="прогонов каждого режима, берется лучший")
+    args = parser.parse_args()
+
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(args.users)], f)
+
+    print(f"Запросов: {args.requests}, пользователей: {args.users}, уровень DEBUG")
+    print(f"{'режим':<16}{'stderr':<11}{'мкс на запрос':>14}{'CPU, мкс':>10}{'записей':>9}{'дозапись, с':>13}")
+    # Режимы чередуются по кругу, чтобы прогрев и рост базы не искажали сравнение
+    results = {}
+    for _ in range(args.rounds):
+        for name, options, slow in MODES:
+            result = asyncio.run(run(options, slow, args.requests, args.users))
+            best = results.get((name, slow))
+            if best is None or result["per_request"] < best["per_request"]:
+                results[name, slow] = result
+    baseline = results[MODES[0][0], False]["per_request"]
+    for name, _, slow in MODES:
+        result = results[name, slow]
+        print(f"{name:<16}{'медленный' if slow else '/dev/null':<11}{result['per_request']:>14.0f}"
+              f"{result['cpu']:>10.0f}{result['lines']:>9}{result['drain']:>13.2f}"
+              f"   +{result['per_request'] / baseline - 1:.0%}")
+        if result["json"]:
+            requests, complete = check_correlation(result["log"])
+            print(f"{'':<16}запросов в логе: {requests}, из них с записями обработчика и бота: {complete}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Стоимость преобразования потокового ответа в разметку Telegram.
+
+Ответ модели в Markdown (заголовки, списки, выделение, код, ссылки)
+приходит фрагментами, и после каждого фрагмента строится текст правки.
+Сравнивается инкрементальный StreamRenderer, который разбирает только
+новый текст, с разбором всего ответа заново на каждую правку. Время
+правок в начале и в конце ответа показывает, растет ли стоимость правки
+с длиной ответа. Промежуточные тексты в HTML проверяются на парность тегов.
+Кроме того, ответ разбивается на фрагменты случайной длины: финальный
+текст инкрементального разбора должен совпасть с разбором всего ответа
+за один вызов и не содержать пустых сущностей.
+
+Запуск:
+    python benchmarks/bench_render.py --chars 4000 --chunk 20
+"""
+import argparse
+import html.parser
+import random
+import time
+
+from fakes import prepare_environment
+
+prepare_environment()
+
+from formatting import HTML, MARKDOWN_V2, StreamRenderer  # noqa: E402
+
+PARAGRAPHS = [
+    "## Решение\n",
+    "Чтобы **ускорить** обработку, используйте `asyncio.gather` и *не блокируйте* event loop.\n",
+    "* первый пункт со ссылкой на [документацию](https://docs.python.org/3/library/asyncio.html)\n",
+    "* второй пункт: значения `snake_case_name` и 2*3 остаются как есть\n",
+    "```python\nasync def main():\n    results = await asyncio.gather(*tasks)\n    return [r for r in results if r < 10 and r > 0]\n```\n",
+    "Итог: ~~медленно~~ быстро, <теги> & спецсимволы экранируются.\n\n",
+    "Вложенное: ***жирный курсив*** и **~~зачеркнутый~~**, пустые: ** ** и __ __\n## \n",
+]
+EMPTY_ENTITIES = ("<b></b>", "<i></i>", "<s></s>", "<code></code>")
+
+
+class TagChecker(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.stack = []
+        self.valid = True
+
+    def handle_starttag(self, tag, attrs):
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack.pop() != tag:
+            self.valid = False
+
+
+def check_html(text: str):
+    checker = TagChecker()
+    checker.feed(text)
+    checker.close()
+    assert checker.valid and not checker.stack, text
+
+
+def make_answer(chars: int) -> str:
+    parts = []
+    while sum(map(len, parts)) < chars:
+        parts.append(PARAGRAPHS[len(parts) % len(PARAGRAPHS)])
+    return "".join(parts)[:chars]
+
+
+def run(mode: str, answer: str, chunk: int, incremental: bool, check: bool):
+    """Возвращает время правок (мкс) по порядку и финальный текст."""
+    renderer = StreamRenderer(mode)
+    timings = []
+    for end in range(chunk, len(answer) + chunk, chunk):
+        text = answer[:end]
+        final = end >= len(answer)
+        if not incremental:
+            renderer = StreamRenderer(mode)
+        started = time.perf_counter()
+        rendered = renderer.render(text, final)
+        timings.append((time.perf_counter() - started) * 1e6)
+        if check and mode == HTML:
+            check_html(rendered)
+    return timings, rendered
+
+
+def check_chunkings(mode: str, answer: str, trials: int):
+    """Финальный текст не зависит от того, какими фрагментами пришел ответ."""
+    expected = StreamRenderer(mode).render(answer, True)
+    generator = random.Random(trials)
+    for _ in range(trials):
+        renderer = StreamRenderer(mode)
+        end = 0
+        while end < len(answer):
+            end += generator.randint(1, 12)
+            rendered = renderer.render(answer[:end])
+            if mode == HTML:
+                check_html(rendered)
+                assert not any(empty in rendered for empty in EMPTY_ENTITIES), rendered
+        rendered = renderer.render(answer, True)
+        assert rendered == expected, "инкрементальный разбор дал другой результат"
+    assert not any(empty in expected for empty in EMPTY_ENTITIES), expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chars', type=int, default=4000)
+    parser.add_argument('--chunk', type=int, default=20, help="символов между правками")
+    parser.add_argument('--rounds', type=int, default=5, help="прогонов каждого варианта, берется лучший")
+    parser.add_argument('--chunkings', type=int, default=200, help="случайных разбиений ответа для проверки")
+    args = parser.parse_args()
+
+    answer = make_answer(args.chars)
+    print(f"Ответ: {len(answer)} символов, правка каждые {args.chunk} символов")
+    print(f"{'разметка':<12}{'разбор':<10}{'всего, мс':>10}{'правка в начале, мкс':>22}{'в конце, мкс':>14}")
+    for mode in (HTML, MARKDOWN_V2):
+        finals = {}
+        for incremental in (False, True):
+            best = None
+            for round_number in range(args.rounds):
+                timings, finals[incremental] = run(mode, answer, args.chunk, incremental, round_number == 0)
+                if best is None or sum(timings) < sum(best):
+                    best = timings
+            quarter = max(1, len(best) // 4)
+            print(f"{mode:<12}{'новый' if incremental else 'заново':<10}{sum(best) / 1000:>10.1f}"
+                  f"{sum(best[:quarter]) / quarter:>22.1f}{sum(best[-quarter:]) / quarter:>14.1f}")
+        assert finals[True] == finals[False], "инкрементальный разбор дал другой результат"
+        check_chunkings(mode, answer[:1500], args.chunkings)
+    print(f"Случайных разбиений ответа: {args.chunkings}, финальный текст совпадает с разбором целиком")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Стоимость работы с настройками пользователя.
+
+Сравнивает прежние модели pydantic (переопределенный dict() с
+вычисляемыми полями, parse_obj при загрузке) с объектами со слотами из
+settings.py по операциям, которые бот выполняет постоянно: чтение
+настроек на каждое сообщение, подготовка строки для записи в хранилище,
+загрузка пользователя из хранилища, размер записи и объем памяти на
+пользователя. Проверка pydantic для новых объектов выполняется только при
+импорте и экспорте и здесь не измеряется.
+
+Запуск:
+    python benchmarks/bench_settings_models.py --users 20000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+import warnings
+
+from fakes import prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+# Прежний код вызывал устаревшие dict() и parse_obj pydantic 2
+warnings.simplefilter("ignore")
+
+
+def legacy_models():
+    """Модели настроек в прежнем виде."""
+    from typing import Optional
+    from pydantic import BaseModel
+
+    class TextModelSettings(BaseModel):
+        base_url: str = "https://api.openai.com/v1"
+        model: str = "gpt-4o-mini"
+        temperature: float = 0.7
+        max_tokens: int = 1000
+        custom_model: Optional[str] = None
+
+        @property
+        def available_models(self):
+            return ["gpt-4o-mini", "gpt-4o", "gpt-4", "Custom Model"]
+
+        @property
+        def effective_model(self):
+            if self.model == "Custom Model" and self.custom_model:
+                return self.custom_model
+            return self.model
+
+        def dict(self, *args, **kwargs):
+            d = super().dict(*args, **kwargs)
+            d['available_models'] = self.available_models
+            d['effective_model'] = self.effective_model
+            return d
+
+    class ImageModelSettings(BaseModel):
+        base_url: str = "https://api.openai.com/v1"
+        model: str = "dall-e-3"
+        size: str = "1024x1024"
+        quality: str = "standard"
+        style: str = "natural"
+        hdr: bool = False
+
+        @property
+        def available_models(self):
+            return ["dall-e-3", "dall-e-2"]
+
+        @property
+        def model_capabilities(self):
+            return {
+                "dall-e-3": {"sizes": ["1024x1024", "1024x1792", "1792x1024"],
+                             "qualities": ["standard", "hd"], "styles": ["natural", "vivid"], "hdr": True},
+                "dall-e-2": {"sizes": ["1024x1024", "512x512", "256x256"],
+                             "qualities": ["standard"], "styles": [], "hdr": False}
+            }
+
+        @property
+        def available_sizes(self):
+            return self.model_capabilities[self.model]["sizes"]
+
+        @property
+        def available_qualities(self):
+            return self.model_capabilities[self.model]["qualities"]
+
+        @property
+        def available_styles(self):
+            return self.model_capabilities[self.model]["styles"]
+
+        @property
+        def supports_hdr(self):
+            return self.model_capabilities[self.model]["hdr"]
+
+        def dict(self, *args, **kwargs):
+            d = super().dict(*args, **kwargs)
+            d['available_models'] = self.available_models
+            d['available_sizes'] = self.available_sizes
+            d['available_qualities'] = self.available_qualities
+            d['available_styles'] = self.available_styles
+            d['supports_hdr'] = self.supports_hdr
+            return d
+
+    class UserSettings(BaseModel):
+        user_id: int
+        text_settings: TextModelSettings = TextModelSettings()
+        image_settings: ImageModelSettings = ImageModelSettings()
+
+    return TextModelSettings, ImageModelSettings, UserSettings
+
+
+def stored_user(user_id: int) -> dict:
+    """Пользователь в том виде, в котором его возвращает хранилище."""
+    return {
+        "user_id": user_id,
+        "text_settings": {"model": "gpt-4o", "temperature": 0.5, "max_tokens": 2000},
+        "image_settings": {"model": "dall-e-3", "quality": "hd", "hdr": True},
+        "message_history": [],
+    }
+
+
+def per_call(func, items) -> float:
+    started = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - started) / len(items) * 1e6
+
+
+def measure(variant: str, users: int) -> dict:
+    if variant == "legacy":
+        _, _, UserSettings = legacy_models()
+        load = UserSettings.parse_obj
+        row = lambda s: (s.text_settings.dict(), s.image_settings.dict())  # noqa: E731
+    else:
+        from settings import UserSettings
+        load = UserSettings.from_dict
+        row = lambda s: (s.text_settings.to_dict(), s.image_settings.to_dict())  # noqa: E731
+
+    data = [stored_user(i) for i in range(users)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    loaded = [load(item) for item in data]
+    memory = (tracemalloc.get_traced_memory()[0] - before) / users
+    tracemalloc.stop()
+
+    def read_turn(settings):
+        # Что читает обработчик текста на каждое сообщение
+        text_settings = settings.text_settings
+        return (text_settings.effective_model, text_settings.base_url,
+                text_settings.temperature, text_settings.max_tokens)
+
+    def read_image(settings):
+        image_settings = settings.image_settings
+        return (image_settings.available_qualities, image_settings.available_styles,
+                image_settings.supports_hdr)
+
+    def write_row(settings):
+        text_settings, image_settings = row(settings)
+        return json.dumps(text_settings, ensure_ascii=False), json.dumps(image_settings, ensure_ascii=False)
+
+    text_row, image_row = write_row(loaded[0])
+    return {
+        "load": per_call(load, data),
+        "read": per_call(read_turn, loaded),
+        "read_image": per_call(read_image, loaded),
+        "write": per_call(write_row, loaded),
+        "row_bytes": len(text_row.encode()) + len(image_row.encode()),
+        "memory": memory,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=3, help="прогонов каждого варианта, берется лучший")
+    args = parser.parse_args()
+
+    results = {}
+    for _ in range(args.rounds):
+        for variant in ("legacy", "slots"):
+            result = measure(variant, args.users)
+            best = results.setdefault(variant, result)
+            for key, value in result.items():
+                best[key] = min(best[key], value)
+    print(f"Пользователей: {args.users}")
+    print(f"{'вариант':<12}{'загрузка, мкс':>15}{'чтение, мкс':>13}{'возможн., мкс':>15}"
+          f"{'запись, мкс':>13}{'строка, байт':>14}{'память, байт':>14}")
+    names = {"legacy": "pydantic", "slots": "__slots__"}
+    for variant, result in results.items():
+        print(f"{names[variant]:<12}{result['load']:>15.2f}{result['read']:>13.3f}{result['read_image']:>15.3f}"
+              f"{result['write']:>13.2f}{result['row_bytes']:>14}{result['memory']:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
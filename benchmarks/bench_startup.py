@@ -0,0 +1,136 @@
+"""
+Время запуска SettingsManager в зависимости от количества пользователей.
+
+Создает базу SQLite с заданным количеством пользователей и сравнивает
+прежнюю загрузку всех пользователей при запуске (load_all и UserSettings для
+каждого) с ленивой: при запуске читаются только ID, а пользователь
+загружается при первом обращении. Каждый вариант запускается в отдельном
+процессе, чтобы измерить прирост пиковой памяти.
+
+Запуск:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --users 10000 100000 1000000 --eager-limit 1000000
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import time
+
+from fakes import prepare_environment
+
+MESSAGES_PER_USER = 4
+FIRST_ACCESS_SAMPLE = 1000
+
+
+def create_database(db_file: str, users: int):
+    from settings import UserSettings
+    from storage import SQLiteStorage
+
+    storage = SQLiteStorage(db_file)
+    defaults = UserSettings(user_id=0)
+    text_settings = json.dumps(defaults.text_settings.to_dict(), ensure_ascii=False)
+    image_settings = json.dumps(defaults.image_settings.to_dict(), ensure_ascii=False)
+    conn = storage._conn
+    with conn:
+        for start in range(0, users, 50000):
+            ids = range(start + 1, min(users, start + 50000) + 1)
+            conn.executemany(
+                "INSERT INTO user_settings (user_id, text_settings, image_settings, version) VALUES (?, ?, ?, 1)",
+                ((user_id, text_settings, image_settings) for user_id in ids)
+            )
+            conn.executemany(
+                "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+                (
+                    (user_id, "user" if i % 2 == 0 else "assistant", f"сообщение {i} пользователя {user_id}")
+                    for user_id in ids for i in range(MESSAGES_PER_USER)
+                )
+            )
+    storage.close()
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode: str, db_file: str, users: int, results):
+    """Точка входа процесса: загружает настройки одним из способов."""
+    prepare_environment()
+    from loguru import logger
+    logger.remove()
+    from settings import SettingsManager, UserSettings
+    from storage import SQLiteStorage
+
+    storage = SQLiteStorage(db_file)
+    rss_before = max_rss_mb()
+    started = time.perf_counter()
+    if mode == "eager":
+        # Так SettingsManager загружал настройки до ленивой загрузки
+        loaded = {
+            user_id: UserSettings.from_dict(data)
+            for user_id, data in storage.load_all().items()
+        }
+        elapsed = time.perf_counter() - started
+        first_access = 0.0
+        count = len(loaded)
+    else:
+        manager = SettingsManager(storage=storage, memory_budget_mb=0)
+        elapsed = time.perf_counter() - started
+        count = len(manager.user_ids())
+        sample = random.Random(1).sample(range(1, users + 1), min(FIRST_ACCESS_SAMPLE, users))
+
+        async def touch_all():
+            for user_id in sample:
+                await manager.sync_user(user_id)
+                assert len(manager.get_user_settings(user_id).message_history) == MESSAGES_PER_USER
+
+        access_started = time.perf_counter()
+        asyncio.run(touch_all())
+        first_access = (time.perf_counter() - access_started) / len(sample) * 1000
+    results.put((mode, users, count, elapsed, max_rss_mb() - rss_before, first_access))
+
+
+def run_in_process(mode: str, db_file: str, users: int):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_mode, args=(mode, db_file, users, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--eager-limit', type=int, default=100000,
+                        help="не запускать полную загрузку для баз больше этого размера")
+    args = parser.parse_args()
+
+    workdir = prepare_environment()
+    from loguru import logger
+    logger.remove()
+
+    print(f"{'пользователей':>14}{'режим':>8}{'запуск, с':>11}{'память, МБ':>12}{'первое обращение, мс':>22}")
+    for users in args.users:
+        db_file = os.path.join(workdir, f"users_{users}.db")
+        started = time.perf_counter()
+        create_database(db_file, users)
+        print(f"{'':>14}  база создана за {time.perf_counter() - started:.1f} с, "
+              f"{os.path.getsize(db_file) / 1024 / 1024:.0f} МБ")
+        modes = ["lazy"] + (["eager"] if users <= args.eager_limit else [])
+        for mode in modes:
+            mode, users, count, elapsed, memory, first_access = run_in_process(mode, db_file, users)
+            assert count == users
+            access = f"{first_access:.3f}" if mode == "lazy" else "-"
+            print(f"{users:>14}{mode:>8}{elapsed:>11.2f}{memory:>12.0f}{access:>22}")
+        if users > args.eager_limit:
+            print(f"{users:>14}{'eager':>8}  пропущено (--eager-limit {args.eager_limit})")
+        os.remove(db_file)
+
+
+if __name__ == "__main__":
+    main()
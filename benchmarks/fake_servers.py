@@ -0,0 +1,322 @@
+"""
+Локальные HTTP-заглушки Telegram Bot API и OpenAI API для нагрузочных тестов.
+
+Сервер написан на asyncio без внешних зависимостей: бот под нагрузкой
+работает без изменений, ему достаточно указать адреса заглушек через
+TELEGRAM_API_URL и OPENAI_API_BASE.
+"""
+import asyncio
+import base64
+import json
+import random
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from itertools import count
+from typing import AsyncIterator, Awaitable, Callable, Optional, Union
+from urllib.parse import parse_qsl, urlsplit
+
+Response = tuple[int, Union[bytes, AsyncIterator[bytes]], str]
+Handler = Callable[[str, str, dict, bytes], Awaitable[Response]]
+
+# Маркер последнего чанка ответа модели: по нему генератор нагрузки
+# узнает, что бот отправил ответ целиком
+END_MARKER = "⏹"
+
+# Минимальный валидный PNG 1x1, который возвращает заглушка генерации изображений
+PNG_1X1 = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+
+class HTTPServer:
+    """
+    Минимальный HTTP/1.1 сервер с keep-alive и потоковыми ответами.
+
+    Обработчик получает метод, путь, заголовки и тело запроса и возвращает
+    (статус, тело, content-type). Если тело - асинхронный итератор, ответ
+    отправляется с Transfer-Encoding: chunked.
+    """
+
+    def __init__(self, handler: Handler, host: str = "127.0.0.1", port: int = 0):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, limit=2 ** 22)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    body = await reader.readexactly(int(headers["content-length"]))
+
+                status, payload, content_type = await self.handler(
+                    method, urlsplit(target).path, headers, body
+                )
+                head = f"HTTP/1.1 {status} OK\r\nContent-Type: {content_type}\r\n"
+                if isinstance(payload, bytes):
+                    writer.write(f"{head}Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                    await writer.drain()
+                else:
+                    writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode())
+                    async for part in payload:
+                        writer.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+                        await writer.drain()
+                    writer.write(b"0\r\n\r\n")
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Соединение закрыто клиентом или сервер останавливается
+            pass
+        finally:
+            writer.close()
+
+
+def parse_form(headers: dict, body: bytes) -> dict:
+    """
+    Разбирает параметры запроса python-telegram-bot.
+
+    Параметры приходят как form-urlencoded (или multipart при загрузке
+    файлов), нестроковые значения закодированы в JSON.
+    """
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        raw = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                raw[name] = part.get_payload(decode=True).decode("utf-8")
+            else:
+                raw[name] = part.get_payload(decode=True)
+    elif content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    else:
+        raw = dict(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+
+    params = {}
+    for name, value in raw.items():
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        params[name] = value
+    return params
+
+
+class FakeTelegramAPI:
+    """
+    Заглушка Bot API: getUpdates с long polling и исходящие методы бота.
+
+    Входящие апдейты добавляются через push_update. Каждый исходящий вызов
+    передается в on_call(method, params), чтобы генератор нагрузки мог
+    отмечать завершение операций.
+    """
+
+    BOT_ID = 100000001
+
+    def __init__(self, token: str, on_call: Optional[Callable[[str, dict], None]] = None):
+        self.prefix = f"/bot{token}/"
+        self.on_call = on_call
+        self.calls: dict[str, int] = {}
+        self._updates: asyncio.Queue = asyncio.Queue()
+        self._update_ids = count(1)
+        self._message_ids: dict[int, int] = {}
+        self._file_ids = count(1)
+
+    def next_message_id(self, chat_id: int) -> int:
+        self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+        return self._message_ids[chat_id]
+
+    def push_update(self, update: dict):
+        update["update_id"] = next(self._update_ids)
+        self._updates.put_nowait(update)
+
+    @property
+    def pending_updates(self) -> int:
+        return self._updates.qsize()
+
+    def bot_user(self) -> dict:
+        return {"id": self.BOT_ID, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+    def _message(self, chat_id: int, message_id: Optional[int] = None, **fields) -> dict:
+        message = {
+            "message_id": message_id or self.next_message_id(chat_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": self.bot_user()
+        }
+        message.update(fields)
+        return message
+
+    async def _get_updates(self, params: dict) -> list:
+        timeout = float(params.get("timeout", 0))
+        limit = int(params.get("limit", 100))
+        try:
+            first = await asyncio.wait_for(self._updates.get(), timeout) if timeout else self._updates.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        updates = [first]
+        while len(updates) < limit and not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    async def handle(self, method: str, path: str, headers: dict, body: bytes) -> Response:
+        if not path.startswith(self.prefix):
+            return 404, b'{"ok":false,"error_code":404,"description":"Not Found"}', "application/json"
+        api_method = path[len(self.prefix):]
+        params = parse_form(headers, body)
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+
+        if api_method == "getUpdates":
+            result = await self._get_updates(params)
+        elif api_method == "getMe":
+            result = dict(self.bot_user(), can_join_groups=True,
+                          can_read_all_group_messages=False, supports_inline_queries=False)
+        elif api_method == "sendMessage":
+            result = self._message(int(params["chat_id"]), text=params.get("text", ""))
+        elif api_method in ("editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(params["chat_id"]) if "chat_id" in params else 0
+            result = self._message(chat_id, params.get("message_id"), text=params.get("text", ""))
+        elif api_method == "sendPhoto":
+            file_id = f"photo-{next(self._file_ids)}"
+            result = self._message(
+                int(params["chat_id"]),
+                caption=params.get("caption", ""),
+                photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+            )
+        elif api_method == "sendDocument":
+            result = self._message(
+                int(params["chat_id"]),
+                document={"file_id": f"doc-{next(self._file_ids)}", "file_unique_id": "doc"}
+            )
+        else:
+            # deleteMessage, answerCallbackQuery, deleteWebhook, sendChatAction и др.
+            result = True
+
+        if self.on_call is not None and api_method != "getUpdates":
+            self.on_call(api_method, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode(), "application/json"
+
+
+class FakeOpenAIAPI:
+    """
+    Заглушка OpenAI API: chat completions (потоковые и обычные) и генерация изображений.
+
+    Args:
+        chunks: Количество чанков в ответе модели
+        first_token_latency: Задержка до первого чанка, секунды
+        chunk_latency: Задержка между чанками, секунды
+        image_latency: Время генерации изображения, секунды
+        models: Поведение отдельных моделей: {модель: {параметр: значение}}.
+            Параметры: first_token_latency; error_rate - доля ответов 500;
+            slow_rate и slow_latency - доля ответов с задержкой первого
+            чанка slow_latency вместо first_token_latency
+        seed: Начальное значение генератора случайных ошибок и задержек
+    """
+
+    def __init__(self, chunks: int = 40, first_token_latency: float = 0.3,
+                 chunk_latency: float = 0.02, image_latency: float = 2.0,
+                 models: Optional[dict[str, dict]] = None, seed: int = 1):
+        self.chunks = chunks
+        self.first_token_latency = first_token_latency
+        self.chunk_latency = chunk_latency
+        self.image_latency = image_latency
+        self.models = models or {}
+        self.random = random.Random(seed)
+        self.calls: dict[str, int] = {}
+        # Запросы chat completions по моделям
+        self.model_calls: dict[str, int] = {}
+
+    def _first_token_latency(self, model: str) -> float:
+        behaviour = self.models.get(model, {})
+        if self.random.random() < behaviour.get("slow_rate", 0):
+            return behaviour["slow_latency"]
+        return behaviour.get("first_token_latency", self.first_token_latency)
+
+    def _chunk(self, model: str, delta: dict, finish_reason: Optional[str] = None) -> bytes:
+        payload = {
+            "id": "chatcmpl-loadtest",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+    async def _stream(self, model: str, first_token_latency: float) -> AsyncIterator[bytes]:
+        await asyncio.sleep(first_token_latency)
+        yield self._chunk(model, {"role": "assistant", "content": ""})
+        for i in range(self.chunks):
+            if i:
+                await asyncio.sleep(self.chunk_latency)
+            yield self._chunk(model, {"content": f"слово{i} "})
+        yield self._chunk(model, {"content": END_MARKER})
+        yield self._chunk(model, {}, "stop")
+        yield b"data: [DONE]\n\n"
+
+    async def handle(self, method: str, path: str, headers: dict, body: bytes) -> Response:
+        endpoint = path.rsplit("/", 2)[-2:]
+        endpoint = "/".join(endpoint)
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        request = json.loads(body or b"{}")
+
+        if endpoint == "chat/completions":
+            model = request.get("model", "gpt-4o-mini")
+            self.model_calls[model] = self.model_calls.get(model, 0) + 1
+            if self.random.random() < self.models.get(model, {}).get("error_rate", 0):
+                await asyncio.sleep(self.chunk_latency)
+                error = {"error": {"message": "The server had an error", "type": "server_error"}}
+                return 500, json.dumps(error).encode(), "application/json"
+            first_token_latency = self._first_token_latency(model)
+
+        if endpoint == "chat/completions" and not request.get("stream"):
+            # Непотоковый запрос, например краткое содержание истории
+            await asyncio.sleep(first_token_latency)
+            payload = {
+                "id": "chatcmpl-loadtest",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4o-mini"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "краткое содержание"},
+                    "finish_reason": "stop"
+                }]
+            }
+            return 200, json.dumps(payload, ensure_ascii=False).encode(), "application/json"
+        if endpoint == "chat/completions":
+            return 200, self._stream(model, first_token_latency), "text/event-stream"
+        if endpoint == "images/generations":
+            await asyncio.sleep(self.image_latency)
+            image = base64.b64encode(PNG_1X1).decode()
+            payload = {"created": int(time.time()), "data": [{"b64_json": image}]}
+            return 200, json.dumps(payload).encode(), "application/json"
+        return 404, b'{"error":{"message":"not found"}}', "application/json"
@@ -0,0 +1,139 @@
+"""
+Поддельные клиенты OpenAI и Telegram для локальных бенчмарков.
+
+Позволяют запускать GPTBot без сети: поток ответа модели эмулируется
+асинхронным итератором с настраиваемой задержкой между чанками.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import sys
+import tempfile
+from types import SimpleNamespace
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare_environment():
+    """
+    Готовит окружение для импорта модулей бота.
+
+    Переходит во временный каталог, чтобы логи и файлы настроек
+    не попадали в рабочую директорию проекта.
+    """
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:TEST')
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+    workdir = tempfile.mkdtemp(prefix='gpt-bot-bench-')
+    os.chdir(workdir)
+    return workdir
+
+
+def make_chunk(content):
+    """Создает объект, повторяющий структуру чанка ChatCompletionChunk."""
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class FakeStream:
+    """Асинхронный поток чанков с задержкой между ними."""
+
+    def __init__(self, chunks, chunk_delay):
+        self._chunks = list(chunks)
+        self._chunk_delay = chunk_delay
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for content in self._chunks:
+            await asyncio.sleep(self._chunk_delay)
+            yield make_chunk(content)
+
+
+class FakeCompletions:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def create(self, messages=(), stream=False, **kwargs):
+        owner = self._owner
+        if stream:
+            owner.calls += 1
+            owner.prompts.append(messages)
+            return FakeStream(owner.chunks, owner.chunk_delay)
+        # Непотоковый запрос (краткое содержание): отвечает строками запроса,
+        # отмеченными как факты, будто модель сохранила важное
+        owner.completion_calls += 1
+        owner.active_completions += 1
+        owner.max_active_completions = max(owner.max_active_completions, owner.active_completions)
+        try:
+            await asyncio.sleep(owner.completion_delay)
+        finally:
+            owner.active_completions -= 1
+        facts = [line for line in messages[-1]["content"].splitlines() if "факт" in line.lower()]
+        message = SimpleNamespace(content="\n".join(dict.fromkeys(facts)) or "нет важных фактов")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FakeEmbeddings:
+    """Эмбеддинг "мешка слов": тексты с общими словами получаются близкими."""
+
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def create(self, input, dimensions=256, **kwargs):
+        self._owner.embedding_calls += 1
+        vector = [0.0] * dimensions
+        for word in re.findall(r"\w+", input.lower()):
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % dimensions] += 1.0
+        return SimpleNamespace(data=[SimpleNamespace(embedding=vector)])
+
+
+class FakeAsyncOpenAI:
+    """Подмена AsyncOpenAI с фиксированным ответом модели."""
+
+    def __init__(self, chunks=None, chunk_delay=0.01, completion_delay=0.2):
+        self.chunks = chunks or [f"слово{i} " for i in range(50)]
+        self.chunk_delay = chunk_delay
+        self.completion_delay = completion_delay
+        self.calls = 0
+        self.embedding_calls = 0
+        # Сообщения каждого потокового запроса
+        self.prompts = []
+        self.completion_calls = 0
+        self.active_completions = 0
+        self.max_active_completions = 0
+        self.chat = SimpleNamespace(completions=FakeCompletions(self))
+        self.embeddings = FakeEmbeddings(self)
+
+    def with_options(self, **kwargs):
+        return self
+
+
+class FakeBot:
+    """Подмена telegram.Bot, запоминающая отправленные правки."""
+
+    def __init__(self, edit_delay=0.0):
+        self.edit_delay = edit_delay
+        self.edits = []
+        self.sent = []
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        if self.edit_delay:
+            await asyncio.sleep(self.edit_delay)
+        self.edits.append((chat_id, message_id, text))
+        return True
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.edit_delay:
+            await asyncio.sleep(self.edit_delay)
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(chat_id=chat_id, message_id=len(self.sent), text=text)
+
+
+def make_client_pool(client):
+    """Создает пул клиентов OpenAI, всегда возвращающий поддельный клиент."""
+    from clients import OpenAIClientPool
+    return OpenAIClientPool('sk-test', client_factory=lambda base_url, api_key: client)
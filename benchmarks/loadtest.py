@@ -0,0 +1,408 @@
+"""
+Нагрузочный тест бота на локальных заглушках Telegram Bot API и OpenAI API.
+
+Бот запускается без изменений в текущем процессе и обращается к заглушкам
+через TELEGRAM_API_URL и OPENAI_API_BASE. Заглушки и генератор нагрузки
+работают в отдельном процессе, чтобы не искажать задержку event loop бота.
+
+Каждый синтетический пользователь в цикле выполняет одну из операций:
+текстовый запрос (handle_text), генерацию изображения (/image) или
+переход по меню настроек (callback'и), и ждет ответа бота перед
+следующей. Отчет содержит p50/p95/p99 задержек по типам операций,
+пропускную способность, задержку event loop и потребление памяти.
+
+Запуск:
+    python benchmarks/loadtest.py --users 2000 --duration 60 --no-telegram-limits
+    python benchmarks/loadtest.py --users 500 --mix text=1 --chunks 80 --output before.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import time
+from typing import Optional
+
+from fakes import prepare_environment
+from fake_servers import END_MARKER, FakeOpenAIAPI, FakeTelegramAPI, HTTPServer
+
+TOKEN = "123456:LOADTEST"
+FIRST_USER_ID = 200000000
+ERROR_PREFIXES = ("❌", "⏳", "⛔", "🛠", "Произошла ошибка", "Ошибка")
+SETTINGS_FLOW = ["text_settings", "change_temperature", "set_temp_0.7", "back_to_main", "image_settings"]
+LAG_INTERVAL = 0.05
+
+
+def percentile(values: list[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None
+    }
+
+
+class PendingOperation:
+    __slots__ = ("kind", "started", "first_response", "future")
+
+    def __init__(self, kind: str, future: asyncio.Future):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.first_response: Optional[float] = None
+        self.future = future
+
+
+class LoadGenerator:
+    """Синтетические пользователи, работающие с ботом через заглушку Telegram."""
+
+    def __init__(self, telegram: FakeTelegramAPI, options: dict):
+        self.telegram = telegram
+        self.options = options
+        self.pending: dict[int, PendingOperation] = {}
+        self.latencies: dict[str, list[float]] = {}
+        self.outcomes: dict[str, dict[str, int]] = {}
+        self._image_prompts = [f"пейзаж номер {i}" for i in range(options["image_prompts"])]
+
+        kinds, weights = [], []
+        for item in options["mix"].split(","):
+            kind, _, weight = item.partition("=")
+            kinds.append(kind.strip())
+            weights.append(float(weight or 1))
+        self._kinds, self._weights = kinds, weights
+
+    # Вызывается заглушкой Telegram на каждый исходящий запрос бота
+    def on_call(self, method: str, params: dict):
+        try:
+            chat_id = int(params.get("chat_id"))
+        except (TypeError, ValueError):
+            return
+        operation = self.pending.get(chat_id)
+        if operation is None or operation.future.done():
+            return
+
+        now = time.perf_counter()
+        if operation.first_response is None:
+            operation.first_response = now
+        text = params.get("text") or params.get("caption") or ""
+
+        if isinstance(text, str) and text.startswith(ERROR_PREFIXES):
+            operation.future.set_result("error")
+        elif operation.kind == "text":
+            if method == "editMessageText" and text.endswith(END_MARKER):
+                operation.future.set_result("ok")
+        elif operation.kind == "image":
+            if method == "sendPhoto":
+                operation.future.set_result("ok")
+        elif operation.kind == "settings":
+            if method in ("editMessageText", "editMessageReplyMarkup"):
+                operation.future.set_result("ok")
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _chat(self, user_id: int) -> dict:
+        return {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+
+    def _message_update(self, user_id: int, text: str) -> dict:
+        message = {
+            "message_id": self.telegram.next_message_id(user_id),
+            "date": int(time.time()),
+            "chat": self._chat(user_id),
+            "from": self._user(user_id),
+            "text": text
+        }
+        if text.startswith("/"):
+            command = text.split(" ", 1)[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"message": message}
+
+    def _callback_update(self, user_id: int, data: str) -> dict:
+        return {
+            "callback_query": {
+                "id": f"{user_id}-{time.monotonic_ns()}",
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": self._chat(user_id),
+                    "from": self.telegram.bot_user(),
+                    "text": "⚙️ Настройки"
+                }
+            }
+        }
+
+    async def _operation(self, user_id: int, kind: str, step: int):
+        if kind == "text":
+            update = self._message_update(user_id, f"Вопрос {step} от пользователя {user_id}")
+        elif kind == "image":
+            update = self._message_update(user_id, f"/image {random.choice(self._image_prompts)}")
+        else:
+            update = self._callback_update(user_id, SETTINGS_FLOW[step % len(SETTINGS_FLOW)])
+
+        operation = PendingOperation(kind, asyncio.get_running_loop().create_future())
+        self.pending[user_id] = operation
+        self.telegram.push_update(update)
+        try:
+            outcome = await asyncio.wait_for(operation.future, self.options["op_timeout"])
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        finally:
+            self.pending.pop(user_id, None)
+
+        outcomes = self.outcomes.setdefault(kind, {"ok": 0, "error": 0, "timeout": 0})
+        outcomes[outcome] += 1
+        if outcome == "ok":
+            finished = time.perf_counter()
+            self.latencies.setdefault(kind, []).append(finished - operation.started)
+            if kind == "text" and operation.first_response is not None:
+                self.latencies.setdefault("text_first_response", []).append(
+                    operation.first_response - operation.started
+                )
+
+    async def _run_user(self, user_id: int, deadline: float):
+        rng = random.Random(user_id)
+        await asyncio.sleep(rng.uniform(0, self.options["ramp"]))
+        step = 0
+        while time.perf_counter() < deadline:
+            kind = rng.choices(self._kinds, self._weights)[0]
+            await self._operation(user_id, kind, step)
+            step += 1
+            if self.options["think"]:
+                await asyncio.sleep(rng.expovariate(1 / self.options["think"]))
+
+    async def run(self) -> dict:
+        started = time.perf_counter()
+        deadline = started + self.options["duration"]
+        await asyncio.gather(*(
+            self._run_user(FIRST_USER_ID + i, deadline)
+            for i in range(self.options["users"])
+        ))
+        elapsed = time.perf_counter() - started
+        completed = sum(o["ok"] for o in self.outcomes.values())
+        return {
+            "elapsed": elapsed,
+            "completed": completed,
+            "throughput": completed / elapsed if elapsed else 0.0,
+            "latency": {kind: summarize(values) for kind, values in self.latencies.items()},
+            "outcomes": self.outcomes
+        }
+
+
+async def _serve(conn, options: dict):
+    openai_api = FakeOpenAIAPI(
+        chunks=options["chunks"],
+        first_token_latency=options["first_token_latency"],
+        chunk_latency=options["chunk_latency"],
+        image_latency=options["image_latency"]
+    )
+    telegram_api = FakeTelegramAPI(TOKEN)
+    generator = LoadGenerator(telegram_api, options)
+    telegram_api.on_call = generator.on_call
+
+    telegram_server = HTTPServer(telegram_api.handle)
+    openai_server = HTTPServer(openai_api.handle)
+    await telegram_server.start()
+    await openai_server.start()
+    conn.send({"telegram_url": telegram_server.url, "openai_url": f"{openai_server.url}/v1"})
+
+    # Ждем, пока бот запустит polling
+    await asyncio.to_thread(conn.recv)
+    results = await generator.run()
+    results["telegram_calls"] = telegram_api.calls
+    results["openai_calls"] = openai_api.calls
+    results["undelivered_updates"] = telegram_api.pending_updates
+    conn.send(results)
+
+    # Продолжаем отвечать, пока бот не остановится
+    await asyncio.to_thread(conn.recv)
+    await telegram_server.stop()
+    await openai_server.stop()
+
+
+def serve(conn, options: dict):
+    """Точка входа процесса с заглушками и генератором нагрузки."""
+    asyncio.run(_serve(conn, options))
+
+
+def rss_mb() -> Optional[float]:
+    """Текущий RSS процесса в МБ (только Linux)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+async def monitor_loop_lag(samples: list[float], stop: asyncio.Event):
+    """Измеряет, на сколько опаздывает пробуждение задачи в event loop."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+async def scrape_metrics(port: int) -> Optional[str]:
+    """Проверяет, что сервер метрик отвечает, и возвращает размер ответа."""
+    if not port:
+        return None
+    import httpx
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"http://127.0.0.1:{port}/metrics")
+        return f"{response.status_code}, {len(response.content)} байт, {response.text.count(chr(10))} строк"
+    except httpx.HTTPError as e:
+        return f"ошибка: {e}"
+
+
+async def run_bot(conn, endpoints: dict, options: dict) -> dict:
+    os.environ["TELEGRAM_API_URL"] = endpoints["telegram_url"]
+    os.environ["OPENAI_API_BASE"] = endpoints["openai_url"]
+    # Все синтетические пользователи имеют доступ к боту
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(options["users"])], f)
+
+    from loguru import logger
+    import bot as bot_module
+
+    if not options["log"]:
+        logger.remove()
+
+    rss_before = rss_mb()
+    gpt_bot = bot_module.GPTBot()
+    application = gpt_bot.application
+    application.bot_data['gpt_bot'] = gpt_bot
+    await application.initialize()
+    # post_init запускает сервер метрик и измерение задержки event loop
+    await application.post_init(application)
+    await application.updater.start_polling(timeout=1, poll_interval=0)
+    await application.start()
+
+    lag_samples: list[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples, stop))
+
+    conn.send("start")
+    results = await asyncio.to_thread(conn.recv)
+
+    stop.set()
+    await monitor
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    rss_after = rss_mb()
+
+    results["metrics_summary"] = bot_module.metrics.summary()
+    results["metrics_scrape"] = await scrape_metrics(gpt_bot.metrics_port)
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    conn.send("stop")
+
+    results["loop_lag"] = summarize(lag_samples)
+    results["memory"] = {"rss_before_mb": rss_before, "rss_after_mb": rss_after, "rss_peak_mb": rss_peak}
+    return results
+
+
+def format_ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}"
+
+
+def print_report(results: dict, options: dict):
+    print(f"Пользователей: {options['users']}, длительность: {results['elapsed']:.1f} с, "
+          f"смесь: {options['mix']}")
+    print()
+    print(f"{'операция':<22}{'ok':>7}{'ошибки':>8}{'таймаут':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}")
+    for kind, stats in sorted(results["latency"].items()):
+        outcomes = results["outcomes"].get(kind, {})
+        print(
+            f"{kind:<22}{stats['count']:>7}{outcomes.get('error', 0):>8}{outcomes.get('timeout', 0):>9}"
+            f"{format_ms(stats['p50']):>9}{format_ms(stats['p95']):>9}{format_ms(stats['p99']):>9}"
+        )
+    for kind, outcomes in sorted(results["outcomes"].items()):
+        if kind not in results["latency"]:
+            print(f"{kind:<22}{0:>7}{outcomes['error']:>8}{outcomes['timeout']:>9}")
+    print()
+    print(f"Пропускная способность: {results['throughput']:.1f} операций/с")
+    lag = results["loop_lag"]
+    print(f"Задержка event loop:    p50 {format_ms(lag['p50'])} мс, p99 {format_ms(lag['p99'])} мс, "
+          f"max {format_ms(lag['max'])} мс")
+    memory = results["memory"]
+    if memory["rss_before_mb"] is not None:
+        print(f"Память (RSS):           до {memory['rss_before_mb']:.0f} МБ, "
+              f"после {memory['rss_after_mb']:.0f} МБ, пик {memory['rss_peak_mb']:.0f} МБ")
+    print(f"Не доставлено апдейтов: {results['undelivered_updates']}")
+    print(f"Вызовы Telegram API:    {results['telegram_calls']}")
+    print(f"Вызовы OpenAI API:      {results['openai_calls']}")
+    if results.get("metrics_scrape"):
+        print(f"Ответ /metrics:         {results['metrics_scrape']}")
+    if results.get("metrics_summary"):
+        print()
+        print(results["metrics_summary"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help="количество синтетических пользователей")
+    parser.add_argument('--duration', type=float, default=30, help="длительность нагрузки, секунды")
+    parser.add_argument('--ramp', type=float, default=5, help="время, за которое подключаются все пользователи")
+    parser.add_argument('--think', type=float, default=2.0, help="средняя пауза пользователя между операциями")
+    parser.add_argument('--mix', default="text=0.8,image=0.1,settings=0.1", help="доли операций")
+    parser.add_argument('--op-timeout', type=float, default=120, help="таймаут одной операции")
+    parser.add_argument('--chunks', type=int, default=40, help="чанков в ответе модели")
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--chunk-latency', type=float, default=0.02)
+    parser.add_argument('--image-latency', type=float, default=2.0)
+    parser.add_argument('--image-prompts', type=int, default=50, help="различных промптов для /image")
+    parser.add_argument('--no-telegram-limits', action='store_true',
+                        help="снять общие лимиты исходящих запросов, оставив только лимиты на чат")
+    parser.add_argument('--log', action='store_true', help="не отключать логирование бота")
+    parser.add_argument('--metrics-port', type=int, default=19100, help="порт сервера метрик бота (0 - не проверять)")
+    parser.add_argument('--output', help="сохранить результаты в JSON для сравнения запусков")
+    args = parser.parse_args()
+    options = dict(vars(args))
+    # prepare_environment переходит во временный каталог
+    output = os.path.abspath(args.output) if args.output else None
+
+    os.environ['TELEGRAM_TOKEN'] = TOKEN
+    os.environ.setdefault('METRICS_PORT', str(args.metrics_port))
+    if args.no_telegram_limits:
+        os.environ.setdefault('GLOBAL_SEND_RATE', '100000')
+        os.environ.setdefault('GLOBAL_EDITS_PER_SECOND', '100000')
+        os.environ.setdefault('MAX_CONCURRENT_SENDS', '256')
+    prepare_environment()
+
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    servers = context.Process(target=serve, args=(child_conn, options), daemon=True)
+    servers.start()
+    endpoints = parent_conn.recv()
+
+    try:
+        results = asyncio.run(run_bot(parent_conn, endpoints, options))
+    finally:
+        servers.join(timeout=10)
+        if servers.is_alive():
+            servers.terminate()
+
+    print_report(results, options)
+    if output:
+        with open(output, "w") as f:
+            json.dump({"options": options, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
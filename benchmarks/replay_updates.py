@@ -0,0 +1,83 @@
+"""
+Отправка записанных апдейтов Telegram на webhook бота.
+
+Читает апдейты из JSONL-файла (по одному JSON-объекту на строку) или
+генерирует синтетические текстовые сообщения и отправляет их POST-запросами
+с секретным токеном, как это делает Telegram. Выводит распределение
+кодов ответа и скорость приема.
+
+Запуск:
+    python benchmarks/replay_updates.py --url http://localhost:8443/telegram --secret s3cr3t --file updates.jsonl
+    python benchmarks/replay_updates.py --url http://localhost:8443/telegram --synthetic 1000 --users 100
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import httpx
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_updates(count: int, users: int, first_user_id: int = 200000000) -> list[dict]:
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = first_user_id + update_id % users
+        updates.append({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+                "text": f"Сообщение {update_id}"
+            }
+        })
+    return updates
+
+
+async def replay(url: str, secret: str, updates: list[dict], concurrency: int) -> Counter:
+    statuses = Counter()
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(update):
+            async with semaphore:
+                try:
+                    response = await client.post(url, json=update, headers=headers)
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+
+        await asyncio.gather(*(post(update) for update in updates))
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', required=True, help="адрес webhook, включая путь")
+    parser.add_argument('--secret', default="", help="значение X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument('--file', help="JSONL-файл с записанными апдейтами")
+    parser.add_argument('--synthetic', type=int, default=100, help="сколько апдейтов сгенерировать без --file")
+    parser.add_argument('--users', type=int, default=10, help="пользователей в синтетических апдейтах")
+    parser.add_argument('--concurrency', type=int, default=40, help="одновременных запросов (как max_connections)")
+    args = parser.parse_args()
+
+    updates = load_updates(args.file) if args.file else synthetic_updates(args.synthetic, args.users)
+    started = time.perf_counter()
+    statuses = asyncio.run(replay(args.url, args.secret, updates, args.concurrency))
+    elapsed = time.perf_counter() - started
+
+    print(f"Отправлено апдейтов: {len(updates)} за {elapsed:.2f} с ({len(updates) / elapsed:.0f}/с)")
+    for status, count in sorted(statuses.items(), key=lambda item: str(item[0])):
+        print(f"  {status}: {count}")
+
+
+if __name__ == "__main__":
+    main()
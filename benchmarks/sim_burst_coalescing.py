@@ -0,0 +1,115 @@
+"""
+Симуляция серий сообщений: сколько запросов к модели делает handle_text.
+
+Каждый пользователь отправляет серию из нескольких сообщений с небольшим
+интервалом, пока модель еще отвечает на первое. Обработчики вызываются
+параллельно, как при concurrent_updates. Без сериализации каждое сообщение
+запускало отдельный поток генерации над общей историей; теперь сообщения,
+пришедшие во время генерации, объединяются в один следующий запрос, а
+серия, уложившаяся в окно CHAT_BURST_WINDOW, - в один запрос к модели.
+
+Запуск:
+    python benchmarks/sim_burst_coalescing.py --users 20 --burst 5 --gap 0.05
+    python benchmarks/sim_burst_coalescing.py --window 0
+"""
+import argparse
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from fakes import FakeAsyncOpenAI, FakeBot, make_client_pool, prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+from chat_queue import CHAT_BURST_WINDOW  # noqa: E402
+
+logger.remove()
+
+FIRST_USER_ID = 300000000
+
+
+def make_update(user_id, text, bot):
+    async def reply_text(reply, **kwargs):
+        return await bot.send_message(user_id, reply)
+
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, username=f"user{user_id}"),
+        effective_chat=SimpleNamespace(id=user_id, type="private"),
+        message=SimpleNamespace(text=text, reply_text=reply_text)
+    )
+
+
+async def user_burst(handle_text, context, user_id, burst, gap, bot):
+    tasks = []
+    for i in range(burst):
+        update = make_update(user_id, f"часть {i + 1} вопроса", bot)
+        tasks.append(asyncio.create_task(handle_text(update, context)))
+        await asyncio.sleep(gap)
+    await asyncio.gather(*tasks)
+
+
+def check_history(settings_manager, user_id, burst):
+    """Проверяет, что ответ модели всегда идет после вопросов, на которые он дан."""
+    history = settings_manager.get_user_settings(user_id).message_history
+    roles = [m["role"] for m in history]
+    user_messages = [m["content"] for m in history if m["role"] == "user"]
+    assert user_messages == [f"часть {i + 1} вопроса" for i in range(burst)], user_messages
+    assert roles[-1] == "assistant", roles
+    return roles
+
+
+async def main(users, burst, gap, window):
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(users)], f)
+
+    import bot as bot_module
+    import handlers
+    from chat_queue import ChatRequestQueue
+    from settings import settings_manager
+    logger.remove()
+
+    handlers.chat_queue = ChatRequestQueue(window=window)
+    client = FakeAsyncOpenAI(chunks=[f"токен{i} " for i in range(20)], chunk_delay=0.02)
+    fake_bot = FakeBot()
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.client_pool = make_client_pool(client)
+    gpt_bot.application = SimpleNamespace(bot=fake_bot)
+    context = SimpleNamespace(
+        application=SimpleNamespace(bot_data={'gpt_bot': gpt_bot}),
+        bot=fake_bot,
+        user_data={}
+    )
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        user_burst(handlers.handle_text, context, FIRST_USER_ID + i, burst, gap, fake_bot)
+        for i in range(users)
+    ))
+    elapsed = time.perf_counter() - started
+
+    roles = check_history(settings_manager, FIRST_USER_ID, burst)
+    for i in range(1, users):
+        check_history(settings_manager, FIRST_USER_ID + i, burst)
+
+    print(f"Пользователей: {users}, сообщений в серии: {burst}, интервал: {gap * 1000:.0f} мс, "
+          f"окно: {window * 1000:.0f} мс")
+    print(f"Сообщений отправлено:   {users * burst}")
+    print(f"Запросов к модели:      {client.calls} ({client.calls / users:.1f} на серию, "
+          f"без сериализации было бы {burst})")
+    print(f"Время:                  {elapsed:.2f} с")
+    print(f"История пользователя:   {' -> '.join(roles)}")
+    if window > gap * (burst - 1):
+        assert client.calls == users, f"серия в пределах окна дала {client.calls / users:.1f} запроса"
+        print("Каждая серия обработана одним запросом к модели")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--burst', type=int, default=5)
+    parser.add_argument('--gap', type=float, default=0.05, help="интервал между сообщениями серии, секунды")
+    parser.add_argument('--window', type=float, default=CHAT_BURST_WINDOW, help="CHAT_BURST_WINDOW, секунды")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.burst, args.gap, args.window))
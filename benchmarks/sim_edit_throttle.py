@@ -0,0 +1,105 @@
+"""
+Симуляция потоковых правок с эмуляцией ограничений Telegram.
+
+Несколько чатов одновременно получают быстрый поток чанков. Поддельный
+Telegram выбрасывает RetryAfter, если правки в чате идут чаще лимита.
+Скрипт проверяет, что число правок укладывается в бюджет планировщика,
+а финальный текст каждого сообщения совпадает с ответом модели.
+
+Запуск:
+    python benchmarks/sim_edit_throttle.py --chats 20 --chunks 400
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+
+from fakes import FakeAsyncOpenAI, FakeBot, make_client_pool, prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+from telegram.error import RetryAfter  # noqa: E402
+import bot as bot_module  # noqa: E402
+from edit_scheduler import EditScheduler  # noqa: E402
+
+logger.remove()
+
+
+class FloodControlBot(FakeBot):
+    """Поддельный Telegram, ограничивающий частоту правок в чате."""
+
+    def __init__(self, chat_interval, retry_after):
+        super().__init__()
+        self.chat_interval = chat_interval
+        self.retry_after = retry_after
+        self.last_edit = {}
+        self.flood_errors = 0
+        self.final_text = {}
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        now = time.monotonic()
+        if now - self.last_edit.get(chat_id, 0.0) < self.chat_interval:
+            self.flood_errors += 1
+            raise RetryAfter(self.retry_after)
+        self.last_edit[chat_id] = now
+        self.final_text[chat_id] = text
+        return await super().edit_message_text(text, chat_id=chat_id, message_id=message_id)
+
+
+async def main(chats, chunks, delay, interval, telegram_interval):
+    bot_module.edit_scheduler = EditScheduler(
+        min_interval=interval,
+        max_interval=interval * 8,
+        min_chars=20,
+        global_rate=chats / interval
+    )
+    telegram = FloodControlBot(chat_interval=telegram_interval, retry_after=telegram_interval)
+    openai_client = FakeAsyncOpenAI(
+        chunks=[f"часть{i} " for i in range(chunks)],
+        chunk_delay=delay
+    )
+    expected_text = "".join(openai_client.chunks)
+
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.client_pool = make_client_pool(openai_client)
+    gpt_bot.application = SimpleNamespace(bot=telegram)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        gpt_bot.stream_chat_completion(
+            messages=[{"role": "user", "content": "привет"}],
+            chat_id=chat_id,
+            message_id=1,
+            context=None
+        )
+        for chat_id in range(1, chats + 1)
+    ))
+    elapsed = time.perf_counter() - started
+
+    naive_edits = chats * (chunks // 5)
+    # Не больше одной правки за интервал плюс финальная правка
+    budget_per_chat = int(elapsed / interval) + 2
+    edits_per_chat = len(telegram.edits) / chats
+    exact = all(telegram.final_text.get(c) == expected_text for c in range(1, chats + 1))
+
+    print(f"Время:                     {elapsed:.2f} с")
+    print(f"Правок без планировщика:   {naive_edits}")
+    print(f"Правок с планировщиком:    {len(telegram.edits)} ({edits_per_chat:.1f} на чат)")
+    print(f"Бюджет на чат:             {budget_per_chat}")
+    print(f"Ошибок RetryAfter:         {telegram.flood_errors}")
+    print(f"Финальный текст совпадает: {exact}")
+
+    assert exact, "Финальный текст отличается от ответа модели"
+    assert edits_per_chat <= budget_per_chat, "Превышен бюджет правок"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--chunks', type=int, default=400)
+    parser.add_argument('--delay', type=float, default=0.002)
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--telegram-interval', type=float, default=0.15)
+    args = parser.parse_args()
+    asyncio.run(main(args.chats, args.chunks, args.delay, args.interval, args.telegram_interval))
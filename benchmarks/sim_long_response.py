@@ -0,0 +1,152 @@
+"""
+Симуляция длинного потокового ответа, который не помещается в одно сообщение.
+
+Модель пишет ответ в несколько раз длиннее лимита Telegram (4096 символов)
+с абзацами, списками и большими блоками кода. Поддельный Telegram
+отклоняет тексты длиннее лимита и некорректную разметку HTML. Скрипт
+проверяет, что ни одна правка или новое сообщение не превышают лимит,
+каждое сообщение содержит парные теги, правится только последнее
+сообщение, а сообщения по порядку содержат весь ответ. Для сравнения выводится длина правки, которую отправлял бы
+прежний код, правивший одно сообщение всем текстом ответа.
+
+Запуск:
+    python benchmarks/sim_long_response.py --chars 20000 --chats 5
+"""
+import argparse
+import asyncio
+import html
+import re
+from types import SimpleNamespace
+
+from fakes import FakeAsyncOpenAI, FakeBot, make_client_pool, prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+from telegram.error import BadRequest  # noqa: E402
+import bot as bot_module  # noqa: E402
+from bench_render import check_html  # noqa: E402
+from edit_scheduler import MESSAGE_MAX_CHARS, EditScheduler  # noqa: E402
+from formatting import HTML, MARKDOWN_V2, StreamRenderer  # noqa: E402
+
+logger.remove()
+
+PARAGRAPHS = [
+    "## Шаг {n}\n\n",
+    "Разберем, как **ускорить** обработку: используйте `asyncio.gather` и *не блокируйте* event loop. "
+    "Подробности есть в [документации](https://docs.python.org/3/library/asyncio.html).\n\n",
+    "* первый пункт: значения `snake_case_name` и 2*3 остаются как есть\n"
+    "* второй пункт со спецсимволами <теги> & кавычки \"\"\n\n",
+    "```python\n" + "".join(
+        f"async def handler_{i}(update, context):\n"
+        f"    results = await asyncio.gather(*tasks)  # шаг {i}\n"
+        f"    return [r for r in results if r < {i} and r > 0]\n\n"
+        for i in range(12)
+    ) + "```\n\n",
+]
+
+
+class LimitedBot(FakeBot):
+    """Поддельный Telegram, проверяющий длину и разметку каждого текста."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = {}
+        self.payloads = []
+
+    def _check(self, text, kwargs):
+        self.payloads.append(len(text))
+        if len(text) > MESSAGE_MAX_CHARS:
+            raise BadRequest("Message is too long")
+        if kwargs.get("parse_mode") == HTML:
+            check_html(text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self._check(text, kwargs)
+        self.messages[chat_id, message_id] = text
+        return await super().edit_message_text(text, chat_id=chat_id, message_id=message_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._check(text, kwargs)
+        message = await super().send_message(chat_id, text)
+        self.messages[chat_id, message.message_id] = text
+        return message
+
+
+def make_answer(chars: int) -> str:
+    parts = []
+    while sum(map(len, parts)) < chars:
+        parts.append(PARAGRAPHS[len(parts) % len(PARAGRAPHS)].format(n=len(parts) // len(PARAGRAPHS) + 1))
+    return "".join(parts)
+
+
+def visible(text: str, parse_mode) -> str:
+    """Видимый текст без тегов и пробельных символов."""
+    if parse_mode == HTML:
+        text = html.unescape(re.sub(r"<[^>]+>", "", text))
+    elif parse_mode == MARKDOWN_V2:
+        text = re.sub(r"```[\w+#.-]*", "", text)
+    return re.sub(r"\s+", "", text)
+
+
+async def run(parse_mode, chars: int, chats: int, chunk: int):
+    bot_module.edit_scheduler = EditScheduler(
+        min_interval=0.01,
+        max_interval=0.1,
+        min_chars=chunk * 4,
+        global_rate=1000,
+        parse_mode=parse_mode
+    )
+    answer = make_answer(chars)
+    telegram = LimitedBot()
+    openai_client = FakeAsyncOpenAI(
+        chunks=[answer[i:i + chunk] for i in range(0, len(answer), chunk)],
+        chunk_delay=0.0005
+    )
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.client_pool = make_client_pool(openai_client)
+    gpt_bot.application = SimpleNamespace(bot=telegram)
+
+    await asyncio.gather(*(
+        gpt_bot.stream_chat_completion(
+            messages=[{"role": "user", "content": f"длинный ответ {chat_id}"}],
+            chat_id=chat_id,
+            message_id=0,
+            context=None
+        )
+        for chat_id in range(1, chats + 1)
+    ))
+
+    expected = visible(StreamRenderer(parse_mode).render(answer, True) if parse_mode else answer, parse_mode)
+    pages = []
+    for chat_id in range(1, chats + 1):
+        ids = sorted(message_id for chat, message_id in telegram.messages if chat == chat_id)
+        texts = [telegram.messages[chat_id, message_id] for message_id in ids]
+        assert "".join(visible(text, parse_mode) for text in texts) == expected, \
+            f"сообщения чата {chat_id} не совпадают с ответом"
+        edited = [message_id for chat, message_id, _ in telegram.edits if chat == chat_id]
+        assert edited == sorted(edited), f"в чате {chat_id} правились прежние сообщения"
+        pages.append(len(texts))
+
+    legacy = len(StreamRenderer(parse_mode).render(answer, True)) if parse_mode else len(answer)
+    print(f"{parse_mode or 'без разметки':<14}{len(answer):>8}{sum(pages) / chats:>12.1f}"
+          f"{len(telegram.edits) / chats:>10.1f}{max(telegram.payloads):>14}{legacy:>16}")
+    assert max(telegram.payloads) <= MESSAGE_MAX_CHARS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chars', type=int, default=20000)
+    parser.add_argument('--chats', type=int, default=5)
+    parser.add_argument('--chunk', type=int, default=7, help="символов в одном фрагменте ответа")
+    args = parser.parse_args()
+
+    print(f"{'разметка':<14}{'символов':>8}{'сообщений':>12}{'правок':>10}{'макс. текст':>14}"
+          f"{'одно сообщение':>16}")
+    for parse_mode in (None, HTML, MARKDOWN_V2):
+        asyncio.run(run(parse_mode, args.chars, args.chats, args.chunk))
+    print("Все тексты не длиннее лимита, сообщения содержат весь ответ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Симуляция кэша ответов на повторяющиеся вопросы.
+
+Пользователи задают вопросы без предыстории (после /clear). Вопросы
+выбираются из небольшого набора тем с распределением Ципфа и пишутся
+по-разному: с другим регистром, пунктуацией или лишними словами.
+Сравнивается количество ответов модели без кэша, с точным
+совпадением и с поиском похожих вопросов по эмбеддингам. Похожий вопрос
+ищется параллельно с запросом к модели, поэтому при попадании по
+эмбеддингу запрос к модели начинается и отменяется до первого токена.
+
+Запуск:
+    python benchmarks/sim_response_cache.py --questions 500
+    python benchmarks/sim_response_cache.py --similarity 0.8
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from types import SimpleNamespace
+
+from fakes import FakeAsyncOpenAI, FakeBot, make_client_pool, prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+
+FIRST_USER_ID = 500000000
+TOPICS = [
+    "что такое python", "как сварить борщ", "сколько планет в солнечной системе",
+    "как работает блокчейн", "переведи hello на французский", "что такое черная дыра",
+    "как выучить английский", "почему небо голубое", "что посмотреть вечером",
+    "как написать резюме", "что такое рекурсия", "как ухаживать за кактусом",
+    "сколько весит кит", "кто написал войну и мир", "как работает интернет",
+    "что такое инфляция", "как бросить курить", "что такое нейросеть",
+    "какая столица австралии", "как испечь хлеб"
+]
+
+
+def phrase(topic: str, rng: random.Random) -> str:
+    """Формулирует вопрос одним из способов."""
+    variant = rng.random()
+    if variant < 0.4:
+        return topic.capitalize() + "?"
+    if variant < 0.6:
+        return topic + "  ?!"
+    if variant < 0.75:
+        return topic.upper()
+    if variant < 0.9:
+        return "Подскажи, " + topic + "?"
+    return "Расскажи пожалуйста " + topic
+
+
+def make_update(user_id, text, bot):
+    async def reply_text(reply, **kwargs):
+        return await bot.send_message(user_id, reply)
+
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, username=f"user{user_id}"),
+        effective_chat=SimpleNamespace(id=user_id, type="private"),
+        message=SimpleNamespace(text=text, reply_text=reply_text)
+    )
+
+
+async def run(mode: str, questions: int, users: int, similarity: float, seed: int):
+    import handlers
+    from chat_queue import ChatRequestQueue
+    import bot as bot_module
+    from edit_scheduler import EditScheduler
+    from response_cache import ResponseCache
+    from settings import settings_manager
+    logger.remove()
+
+    streams = []
+
+    class CountingCache(ResponseCache):
+        def stream(self, *args, **kwargs):
+            streams.append(super().stream(*args, **kwargs))
+            return streams[-1]
+
+    cache = CountingCache(enabled=mode != "off", similarity=similarity if mode == "semantic" else 0)
+    bot_module.response_cache = cache
+    # Лимиты правок Telegram здесь не проверяются и только замедляют прогон
+    bot_module.edit_scheduler = EditScheduler(min_interval=0, global_rate=100000)
+    # Сообщения пользователя приходят по одному: окно объединения серий
+    # (CHAT_BURST_WINDOW) только добавило бы паузу перед каждым ответом
+    handlers.chat_queue = ChatRequestQueue(window=0)
+    client = FakeAsyncOpenAI(chunks=[f"ответ{i} " for i in range(30)], chunk_delay=0.005)
+    fake_bot = FakeBot()
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.client_pool = make_client_pool(client)
+    gpt_bot.application = SimpleNamespace(bot=fake_bot)
+    context = SimpleNamespace(
+        application=SimpleNamespace(bot_data={'gpt_bot': gpt_bot}),
+        bot=fake_bot,
+        user_data={}
+    )
+
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(TOPICS))]
+    started = time.perf_counter()
+    for i in range(questions):
+        user_id = FIRST_USER_ID + i % users
+        settings_manager.clear_message_history(user_id)
+        topic = rng.choices(TOPICS, weights)[0]
+        await handlers.handle_text(make_update(user_id, phrase(topic, rng), fake_bot), context)
+        history = settings_manager.get_user_settings(user_id).message_history
+        assert history[-1]["role"] == "assistant", "ответ не попал в историю"
+    elapsed = time.perf_counter() - started
+    hits = sum(stream.cached is not None for stream in streams)
+    return questions - hits, client.calls, client.embedding_calls, len(cache), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--questions', type=int, default=300)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--similarity', type=float, default=0.8, help="порог близости для семантического поиска")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(args.users)], f)
+
+    print(f"Вопросов: {args.questions}, тем: {len(TOPICS)}, порог близости: {args.similarity}")
+    print(f"{'режим':<10}{'ответов модели':>15}{'отменено':>10}{'эмбеддингов':>13}{'попаданий':>11}"
+          f"{'в кэше':>8}{'время, с':>10}")
+    for mode in ("off", "exact", "semantic"):
+        answers, calls, embeddings, size, elapsed = asyncio.run(
+            run(mode, args.questions, args.users, args.similarity, args.seed)
+        )
+        hit_rate = 1 - answers / args.questions
+        print(f"{mode:<10}{answers:>15}{calls - answers:>10}{embeddings:>13}{hit_rate:>11.0%}"
+              f"{size:>8}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
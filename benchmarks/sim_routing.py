@@ -0,0 +1,135 @@
+"""
+Симуляция выбора маршрута к модели при сбоях и медленных ответах.
+
+Бот обращается к локальной заглушке OpenAI API через настоящий
+OpenAIClientPool. Для основной модели включается один из сценариев:
+полный отказ (все запросы завершаются ошибкой 500), редкие очень медленные
+ответы (хвост задержки первого токена) или частые ошибки. Сравниваются
+запросы без маршрутизации (повторы клиента OpenAI по тому же маршруту) и
+с ней: автоматический выключатель, переключение на запасную модель и
+параллельный запрос при задержке первого токена.
+
+Запуск:
+    python benchmarks/sim_routing.py --requests 300 --concurrency 20
+    python benchmarks/sim_routing.py --scenario slow --hedge-delay 0.5
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+
+from fakes import prepare_environment
+from fake_servers import END_MARKER, FakeOpenAIAPI, HTTPServer
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+
+PRIMARY = "gpt-4o"
+FALLBACK = "gpt-4o-mini"
+SCENARIOS = {
+    # Основная модель недоступна
+    "outage": {PRIMARY: {"error_rate": 1.0}},
+    # Каждый десятый ответ основной модели начинается через 3 секунды
+    "slow": {PRIMARY: {"slow_rate": 0.1, "slow_latency": 3.0}},
+    # Треть запросов к основной модели завершается ошибкой
+    "flaky": {PRIMARY: {"error_rate": 0.3}},
+}
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+async def run(scenario: str, routing: bool, requests: int, concurrency: int, hedge_delay: float):
+    import bot as bot_module
+    import routing as routing_module
+    from clients import OpenAIClientPool
+    from settings import TextModelSettings
+    logger.remove()
+
+    api = FakeOpenAIAPI(chunks=20, first_token_latency=0.2, chunk_latency=0.005, models=SCENARIOS[scenario])
+    server = HTTPServer(api.handle)
+    await server.start()
+    if routing:
+        router = routing_module.ModelRouter(fallbacks=FALLBACK, hedge_delay=hedge_delay, breaker_cooldown=2)
+    else:
+        # Без запасных маршрутов остается один запрос с повторами клиента
+        router = routing_module.ModelRouter(fallbacks="", hedge_delay=0)
+    bot_module.router = router
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.client_pool = OpenAIClientPool(api_key="sk-test", default_base_url=server.url)
+    text_settings = TextModelSettings(model=PRIMARY)
+    messages = [{"role": "user", "content": "Привет"}]
+
+    ttft, durations, errors, fallbacks = [], [], 0, 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request():
+        nonlocal errors, fallbacks
+        async with semaphore:
+            started = time.perf_counter()
+            first = None
+            text = ""
+            pieces = gpt_bot.open_routed_stream(messages, text_settings)
+            try:
+                async for piece in pieces:
+                    if first is None:
+                        first = time.perf_counter() - started
+                    text += piece
+            except Exception:
+                errors += 1
+                return
+            finally:
+                await pieces.aclose()
+            assert text.endswith(END_MARKER)
+            ttft.append(first)
+            durations.append(time.perf_counter() - started)
+            fallbacks += pieces.fallback
+
+    started = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    await gpt_bot.client_pool.close()
+    await server.stop()
+    return {
+        "ok": len(ttft) / requests,
+        "fallbacks": fallbacks,
+        "ttft_p50": percentile(ttft, 50),
+        "ttft_p95": percentile(ttft, 95),
+        "ttft_p99": percentile(ttft, 99),
+        "duration_p95": percentile(durations, 95),
+        "calls": dict(api.model_calls),
+        "elapsed": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--hedge-delay', type=float, default=0.6,
+                        help="задержка параллельного запроса при маршрутизации, секунды")
+    args = parser.parse_args()
+
+    print(f"Запросов: {args.requests}, одновременно: {args.concurrency}, "
+          f"основная модель: {PRIMARY}, запасная: {FALLBACK}")
+    print(f"{'сценарий':<9}{'режим':<14}{'успешно':>8}{'запасной':>9}{'TTFT p50':>10}{'p95':>7}{'p99':>7}"
+          f"{'ответ p95':>11}{'время, с':>10}  запросы к моделям")
+    for scenario in args.scenario:
+        for routing in (False, True):
+            result = asyncio.run(run(scenario, routing, args.requests, args.concurrency, args.hedge_delay))
+            calls = ", ".join(f"{model}: {count}" for model, count in sorted(result["calls"].items()))
+            print(f"{scenario:<9}{'маршрутизация' if routing else 'повторы':<14}{result['ok']:>8.0%}"
+                  f"{result['fallbacks']:>9}{result['ttft_p50']:>10.2f}{result['ttft_p95']:>7.2f}"
+                  f"{result['ttft_p99']:>7.2f}{result['duration_p95']:>11.2f}{result['elapsed']:>10.1f}  {calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Симуляция нескольких реплик бота с общим хранилищем состояния.
+
+Каждая реплика - отдельный SettingsManager (для sqlite и redis - отдельный
+процесс), все они одновременно добавляют сообщения в историю одних и тех же
+пользователей. Проверяется, что после записи в хранилище нет потерянных
+сообщений и что сообщения каждой реплики идут в исходном порядке.
+
+Запуск:
+    python benchmarks/sim_shared_state.py --backend memory --replicas 4
+    python benchmarks/sim_shared_state.py --backend sqlite --replicas 4 --users 20 --messages 50
+    REDIS_URL=redis://localhost:6379/15 python benchmarks/sim_shared_state.py --backend redis
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+
+from fakes import prepare_environment
+
+FIRST_USER_ID = 400000000
+
+
+async def run_replica(manager, replica, users, messages, seed):
+    """Добавляет сообщения от имени реплики, как это делают обработчики."""
+    rng = random.Random(seed)
+    for i in range(messages):
+        for user_id in users:
+            await manager.sync_user(user_id)
+            manager.append_message(user_id, {"role": "user", "content": f"{replica}:{i}"})
+        await asyncio.sleep(rng.uniform(0, 0.01))
+    await manager.drain()
+    # При сильной конкуренции одной серии попыток записи может не хватить
+    while manager.has_pending_changes:
+        manager.flush()
+    return manager.conflicts
+
+
+def replica_process(backend_kind, db_file, replica, users, messages, flush_delay, results):
+    """Точка входа процесса-реплики."""
+    prepare_environment()
+    os.environ['STATE_BACKEND'] = backend_kind
+    os.environ['STATE_DB_FILE'] = db_file
+    os.environ['STATE_SHARED'] = 'true'
+    from loguru import logger
+    logger.remove()
+    from settings import SettingsManager
+    from state import state_backend
+
+    manager = SettingsManager(storage=state_backend, flush_delay=flush_delay)
+    conflicts = asyncio.run(run_replica(manager, replica, users, messages, replica))
+    results.put((replica, conflicts))
+
+
+def verify(backend, users, replicas, messages):
+    lost = 0
+    for user_id in users:
+        data = backend.load_user(user_id)
+        history = [m["content"] for m in (data or {}).get("message_history", [])]
+        lost += replicas * messages - len(history)
+        for replica in range(replicas):
+            own = [int(c.split(":")[1]) for c in history if c.startswith(f"{replica}:")]
+            if len(own) == messages:
+                assert own == list(range(messages)), f"порядок сообщений реплики {replica} нарушен"
+    return lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backend', choices=['memory', 'sqlite', 'redis'], default='memory')
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=30, help="сообщений от каждой реплики каждому пользователю")
+    parser.add_argument('--flush-delay', type=float, default=0.02)
+    args = parser.parse_args()
+
+    workdir = prepare_environment()
+    from loguru import logger
+    logger.remove()
+    from storage import MemoryStorage, RedisStorage, SQLiteStorage
+
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    db_file = os.path.join(workdir, 'shared_state.db')
+    started = time.perf_counter()
+
+    if args.backend == 'memory':
+        from settings import SettingsManager
+        backend = MemoryStorage()
+
+        async def run_all():
+            managers = [SettingsManager(storage=backend, flush_delay=args.flush_delay) for _ in range(args.replicas)]
+            return await asyncio.gather(*(
+                run_replica(manager, replica, users, args.messages, replica)
+                for replica, manager in enumerate(managers)
+            ))
+        conflicts = sum(asyncio.run(run_all()))
+    else:
+        if args.backend == 'redis':
+            backend = RedisStorage(os.getenv('REDIS_URL', 'redis://localhost:6379/15'), prefix='gptbot-sim:')
+            backend._client.flushdb()
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [
+            context.Process(target=replica_process, args=(
+                args.backend, db_file, replica, users, args.messages, args.flush_delay, results
+            ))
+            for replica in range(args.replicas)
+        ]
+        for process in processes:
+            process.start()
+        conflicts = sum(results.get()[1] for _ in processes)
+        for process in processes:
+            process.join()
+        if args.backend == 'sqlite':
+            backend = SQLiteStorage(db_file, shared=True)
+
+    elapsed = time.perf_counter() - started
+    lost = verify(backend, users, args.replicas, args.messages)
+    total = args.replicas * args.users * args.messages
+    print(f"Хранилище: {args.backend}, реплик: {args.replicas}, пользователей: {args.users}")
+    print(f"Добавлено сообщений:       {total} за {elapsed:.2f} с")
+    print(f"Конфликтов версий:         {conflicts} (разрешены повторной записью)")
+    print(f"Потеряно сообщений:        {lost}")
+    assert lost == 0
+
+
+if __name__ == "__main__":
+    main()
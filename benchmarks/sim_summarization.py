@@ -0,0 +1,160 @@
+"""
+Симуляция длинных диалогов с кратким содержанием истории.
+
+Пользователи ведут длинный диалог; в начале каждый сообщает несколько
+фактов о себе, которые модель должна помнить. Сравнивается размер запроса
+к модели и сохранность фактов в контексте без краткого содержания (старые
+сообщения отбрасываются по бюджету токенов) и с ним. Поддельная модель
+краткого содержания сохраняет строки с фактами и отвечает с задержкой,
+поэтому видно, что сжатие не задерживает ответы и для одного пользователя
+выполняется не больше одного сжатия одновременно.
+
+Запуск:
+    python benchmarks/sim_summarization.py --turns 120 --users 5
+    python benchmarks/sim_summarization.py --model gpt-4o --threshold 20
+"""
+import argparse
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from fakes import FakeAsyncOpenAI, FakeBot, make_client_pool, prepare_environment
+
+prepare_environment()
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+
+FIRST_USER_ID = 600000000
+FACTS = ["меня зовут Анна", "я живу в Казани", "у меня аллергия на орехи", "я пишу на Go"]
+
+
+def make_update(user_id, text, bot):
+    async def reply_text(reply, **kwargs):
+        return await bot.send_message(user_id, reply)
+
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, username=f"user{user_id}"),
+        effective_chat=SimpleNamespace(id=user_id, type="private"),
+        message=SimpleNamespace(text=text, reply_text=reply_text)
+    )
+
+
+async def run(enabled: bool, users: int, turns: int, model: str, threshold: int, keep: int):
+    import handlers
+    from chat_queue import ChatRequestQueue
+    import bot as bot_module
+    import summarizer as summarizer_module
+    from context_window import context_builder
+    from edit_scheduler import EditScheduler
+    from settings import settings_manager
+    logger.remove()
+
+    summarizer = summarizer_module.ConversationSummarizer(enabled=enabled, threshold=threshold, keep=keep)
+    bot_module.summarizer = summarizer_module.summarizer = summarizer
+    # Считаем одновременные сжатия истории каждого пользователя
+    active, max_active = {}, [0]
+    summarize = summarizer._summarize
+
+    async def tracked_summarize(user_id, *args):
+        active[user_id] = active.get(user_id, 0) + 1
+        max_active[0] = max(max_active[0], active[user_id])
+        try:
+            await summarize(user_id, *args)
+        finally:
+            active[user_id] -= 1
+    summarizer._summarize = tracked_summarize
+    bot_module.edit_scheduler = EditScheduler(min_interval=0, global_rate=100000)
+    # Сообщения пользователя приходят по одному: окно объединения серий
+    # (CHAT_BURST_WINDOW) только добавило бы паузу перед каждым ответом
+    handlers.chat_queue = ChatRequestQueue(window=0)
+    # Ответ модели - несколько сотен токенов, как у развернутого ответа
+    client = FakeAsyncOpenAI(chunks=[f"подробный{i} ответ{i} " for i in range(60)], chunk_delay=0.002, completion_delay=0.1)
+    fake_bot = FakeBot()
+    gpt_bot = bot_module.GPTBot.__new__(bot_module.GPTBot)
+    gpt_bot.client_pool = make_client_pool(client)
+    gpt_bot.application = SimpleNamespace(bot=fake_bot)
+    context = SimpleNamespace(
+        application=SimpleNamespace(bot_data={'gpt_bot': gpt_bot}),
+        bot=fake_bot,
+        user_data={}
+    )
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    for user_id in user_ids:
+        settings_manager.clear_message_history(user_id)
+        settings_manager.update_text_settings(user_id, model=model)
+
+    async def converse(user_id):
+        for turn in range(turns):
+            if turn < len(FACTS):
+                text = f"Запомни факт: {FACTS[turn]}"
+            else:
+                text = f"Вопрос номер {turn}: расскажи подробнее про пункт {turn % 7}"
+            await handlers.handle_text(make_update(user_id, text, fake_bot), context)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - started
+    await summarizer.close()
+
+    # Размер запроса к модели и факты в последнем запросе пользователя
+    tokens = [
+        sum(context_builder.message_tokens(m, model) for m in prompt)
+        for prompt in client.prompts
+    ]
+    tail = tokens[-users * 20:]
+    last_prompts = client.prompts[-users:]
+    kept = sum(
+        sum(fact in "\n".join(m["content"] for m in prompt) for fact in FACTS)
+        for prompt in last_prompts
+    ) / (len(FACTS) * users)
+    summaries = sum(
+        1 for user_id in user_ids
+        for m in settings_manager.get_user_settings(user_id).message_history
+        if m["role"] == summarizer_module.SUMMARY_ROLE
+    )
+    assert all(json.loads(m["content"])["keep"] >= 0 for user_id in user_ids
+               for m in settings_manager.get_user_settings(user_id).message_history
+               if m["role"] == summarizer_module.SUMMARY_ROLE)
+    return {
+        # Среднее по последним 20 запросам каждого пользователя
+        "avg_tokens": sum(tail) / len(tail),
+        "max_tokens": max(tokens),
+        "facts": kept,
+        "summary_calls": client.completion_calls,
+        "summaries": summaries,
+        "max_active": max_active[0],
+        "elapsed": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--turns', type=int, default=120)
+    parser.add_argument('--model', nargs='+', default=['gpt-4', 'gpt-4o'],
+                        help="модели пользователя (gpt-4 - окно 8k токенов, gpt-4o - 128k)")
+    parser.add_argument('--threshold', type=int, default=40)
+    parser.add_argument('--keep', type=int, default=10)
+    args = parser.parse_args()
+
+    with open("allowed_users.json", "w") as f:
+        json.dump([str(FIRST_USER_ID + i) for i in range(args.users)], f)
+
+    print(f"Пользователей: {args.users}, ходов: {args.turns}, "
+          f"порог: {args.threshold}, без сжатия: {args.keep}")
+    print(f"{'модель':<8}{'режим':<12}{'токенов в запросе':>18}{'максимум':>10}{'фактов':>8}"
+          f"{'сжатий':>8}{'одновременно':>14}{'время, с':>10}")
+    for model in args.model:
+        for enabled in (False, True):
+            result = asyncio.run(run(enabled, args.users, args.turns, model, args.threshold, args.keep))
+            print(f"{model:<8}{'сжатие' if enabled else 'обрезка':<12}{result['avg_tokens']:>18.0f}"
+                  f"{result['max_tokens']:>10}{result['facts']:>8.0%}{result['summaries']:>8}"
+                  f"{result['max_active']:>14}{result['elapsed']:>10.2f}")
+            assert result['max_active'] <= 1, "несколько сжатий истории одного пользователя одновременно"
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,6 @@ from telegram.ext import (
     ContextTypes
 )
 from telegram.error import RetryAfter, TimedOut, NetworkError, Conflict, BadRequest
-from openai import OpenAI
 import os
 from loguru import logger
 from dotenv import load_dotenv
@@ -24,10 +23,9 @@ from handlers import (
     handle_image_model_settings,
     show_current_settings_command,
     handle_image_command,
-    handle_custom_model_input,
-    handle_base_url_input,
-    handle_image_base_url_input,
     handle_settings_import,
+    route_text_message,
+    cancel_command,
     myid_command,
     stats_command,
     broadcast_command,
@@ -38,9 +36,28 @@ from handlers import (
     maintenance_command,
     check_maintenance_mode
 )
-from settings import SettingsManager
+from settings import settings_manager
+from context_window import MODEL_CONTEXT_LIMITS, context_builder
+from edit_scheduler import edit_scheduler
+from outbox import OutboundRateLimiter
+from clients import OpenAIClientPool, DEFAULT_BASE_URL
+from webhook import UPDATE_QUEUE_SIZE, run_webhook
+from chat_queue import chat_queue
+from images import image_pipeline
+from response_cache import (
+    RESPONSE_CACHE_EMBEDDING_DIMENSIONS,
+    RESPONSE_CACHE_EMBEDDING_MODEL,
+    response_cache
+)
+from summarizer import SUMMARY_MAX_TOKENS, SUMMARY_MODEL, summarizer
+from routing import Route, RoutedStream, router
+from log_config import setup_logging, with_request_id
+import metrics
 import asyncio
-import sys
+import base64
+import time
+from contextlib import aclosing
+from typing import Optional
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -48,36 +65,13 @@ load_dotenv()
 # Включение/выключение режима отладки
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
-# Настройка логирования
-logger.remove()  # Удаляем стандартный обработчик
-LOG_FORMAT = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
-
-if DEBUG:
-    logger.add(
-        "logs/debug.log",
-        format=LOG_FORMAT,
-        level="DEBUG",
-        rotation="500 MB",
-        compression="zip",
-        retention="10 days"
-    )
-    logger.add(sys.stderr, format=LOG_FORMAT, level="DEBUG")
-else:
-    logger.add(
-        "logs/production.log",
-        format=LOG_FORMAT,
-        level="INFO",
-        rotation="500 MB",
-        compression="zip",
-        retention="30 days"
-    )
-    logger.add(sys.stderr, format=LOG_FORMAT, level="INFO")
-
-# Создаем директорию для логов, если её нет
-os.makedirs("logs", exist_ok=True)
+# Способ получения апдейтов: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Сколько апдейтов обрабатывать одновременно (1 - строго по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '256'))
 
-# Инициализация менеджера настроек
-settings_manager = SettingsManager()
+# Настройка логирования
+setup_logging(DEBUG)
 
 class GPTBot:
     def __init__(self):
@@ -91,16 +85,47 @@ class GPTBot:
         if not openai_api_key:
             raise ValueError("Не указан API ключ OpenAI")
         
-        self.openai_client = OpenAI(
+        # Пул асинхронных клиентов: по одному на каждый base_url из настроек
+        # пользователей. Асинхронные клиенты не блокируют event loop во время
+        # генерации, поэтому несколько чатов получают ответы одновременно
+        self.client_pool = OpenAIClientPool(
             api_key=openai_api_key,
-            base_url=os.getenv('OPENAI_API_BASE', "https://api.openai.com/v1")
+            default_base_url=os.getenv('OPENAI_API_BASE', DEFAULT_BASE_URL)
         )
 
         # Создаем приложение
-        self.application = Application.builder().token(self.token).build()
+        # Все исходящие запросы к Telegram проходят через общий ограничитель
+        # Ограниченная очередь апдейтов: при перегрузке новые апдейты
+        # ждут в Telegram, а не накапливаются в памяти
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .rate_limiter(OutboundRateLimiter())
+            .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+            # Апдейты разных пользователей обрабатываются параллельно,
+            # запросы одного пользователя упорядочивает chat_queue
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .post_init(self._on_startup)
+            .post_shutdown(self._on_shutdown)
+        )
+        if BOT_MODE == 'webhook':
+            # Апдейты принимает HTTP-сервер webhook, Updater не нужен
+            builder = builder.updater(None)
+        # Адрес Bot API можно переопределить: локальный Bot API сервер
+        # или тестовый стенд (см. benchmarks/loadtest.py)
+        telegram_api_url = os.getenv('TELEGRAM_API_URL')
+        if telegram_api_url:
+            telegram_api_url = telegram_api_url.rstrip('/')
+            builder = (
+                builder
+                .base_url(f"{telegram_api_url}/bot")
+                .base_file_url(f"{telegram_api_url}/file/bot")
+            )
+        self.application = builder.build()
         
         # Регистрируем обработчики
         self._setup_handlers()
+        self._setup_metrics()
         
         # Регистрируем обработчик ошибок
         self.application.add_error_handler(self._error_handler)
@@ -116,6 +141,7 @@ class GPTBot:
         self.application.add_handler(CommandHandler(['image', 'img'], handle_image_command))
         self.application.add_handler(CommandHandler('myid', myid_command))
         self.application.add_handler(CommandHandler('gpt', handle_text))
+        self.application.add_handler(CommandHandler('cancel', cancel_command))
 
         # Добавляем административные команды
         self.application.add_handler(CommandHandler('stats', stats_command))
@@ -132,34 +158,13 @@ class GPTBot:
         self.application.add_handler(CommandHandler('restart', restart_command))
         self.application.add_handler(CommandHandler('maintenance', maintenance_command))
 
-        # Добавляем обработчики сообщений
-        self.application.add_handler(
-            MessageHandler(
-                filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-                handle_custom_model_input
-            ),
-            group=0
-        )
-        self.application.add_handler(
-            MessageHandler(
-                filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-                handle_base_url_input
-            ),
-            group=1
-        )
-        self.application.add_handler(
-            MessageHandler(
-                filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-                handle_image_base_url_input
-            ),
-            group=2
-        )
+        # Добавляем обработчики сообщений. Текст обрабатывает один обработчик:
+        # ввод из меню настроек или запрос к модели (см. route_text_message)
         self.application.add_handler(
             MessageHandler(
                 filters.TEXT & ~filters.COMMAND,
-                handle_text
-            ),
-            group=3
+                route_text_message
+            )
         )
         self.application.add_handler(MessageHandler(filters.PHOTO, handle_image))
         
@@ -186,6 +191,46 @@ class GPTBot:
             pattern='^(change_image_model|set_image_model_.*|change_size|set_size_.*|change_quality|set_quality_.*|change_style|set_style_.*|toggle_hdr|change_image_base_url)$'
         ))
 
+    def _setup_metrics(self):
+        """Подключает сбор метрик обработчиков и глубины очередей."""
+        # Порт сервера метрик; процессы-обработчики webhook получают свой
+        self.metrics_port = metrics.METRICS_PORT
+        self.metrics_server: Optional[metrics.MetricsServer] = None
+        for handlers in self.application.handlers.values():
+            for handler in handlers:
+                # Записи лога обработчика получают request_id апдейта
+                handler.callback = with_request_id(metrics.track_handler(handler.callback))
+
+        update_queue = self.application.update_queue
+        metrics.queue_depth.track(update_queue.qsize, queue="updates")
+        metrics.queue_depth.track(chat_queue.pending, queue="chat_requests")
+        metrics.queue_depth.track(image_pipeline.queued, queue="image_requests")
+        metrics.queue_depth.track(settings_manager.pending_count, queue="settings_writes")
+        metrics.queue_depth.track(summarizer.running, queue="summaries")
+        metrics.response_cache_entries.track(response_cache.__len__)
+        metrics.client_pool_size.track(self.client_pool.__len__)
+
+    async def _on_startup(self, application: Application) -> None:
+        """Запускает сервер метрик, измерение задержки event loop и загрузку токенизаторов."""
+        metrics.loop_lag_monitor.start()
+        context_builder.preload(MODEL_CONTEXT_LIMITS)
+        if not self.metrics_port:
+            return
+        self.metrics_server = metrics.MetricsServer(port=self.metrics_port)
+        if not await self.metrics_server.start():
+            self.metrics_server = None
+
+    async def _on_shutdown(self, application: Application) -> None:
+        """Закрывает HTTP-соединения клиентов OpenAI при остановке бота."""
+        logger.debug("Статистика пула клиентов OpenAI: {}", self.client_pool.stats())
+        await self.client_pool.close()
+        # Дожидаемся отложенной записи настроек, пока event loop еще работает
+        await summarizer.close()
+        await settings_manager.drain()
+        await metrics.loop_lag_monitor.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+
     async def _error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик ошибок бота."""
         try:
@@ -222,7 +267,7 @@ class GPTBot:
             logger.error(f"Ошибка в обработчике ошибок: {e}")
             logger.debug(f"Полный контекст ошибки: {context.error.__traceback__}")
 
-    async def stream_chat_completion(self, messages, chat_id, message_id, context):
+    async def stream_chat_completion(self, messages, chat_id, message_id, context, user_id=None):
         """
         Отправка потокового ответа от модели GPT.
         
@@ -231,108 +276,131 @@ class GPTBot:
             chat_id: ID чата
             message_id: ID сообщения для обновления
             context: Контекст бота
+            user_id: ID пользователя, чьи настройки и история используются
+                (по умолчанию совпадает с chat_id)
         """
-        max_retries = 3
-        retry_delay = 100  # начальная задержка в секундах
-        attempt = 0
-
-        while attempt < max_retries:
-            try:
-                # Получаем настройки пользователя
-                settings = settings_manager.get_user_settings(chat_id)
-                text_settings = settings.text_settings
+        user_id = user_id or chat_id
+        editor = edit_scheduler.open(self.application.bot, chat_id, message_id)
+        try:
+            # Получаем настройки пользователя
+            settings = settings_manager.get_user_settings(user_id)
+            text_settings = settings.text_settings
 
-                # Создаем потоковый запрос к API с настройками пользователя
-                stream = self.openai_client.chat.completions.create(
-                    model=text_settings.model,
-                    messages=messages,
-                    temperature=text_settings.temperature,
-                    max_tokens=text_settings.max_tokens,
-                    stream=True
-                )
+            # Ответы на вопросы без предыстории могут быть взяты из кэша
+            cache_key = response_cache.key_for(
+                settings.message_history,
+                self.client_pool.resolve_base_url(text_settings.base_url),
+                text_settings.effective_model,
+                text_settings.temperature,
+                text_settings.max_tokens
+            )
+            # Ответ из кэша отправляется тем же путем, что и поток модели;
+            # похожий вопрос ищется параллельно с запросом к модели
+            pieces = response_cache.stream(
+                cache_key,
+                lambda: self.open_routed_stream(messages, text_settings),
+                lambda text: self.create_embedding(text, text_settings.base_url)
+            )
 
-                # Буфер для накопления частей ответа
-                response_buffer = ""
-                last_update = ""  # Сохраняем последнее отправленное сообщение
-                update_counter = 0  # Счетчик для обновлений
-                
-                # Обрабатываем поток ответов
-                for chunk in stream:
-                    if chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        response_buffer += content
-                        update_counter += 1
-                        
-                        # Обновляем сообщение каждые 5 чанков или если есть новая строка
-                        if update_counter >= 5 or '\n' in content:
-                            try:
-                                # Проверяем, изменилось ли сообщение
-                                if response_buffer != last_update:
-                                    await self.application.bot.edit_message_text(
-                                        chat_id=chat_id,
-                                        message_id=message_id,
-                                        text=response_buffer
-                                    )
-                                    last_update = response_buffer
-                                update_counter = 0
-                            except BadRequest as e:
-                                if "Message is not modified" not in str(e):
-                                    logger.debug(f"Ошибка при обновлении сообщения: {e}")
+            # Буфер для накопления частей ответа
+            response_buffer = ""
+            timer = metrics.StreamTimer()
 
-                # Отправляем финальное обновление
-                if response_buffer and response_buffer != last_update:
-                    try:
-                        await self.application.bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=message_id,
-                            text=response_buffer
-                        )
-                        
-                        # Сохраняем ответ в историю
-                        settings.message_history.append({
-                            "role": "assistant",
-                            "content": response_buffer
-                        })
-                        settings_manager.save_settings()
-                    except BadRequest as e:
-                        if "Message is not modified" not in str(e):
-                            logger.debug(f"Ошибка при финальном обновлении: {e}")
-                
-                # Если успешно получили ответ, выходим из цикла
-                break
+            # Обрабатываем поток ответов. Частоту правок ограничивает
+            # планировщик, он же обрабатывает ограничения Telegram (RetryAfter)
+            async with aclosing(pieces):
+                async for piece in pieces:
+                    if pieces.cached is None:
+                        timer.token()
+                    response_buffer += piece
+                    await editor.update(response_buffer)
 
-            except Exception as e:
-                error_message = str(e)
-                if "Flood control exceeded" in error_message:
-                    attempt += 1
-                    if attempt < max_retries:
-                        retry_seconds = retry_delay * attempt
-                        logger.warning(f"Превышен лимит запросов. Попытка {attempt} из {max_retries}. "
-                                     f"Ожидание {retry_seconds} секунд...")
-                        
-                        await self.application.bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=message_id,
-                            text=f"⏳ Превышен лимит запросов. Повторная попытка через {retry_seconds} секунд..."
-                        )
-                        
-                        await asyncio.sleep(retry_seconds)
-                        continue
-                    else:
-                        logger.error(f"Превышен лимит попыток после {max_retries} попыток")
-                        await self.application.bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=message_id,
-                            text="❌ Превышен лимит запросов. Пожалуйста, попробуйте позже."
-                        )
-                else:
-                    logger.error(f"Ошибка при получении ответа от OpenAI: {e}")
-                    await self.application.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text="❌ Произошла ошибка при получении ответа. Пожалуйста, попробуйте позже."
+            # Отправляем финальное обновление
+            if response_buffer:
+                if await editor.finish(response_buffer):
+                    # Сохраняем ответ в историю
+                    settings_manager.append_message(user_id, {
+                        "role": "assistant",
+                        "content": response_buffer
+                    })
+                    # Ответ запасной модели не кэшируется под ключом выбранной
+                    if cache_key is not None and pieces.cached is None and not pieces.fallback:
+                        pieces.put(response_buffer)
+                    # Длинная история сжимается в фоне, после ответа пользователю
+                    summarizer.schedule(
+                        user_id,
+                        self.client_pool.resolve_base_url(text_settings.base_url),
+                        lambda prompt: self.create_summary(prompt, text_settings)
                     )
-                break
+                logger.debug(f"Ответ в чат {chat_id} отправлен за {editor.edit_count} правок "
+                             f"в {len(editor.message_ids)} сообщениях")
+            if pieces.cached is None:
+                timer.finish(editor.edit_count)
+
+        except Exception as e:
+            metrics.openai_errors.inc(kind="chat", error=type(e).__name__)
+            logger.error(f"Ошибка при получении ответа от OpenAI: {e}")
+            await editor.finish("❌ Произошла ошибка при получении ответа. Пожалуйста, попробуйте позже.")
+
+    def open_routed_stream(self, messages, text_settings) -> RoutedStream:
+        """Потоковый ответ с выбором маршрута и переключением на запасные модели."""
+        base_url = self.client_pool.resolve_base_url(text_settings.base_url)
+        return router.stream(
+            lambda route, retry: self._stream_completion(messages, text_settings, route, retry),
+            base_url,
+            text_settings.effective_model,
+            default_endpoint=base_url == self.client_pool.default_base_url
+        )
+
+    async def _stream_completion(self, messages, text_settings, route: Route, retry: bool = True):
+        """Отдает фрагменты потокового ответа модели по маршруту."""
+        async with self.client_pool.lease(route.base_url) as client:
+            if not retry:
+                # Ошибку быстрее обработать переключением на другой маршрут
+                client = client.with_options(max_retries=0)
+            # Создаем потоковый запрос к API с настройками пользователя
+            stream = await client.chat.completions.create(
+                model=route.model,
+                messages=messages,
+                temperature=text_settings.temperature,
+                max_tokens=text_settings.max_tokens,
+                stream=True
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
+
+    async def create_embedding(self, text: str, base_url: Optional[str] = None) -> list[float]:
+        """Получает эмбеддинг текста для поиска похожих вопросов в кэше ответов."""
+        params = {}
+        if RESPONSE_CACHE_EMBEDDING_MODEL.startswith('text-embedding-3') and RESPONSE_CACHE_EMBEDDING_DIMENSIONS:
+            params['dimensions'] = RESPONSE_CACHE_EMBEDDING_DIMENSIONS
+        started = time.perf_counter()
+        async with self.client_pool.lease(base_url) as client:
+            response = await client.embeddings.create(
+                model=RESPONSE_CACHE_EMBEDDING_MODEL,
+                input=text,
+                **params
+            )
+        metrics.openai_request_duration.observe(time.perf_counter() - started, kind="embedding")
+        return response.data[0].embedding
+
+    async def create_summary(self, messages: list[dict], text_settings) -> str:
+        """Составляет краткое содержание старой части диалога."""
+        # Дешевая модель есть только на основном endpoint, на пользовательском
+        # используется модель из настроек
+        if self.client_pool.resolve_base_url(text_settings.base_url) == self.client_pool.default_base_url:
+            model = SUMMARY_MODEL
+        else:
+            model = text_settings.effective_model
+        async with self.client_pool.lease(text_settings.base_url) as client:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.2,
+                max_tokens=SUMMARY_MAX_TOKENS
+            )
+        return response.choices[0].message.content or ""
 
     async def create_image(self, prompt, **kwargs):
         """
@@ -343,18 +411,34 @@ class GPTBot:
             **kwargs: Дополнительные параметры (размер, качество и т.д.)
         
         Returns:
-            str: URL сгенерированного изображения
+            bytes | str: Содержимое изображения для загрузки в Telegram или
+            URL, если API не вернул изображение в base64
         """
         try:
-            response = self.openai_client.images.generate(
-                model=kwargs.get('model', 'dall-e-3'),
-                prompt=prompt,
-                size=kwargs.get('size', '1024x1024'),
-                quality=kwargs.get('quality', 'standard'),
-                n=1
-            )
-            return response.data[0].url
+            model = kwargs.get('model', 'dall-e-3')
+            params = {}
+            if model == 'dall-e-3' and kwargs.get('style'):
+                params['style'] = kwargs['style']
+            started = time.perf_counter()
+            async with self.client_pool.lease(kwargs.get('base_url')) as client:
+                # Получаем изображение сразу в base64: загрузка байтов в Telegram
+                # не зависит от срока жизни временной ссылки OpenAI
+                response = await client.images.generate(
+                    model=model,
+                    prompt=prompt,
+                    size=kwargs.get('size', '1024x1024'),
+                    quality=kwargs.get('quality', 'standard'),
+                    response_format='b64_json',
+                    n=1,
+                    **params
+                )
+            metrics.openai_request_duration.observe(time.perf_counter() - started, kind="image")
+            image = response.data[0]
+            if image.b64_json:
+                return base64.b64decode(image.b64_json)
+            return image.url
         except Exception as e:
+            metrics.openai_errors.inc(kind="image", error=type(e).__name__)
             logger.error(f"Ошибка при генерации изображения: {e}")
             raise
 
@@ -364,6 +448,11 @@ class GPTBot:
             # Добавляем GPTBot как пользовательское свойство контекста
             self.application.bot_data['gpt_bot'] = self
             
+            if BOT_MODE == 'webhook':
+                logger.info("Бот запущен в режиме webhook")
+                run_webhook(self.application)
+                return
+
             # Запускаем бота
             logger.info("Бот запущен")
             self.application.run_polling(
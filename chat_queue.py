@@ -0,0 +1,93 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Hashable
+from loguru import logger
+
+# Сколько секунд ждать продолжения серии сообщений перед запросом к модели
+# (0 - отвечать на первое сообщение сразу). Сообщения, которые пользователь
+# отправляет подряд, обычно приходят с интервалом в доли секунды
+CHAT_BURST_WINDOW = float(os.getenv('CHAT_BURST_WINDOW', '0.4'))
+
+
+class ChatRequestQueue:
+    """
+    Последовательная обработка запросов одного пользователя.
+
+    Пока для пользователя идет генерация, новые сообщения не запускают
+    параллельные запросы к модели, а накапливаются. Когда текущая генерация
+    завершится, накопленные сообщения из одного чата обрабатываются одним
+    запросом. Так история сообщений не перемешивается, а серия быстрых
+    сообщений не умножает расходы на API.
+    """
+
+    def __init__(self, window: float = CHAT_BURST_WINDOW):
+        self.window = window
+        self._queues: dict[Hashable, list[tuple[int, Any]]] = {}
+        self.batches = 0
+        self.coalesced = 0
+
+    def is_busy(self, key: Hashable) -> bool:
+        return key in self._queues
+
+    @staticmethod
+    def _take_batch(queue: list[tuple[int, Any]]) -> list:
+        """Забирает из начала очереди сообщения из того же чата, что и первое."""
+        chat_id = queue[0][0]
+        size = 1
+        while size < len(queue) and queue[size][0] == chat_id:
+            size += 1
+        batch = [item for _, item in queue[:size]]
+        del queue[:size]
+        return batch
+
+    async def submit(
+        self,
+        key: Hashable,
+        chat_id: int,
+        item: Any,
+        process: Callable[[list], Awaitable[None]]
+    ) -> bool:
+        """
+        Обрабатывает запрос или добавляет его к уже идущей обработке.
+
+        Args:
+            key: Ключ сериализации (ID пользователя)
+            chat_id: ID чата, из которого пришло сообщение
+            item: Данные запроса
+            process: Корутина-функция, обрабатывающая список запросов
+
+        Returns:
+            bool: False, если запрос будет обработан вместе с другими
+            в уже запущенной обработке
+        """
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append((chat_id, item))
+            self.coalesced += 1
+            logger.debug(f"Сообщение пользователя {key} будет обработано вместе с предыдущими")
+            return False
+
+        queue = self._queues[key] = [(chat_id, item)]
+        try:
+            while queue:
+                if self.window:
+                    await asyncio.sleep(self.window)
+                batch = self._take_batch(queue)
+                self.batches += 1
+                try:
+                    await process(batch)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке сообщений пользователя {key}: {e}")
+        finally:
+            del self._queues[key]
+        return True
+
+    def pending(self) -> int:
+        """Количество сообщений, ожидающих или проходящих обработку."""
+        return sum(len(queue) for queue in self._queues.values()) + len(self._queues)
+
+    def stats(self) -> dict:
+        return {"active": len(self._queues), "batches": self.batches, "coalesced": self.coalesced}
+
+
+chat_queue = ChatRequestQueue()
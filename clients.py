@@ -0,0 +1,151 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+import httpx
+from loguru import logger
+from openai import AsyncOpenAI
+import metrics
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+# Максимум соединений к одному endpoint и сколько из них держать открытыми
+MAX_CONNECTIONS_PER_HOST = int(os.getenv('OPENAI_MAX_CONNECTIONS', '20'))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE', '10'))
+KEEPALIVE_EXPIRY = 60.0
+# Через сколько секунд простоя клиент закрывается и удаляется из пула
+CLIENT_IDLE_TIMEOUT = float(os.getenv('OPENAI_CLIENT_IDLE_TIMEOUT', '900'))
+
+
+def create_openai_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    """Создает AsyncOpenAI с пулом keep-alive соединений."""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS_PER_HOST,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(600.0, connect=10.0)
+    )
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+
+class _PoolEntry:
+    __slots__ = ("client", "last_used", "in_use")
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+
+class OpenAIClientPool:
+    """
+    Пул клиентов OpenAI, по одному на каждую пару (base_url, api_key).
+
+    Пользователи могут указать свой base_url для текстовой модели и модели
+    изображений. Клиент для каждого endpoint создается один раз и повторно
+    использует открытые HTTP-соединения, а простаивающие клиенты
+    закрываются по таймауту.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        default_base_url: str = DEFAULT_BASE_URL,
+        idle_timeout: float = CLIENT_IDLE_TIMEOUT,
+        client_factory: Callable[[str, str], AsyncOpenAI] = create_openai_client
+    ):
+        self.api_key = api_key
+        self.default_base_url = default_base_url
+        self.idle_timeout = idle_timeout
+        self.client_factory = client_factory
+        self._clients: dict[tuple[str, str], _PoolEntry] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def resolve_base_url(self, base_url: Optional[str]) -> str:
+        """
+        Возвращает фактический base_url.
+
+        Значение по умолчанию из настроек пользователя заменяется на
+        OPENAI_API_BASE из окружения.
+        """
+        if not base_url or base_url.rstrip('/') == DEFAULT_BASE_URL:
+            return self.default_base_url
+        return base_url.rstrip('/')
+
+    def _entry(self, base_url: Optional[str]) -> _PoolEntry:
+        self._evict_idle()
+        key = (self.resolve_base_url(base_url), self.api_key)
+        entry = self._clients.get(key)
+        if entry is None:
+            self.misses += 1
+            metrics.client_pool_requests.inc(result="miss")
+            entry = self._clients[key] = _PoolEntry(self.client_factory(key[0], key[1]))
+            logger.debug(f"Создан клиент OpenAI для {key[0]} (клиентов в пуле: {len(self._clients)})")
+        else:
+            self.hits += 1
+            metrics.client_pool_requests.inc(result="hit")
+        entry.last_used = time.monotonic()
+        return entry
+
+    def get(self, base_url: Optional[str] = None) -> AsyncOpenAI:
+        """Возвращает клиент для base_url, создавая его при необходимости."""
+        return self._entry(base_url).client
+
+    @asynccontextmanager
+    async def lease(self, base_url: Optional[str] = None):
+        """Выдает клиент на время запроса, защищая его от закрытия по простою."""
+        entry = self._entry(base_url)
+        entry.in_use += 1
+        try:
+            yield entry.client
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    def _evict_idle(self):
+        threshold = time.monotonic() - self.idle_timeout
+        stale = [
+            key for key, entry in self._clients.items()
+            if entry.in_use == 0 and entry.last_used < threshold
+        ]
+        for key in stale:
+            entry = self._clients.pop(key)
+            self.evictions += 1
+            metrics.client_pool_evictions.inc()
+            logger.debug(f"Клиент OpenAI для {key[0]} закрыт после простоя")
+            self._close_client(entry.client)
+
+    @staticmethod
+    def _close_client(client):
+        close = getattr(client, "close", None)
+        if close is None:
+            return
+        try:
+            asyncio.get_running_loop().create_task(close())
+        except RuntimeError:
+            pass
+
+    async def close(self):
+        """Закрывает все клиенты пула."""
+        for entry in self._clients.values():
+            close = getattr(entry.client, "close", None)
+            if close is not None:
+                await close()
+        self._clients.clear()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def stats(self) -> dict:
+        """Метрики пула: попадания, промахи, вытеснения и размер."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._clients)
+        }
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import sys
+from collections import OrderedDict
+from typing import Iterable, Optional
+from loguru import logger
+import os
+from history import Message, message_dict
+
+try:
+    import tiktoken
+except ImportError:
+    # Без tiktoken используется приблизительная оценка количества токенов
+    tiktoken = None
+
+# Размер контекстного окна для известных моделей (в токенах)
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+# Для неизвестных (пользовательских) моделей берем осторожное значение
+DEFAULT_CONTEXT_LIMIT = 8192
+
+# Служебные токены, которые API добавляет к каждому сообщению
+MESSAGE_OVERHEAD_TOKENS = 4
+# Запас на неточность подсчета и служебные токены ответа
+SAFETY_MARGIN_TOKENS = 64
+
+# Необязательное ограничение размера контекста для экономии (0 - без ограничения)
+MAX_CONTEXT_TOKENS = int(os.getenv('MAX_CONTEXT_TOKENS', '0') or 0)
+# Предел памяти кэша количества токенов для сообщений-словарей (байты)
+TOKEN_CACHE_MAX_BYTES = 4 * 1024 * 1024
+# Накладные расходы OrderedDict на одну запись кэша (байты, оценка)
+_CACHE_ENTRY_OVERHEAD = 100
+
+
+def get_context_limit(model: str) -> int:
+    """Возвращает размер контекстного окна модели."""
+    if model in MODEL_CONTEXT_LIMITS:
+        return MODEL_CONTEXT_LIMITS[model]
+    # Учитываем версии моделей вида gpt-4o-2024-08-06
+    for name in sorted(MODEL_CONTEXT_LIMITS, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_CONTEXT_LIMITS[name]
+    return DEFAULT_CONTEXT_LIMIT
+
+
+class ContextWindowBuilder:
+    """
+    Подбирает последние сообщения истории так, чтобы они поместились
+    в бюджет токенов модели.
+
+    Количество токенов каждого сообщения кэшируется, поэтому на очередном
+    ходе подсчитывается только новое сообщение, а не вся история. Объекты
+    Message хранят его сами (Message.tokens), для словарей есть кэш по
+    хэшу текста, ограниченный cache_bytes: копии текстов не хранятся.
+
+    Токенизатор при первом использовании может скачивать словарь из сети,
+    поэтому внутри event loop он загружается в отдельном потоке, а до
+    окончания загрузки (или если она не удалась) количество токенов
+    оценивается по длине текста.
+    """
+
+    def __init__(self, cache_bytes: int = TOKEN_CACHE_MAX_BYTES):
+        self.cache_bytes = cache_bytes
+        self._token_cache: OrderedDict = OrderedDict()
+        self._token_cache_bytes = 0
+        self._encodings: dict = {}
+        self._loading: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def _load_encoding(model: str):
+        if tiktoken is None:
+            return None
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                return tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить токенизатор для модели {model}: {e}, "
+                           f"количество токенов оценивается по длине текста")
+            return None
+
+    def _get_encoding(self, model: str):
+        if model in self._encodings:
+            return self._encodings[model]
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (скрипты, бенчмарки) токенизатор загружается сразу
+            self._encodings[model] = self._load_encoding(model)
+            return self._encodings[model]
+        if model not in self._loading:
+            task = asyncio.ensure_future(asyncio.to_thread(self._load_encoding, model))
+            task.add_done_callback(lambda done: self._on_encoding_loaded(model, done))
+            self._loading[model] = task
+        return None
+
+    def _on_encoding_loaded(self, model: str, task: asyncio.Future):
+        del self._loading[model]
+        self._encodings[model] = None if task.cancelled() else task.result()
+
+    def preload(self, models: Iterable[str]):
+        """Начинает загрузку токенизаторов моделей в фоне (вызывается при запуске бота)."""
+        for model in models:
+            self._get_encoding(model)
+
+    def count_tokens(self, text: str, model: str) -> int:
+        """Подсчитывает количество токенов в тексте."""
+        encoding = self._get_encoding(model)
+        if encoding is not None:
+            return len(encoding.encode(text))
+        # Приблизительная оценка без токенизатора: ~4 байта на токен
+        return len(text.encode('utf-8')) // 4 + 1
+
+    def message_tokens(self, message: dict, model: str) -> int:
+        """Возвращает количество токенов сообщения с учетом кэша."""
+        encoding = self._get_encoding(model)
+        encoding_name = encoding.name if encoding is not None else None
+        if isinstance(message, Message):
+            if message.tokens is None or message.tokens[0] != encoding_name:
+                tokens = self.count_tokens(message.content, model) + MESSAGE_OVERHEAD_TOKENS
+                message.tokens = (encoding_name, tokens)
+            return message.tokens[1]
+
+        content = message["content"]
+        key = (encoding_name, hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest())
+        tokens = self._token_cache.get(key)
+        if tokens is not None:
+            self._token_cache.move_to_end(key)
+            return tokens
+        tokens = self.count_tokens(content, model) + MESSAGE_OVERHEAD_TOKENS
+        self._token_cache[key] = tokens
+        self._token_cache_bytes += self._entry_bytes(key)
+        while self._token_cache_bytes > self.cache_bytes and self._token_cache:
+            evicted, _ = self._token_cache.popitem(last=False)
+            self._token_cache_bytes -= self._entry_bytes(evicted)
+        return tokens
+
+    @staticmethod
+    def _entry_bytes(key: tuple) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(key[1]) + _CACHE_ENTRY_OVERHEAD
+
+    def get_budget(self, model: str, max_tokens: int) -> int:
+        """Возвращает количество токенов, доступных для истории сообщений."""
+        budget = get_context_limit(model) - max_tokens - SAFETY_MARGIN_TOKENS
+        if MAX_CONTEXT_TOKENS:
+            budget = min(budget, MAX_CONTEXT_TOKENS)
+        return max(budget, 0)
+
+    def build(self, messages: list, model: str, max_tokens: int,
+              budget: Optional[int] = None) -> list:
+        """
+        Формирует список сообщений для запроса к модели.
+
+        Args:
+            messages: Полная история сообщений
+            model: Фактическая модель (effective_model)
+            max_tokens: Количество токенов, зарезервированное под ответ
+            budget: Явный бюджет токенов для истории (по умолчанию из модели)
+
+        Returns:
+            list: Последние сообщения, укладывающиеся в бюджет. Системное
+            сообщение в начале истории и последнее сообщение сохраняются всегда.
+        """
+        if not messages:
+            return []
+        if budget is None:
+            budget = self.get_budget(model, max_tokens)
+
+        pinned = []
+        start = 0
+        if messages[0].get("role") == "system":
+            pinned = [messages[0]]
+            budget -= self.message_tokens(messages[0], model)
+            start = 1
+
+        selected = []
+        used = 0
+        for message in reversed(messages[start:]):
+            tokens = self.message_tokens(message, model)
+            if selected and used + tokens > budget:
+                break
+            selected.append(message)
+            used += tokens
+
+        selected.reverse()
+        if len(selected) < len(messages) - start:
+            logger.debug(
+                f"История сокращена до {len(selected)} из {len(messages) - start} сообщений "
+                f"({used} токенов, бюджет {budget})"
+            )
+        # В API передаются словари, даже если история хранит объекты Message
+        return [message_dict(message) for message in pinned + selected]
+
+    def build_for_settings(self, messages: list, text_settings) -> list:
+        """Формирует контекст с учетом настроек текстовой модели пользователя."""
+        return self.build(messages, text_settings.effective_model, text_settings.max_tokens)
+
+
+context_builder = ContextWindowBuilder()
@@ -0,0 +1,311 @@
+import asyncio
+import os
+import time
+from typing import Optional
+from loguru import logger
+from telegram.error import BadRequest, RetryAfter
+from outbox import TokenBucket
+from formatting import STREAM_PARSE_MODE, StreamRenderer, split_page
+import metrics
+
+# Минимальный интервал между правками одного чата (секунды)
+EDIT_MIN_INTERVAL = float(os.getenv('EDIT_MIN_INTERVAL', '1.0'))
+# Максимальный интервал, до которого растет пауза после ограничений Telegram
+EDIT_MAX_INTERVAL = float(os.getenv('EDIT_MAX_INTERVAL', '10.0'))
+# Минимальное количество новых символов для промежуточной правки
+EDIT_MIN_CHARS = int(os.getenv('EDIT_MIN_CHARS', '40'))
+# Общий лимит правок в секунду для всех чатов
+GLOBAL_EDITS_PER_SECOND = float(os.getenv('GLOBAL_EDITS_PER_SECOND', '20'))
+# Количество попыток отправить финальный текст
+FINAL_EDIT_ATTEMPTS = 5
+# Максимальная длина текста сообщения в Telegram
+MESSAGE_MAX_CHARS = 4096
+# Длина ответа, после которой он продолжается в новом сообщении (символов
+# Markdown; запас до лимита Telegram оставлен под разметку)
+STREAM_PAGE_CHARS = int(os.getenv('STREAM_PAGE_CHARS', '3800'))
+# Текст нового сообщения, пока в нем еще нет продолжения ответа
+CONTINUATION_PLACEHOLDER = "…"
+
+
+class _ChatState:
+    __slots__ = ("interval", "last_edit", "blocked_until")
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_edit = 0.0
+        self.blocked_until = 0.0
+
+
+class EditScheduler:
+    """
+    Планировщик правок сообщений при потоковой генерации.
+
+    Ограничивает частоту edit_message_text для каждого чата и в целом
+    по боту: промежуточные правки отправляются не чаще интервала чата
+    и только если с прошлой правки добавилось достаточно символов.
+    Промежуточные тексты, которые не удалось отправить, объединяются -
+    следующая правка сразу содержит весь накопленный текст. При RetryAfter
+    чат блокируется на указанное Telegram время, а его интервал растет.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = EDIT_MIN_INTERVAL,
+        max_interval: float = EDIT_MAX_INTERVAL,
+        min_chars: int = EDIT_MIN_CHARS,
+        global_rate: float = GLOBAL_EDITS_PER_SECOND,
+        parse_mode: str = STREAM_PARSE_MODE,
+        page_chars: int = STREAM_PAGE_CHARS
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_chars = min_chars
+        self.parse_mode = parse_mode
+        self.page_chars = min(page_chars, MESSAGE_MAX_CHARS)
+        self.global_bucket = TokenBucket(global_rate)
+        self._chats: dict[int, _ChatState] = {}
+
+    def _chat_state(self, chat_id: int) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            self._prune()
+            state = self._chats[chat_id] = _ChatState(self.min_interval)
+        return state
+
+    def _prune(self):
+        """Удаляет состояние давно неактивных чатов."""
+        if len(self._chats) < 10000:
+            return
+        threshold = time.monotonic() - self.max_interval * 10
+        for chat_id in [c for c, s in self._chats.items() if s.last_edit < threshold]:
+            del self._chats[chat_id]
+
+    def open(self, bot, chat_id: int, message_id: int) -> "StreamEditor":
+        """Создает редактор для одного сообщения с потоковым ответом."""
+        renderer = StreamRenderer(self.parse_mode) if self.parse_mode else None
+        return StreamEditor(self, bot, chat_id, message_id, renderer)
+
+    def on_success(self, chat_id: int):
+        state = self._chat_state(chat_id)
+        state.last_edit = time.monotonic()
+        # После успешных правок постепенно возвращаемся к базовому интервалу
+        state.interval = max(self.min_interval, state.interval * 0.9)
+
+    def on_retry_after(self, chat_id: int, retry_after: float):
+        metrics.flood_waits.inc(source="edit")
+        metrics.flood_wait_seconds.inc(retry_after, source="edit")
+        state = self._chat_state(chat_id)
+        now = time.monotonic()
+        state.blocked_until = now + retry_after
+        state.last_edit = now
+        state.interval = min(self.max_interval, state.interval * 2)
+        logger.warning(
+            f"Ограничение частоты правок в чате {chat_id}: пауза {retry_after} с, "
+            f"новый интервал {state.interval:.1f} с"
+        )
+
+    def wait_time(self, chat_id: int) -> float:
+        """Время до момента, когда в чате можно будет отправить правку."""
+        state = self._chat_state(chat_id)
+        now = time.monotonic()
+        return max(0.0, state.blocked_until - now, state.last_edit + state.interval - now)
+
+
+class StreamEditor:
+    """
+    Отправляет правки сообщений с одним потоковым ответом через EditScheduler.
+
+    Текст ответа передается в Markdown, как его пишет модель; если задан
+    renderer, в Telegram уходит разметка HTML или MarkdownV2. Если Telegram
+    не смог разобрать разметку, ответ до конца отправляется обычным текстом.
+
+    Ответ длиннее page_chars планировщика продолжается в новом сообщении:
+    текущее сообщение получает окончательный текст своей части (разрез по
+    абзацу или строке, блок кода закрывается и открывается заново в
+    следующем сообщении), дальше правится только последнее сообщение.
+    """
+
+    def __init__(self, scheduler: EditScheduler, bot, chat_id: int, message_id: int,
+                 renderer: Optional[StreamRenderer] = None):
+        self.scheduler = scheduler
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.message_ids = [message_id]
+        self.renderer = renderer
+        self.sent_text = ""
+        self.edit_count = 0
+        self._sent_body = None
+        self._sent_final = False
+        # Начало последнего сообщения в тексте ответа, текст до него и
+        # строка ```, открывающая заново блок кода, разрезанный между сообщениями
+        self._offset = 0
+        self._head = ""
+        self._carry = ""
+
+    def _page(self, text: str) -> str:
+        """Markdown последнего сообщения."""
+        return self._carry + text[self._offset:] if self._offset else text
+
+    def _body(self, page: str, final: bool, renderer: Optional[StreamRenderer]) -> tuple[str, dict]:
+        if renderer is None:
+            return page, {}
+        return renderer.render(page, final), {"parse_mode": renderer.parse_mode}
+
+    def _new_renderer(self) -> Optional[StreamRenderer]:
+        return StreamRenderer(self.renderer.parse_mode) if self.renderer is not None else None
+
+    async def _send(self, method, page: str, body: str, options: dict, **kwargs):
+        """Вызывает метод бота с текстом; если разметку не удалось разобрать, повторяет без нее."""
+        try:
+            return await method(chat_id=self.chat_id, text=body, **options, **kwargs)
+        except BadRequest as e:
+            if not options or "can't parse entities" not in str(e).lower():
+                raise
+            logger.warning(f"Не удалось разобрать разметку ответа в чате {self.chat_id}: {e}, "
+                           f"ответ отправляется без разметки")
+            self.renderer = None
+            return await method(chat_id=self.chat_id, text=page, **kwargs)
+
+    async def _edit(self, text: str, final: bool = False) -> bool:
+        page = self._page(text)
+        if len(page) > self.scheduler.page_chars:
+            return await self._roll_over(text)
+        body, options = self._body(page, final, self.renderer)
+        if len(body) > MESSAGE_MAX_CHARS:
+            return await self._roll_over(text)
+        if body != self._sent_body:
+            try:
+                await self._send(self.bot.edit_message_text, page, body, options, message_id=self.message_id)
+            except RetryAfter as e:
+                self.scheduler.on_retry_after(self.chat_id, float(e.retry_after))
+                return False
+            except BadRequest as e:
+                if "Message is not modified" not in str(e):
+                    raise
+            self.edit_count += 1
+            self.scheduler.on_success(self.chat_id)
+        self.sent_text = text
+        self._sent_body = body
+        self._sent_final = final
+        return True
+
+    async def _roll_over(self, text: str) -> bool:
+        """
+        Завершает последнее сообщение и продолжает ответ в новом.
+
+        Новое сообщение отправляется только после того, как текущее получило
+        окончательный текст своей части; если любой из запросов не удался,
+        следующий вызов повторяет разрез заново.
+
+        Returns:
+            bool: True, если ответ продолжен в новом сообщении
+        """
+        page = self._page(text)
+        limit = self.scheduler.page_chars
+        while True:
+            cut, carry = split_page(page, limit, len(self._carry))
+            if self.renderer is None:
+                # Без разметки блок кода не нужно открывать заново
+                carry = ""
+            body, options = self._body(page[:cut], True, self._new_renderer())
+            # Разметка может удлинить текст сверх лимита Telegram
+            if len(body) <= MESSAGE_MAX_CHARS or limit <= len(self._carry) + 1:
+                break
+            limit = limit * 3 // 4
+        offset = self._offset + cut - len(self._carry)
+        if not carry:
+            while text.startswith("\n", offset):
+                offset += 1
+
+        try:
+            if body != self._sent_body:
+                try:
+                    await self._send(self.bot.edit_message_text, page[:cut], body, options,
+                                     message_id=self.message_id)
+                    self.edit_count += 1
+                except BadRequest as e:
+                    if "Message is not modified" not in str(e):
+                        raise
+                self._sent_body = body
+            # Продолжение ответа сразу отправляется в новом сообщении,
+            # если оно само помещается в сообщение
+            renderer = self._new_renderer()
+            rest = carry + text[offset:]
+            rest_body, rest_options = self._body(rest, False, renderer)
+            complete = (bool(text[offset:].strip()) and len(rest) <= self.scheduler.page_chars
+                        and len(rest_body) <= MESSAGE_MAX_CHARS)
+            if not complete:
+                rest, rest_body, rest_options = CONTINUATION_PLACEHOLDER, CONTINUATION_PLACEHOLDER, {}
+            message = await self._send(self.bot.send_message, rest, rest_body, rest_options)
+        except RetryAfter as e:
+            self.scheduler.on_retry_after(self.chat_id, float(e.retry_after))
+            return False
+        except BadRequest as e:
+            logger.warning(f"Не удалось продолжить ответ в новом сообщении в чате {self.chat_id}: {e}")
+            return False
+
+        self.message_id = message.message_id
+        self.message_ids.append(self.message_id)
+        self._offset, self._head, self._carry = offset, text[:offset], carry
+        if self.renderer is not None:
+            self.renderer = renderer
+        self.sent_text = text if complete else text[:offset]
+        self._sent_body = rest_body
+        self._sent_final = False
+        self.edit_count += 1
+        self.scheduler.on_success(self.chat_id)
+        logger.debug(f"Ответ в чате {self.chat_id} продолжен в сообщении {self.message_id} "
+                     f"(сообщений: {len(self.message_ids)})")
+        return True
+
+    async def update(self, text: str) -> bool:
+        """
+        Предлагает промежуточный текст ответа.
+
+        Правка отправляется, только если это разрешают лимиты чата и бота,
+        иначе текст будет отправлен вместе со следующей правкой.
+
+        Returns:
+            bool: True, если правка была отправлена
+        """
+        if len(text) - len(self.sent_text) < self.scheduler.min_chars:
+            return False
+        if self.scheduler.wait_time(self.chat_id) > 0:
+            return False
+        if not self.scheduler.global_bucket.try_acquire():
+            return False
+        try:
+            return await self._edit(text)
+        except BadRequest as e:
+            logger.debug(f"Ошибка при обновлении сообщения: {e}")
+            return False
+
+    async def finish(self, text: str, attempts: Optional[int] = None) -> bool:
+        """
+        Отправляет финальный текст, дожидаясь разрешения лимитов.
+
+        Если текст не продолжает уже отправленный ответ (например, сообщение
+        об ошибке), он заменяет текст последнего сообщения.
+
+        Returns:
+            bool: True, если сообщения содержат финальный текст
+        """
+        attempts = attempts or FINAL_EDIT_ATTEMPTS
+        if self._offset and not text.startswith(self._head):
+            self._offset, self._head, self._carry = 0, "", ""
+        failures = 0
+        while failures < attempts:
+            if text == self.sent_text and (self._sent_final or self.renderer is None):
+                return True
+            delay = self.scheduler.wait_time(self.chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.scheduler.global_bucket.acquire()
+            if not await self._edit(text, final=True):
+                failures += 1
+        logger.error(f"Не удалось отправить финальный текст в чат {self.chat_id} после {attempts} попыток")
+        return False
+
+
+edit_scheduler = EditScheduler()
@@ -0,0 +1,432 @@
+import os
+import re
+from typing import Optional
+
+# Разметка потоковых ответов модели: HTML, MarkdownV2 или пустая строка
+# (текст отправляется без разметки, как есть)
+STREAM_PARSE_MODE = os.getenv('STREAM_PARSE_MODE', 'HTML')
+# Максимальная длина ссылки [текст](адрес): дальше "[" считается обычным символом
+MAX_LINK_LENGTH = 500
+
+HTML = "HTML"
+MARKDOWN_V2 = "MarkdownV2"
+
+# Символы, с которых может начинаться разметка Markdown в ответе модели
+_SPECIAL = re.compile(r"[*_~`\[\\\n#]")
+_LINK = re.compile(r"\[([^\]\n]*)\]\(([^)\s]*)\)")
+_LINK_SCHEMES = ("http://", "https://", "tg://", "mailto:")
+_LANGUAGE = re.compile(r"[\w+#.-]+")
+_PUNCTUATION = frozenset("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~")
+# Неполная ссылка в конце буфера: ждем продолжения
+_PARTIAL_LINK = re.compile(r"\[[^\]\n]*(\]\(?[^)\s]*)?\Z")
+_FENCE_CLOSE = re.compile(r"```[ \t]*(\n|\Z)")
+_CODE_END = re.compile(r"[`\n]")
+
+
+class HTMLDialect:
+    escape_table = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+    tags = {"b": ("<b>", "</b>"), "i": ("<i>", "</i>"), "s": ("<s>", "</s>"), "code": ("<code>", "</code>")}
+
+    def escape(self, text: str) -> str:
+        return text.translate(self.escape_table)
+
+    escape_code = escape
+
+    def open_pre(self, language: str) -> str:
+        return f'<pre><code class="language-{language}">' if language else "<pre>"
+
+    def close_pre(self, language: str) -> str:
+        return "</code></pre>" if language else "</pre>"
+
+    def link(self, text: str, url: str) -> str:
+        href = self.escape(url).replace('"', "&quot;")
+        return f'<a href="{href}">{self.escape(text)}</a>'
+
+
+class MarkdownV2Dialect:
+    escape_table = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+    code_table = str.maketrans({"\\": "\\\\", "`": "\\`"})
+    url_table = str.maketrans({"\\": "\\\\", ")": "\\)"})
+    tags = {"b": ("*", "*"), "i": ("_", "_"), "s": ("~", "~"), "code": ("`", "`")}
+
+    def escape(self, text: str) -> str:
+        return text.translate(self.escape_table)
+
+    def escape_code(self, text: str) -> str:
+        return text.translate(self.code_table)
+
+    def open_pre(self, language: str) -> str:
+        return f"```{language}\n"
+
+    def close_pre(self, language: str) -> str:
+        return "```"
+
+    def link(self, text: str, url: str) -> str:
+        return f"[{self.escape(text)}]({url.translate(self.url_table)})"
+
+
+DIALECTS = {HTML: HTMLDialect(), MARKDOWN_V2: MarkdownV2Dialect()}
+
+
+class StreamRenderer:
+    """
+    Преобразует растущий ответ модели (Markdown) в разметку Telegram.
+
+    Разбор инкрементальный: обработанный префикс ответа, его разметка и
+    стек открытых сущностей сохраняются между вызовами, поэтому каждая
+    правка разбирает только новый текст. Разметка, которую нельзя
+    разобрать без продолжения (одиночная "*" в конце, начало ссылки или
+    блока кода), отправляется как обычный текст до следующей правки, а
+    незакрытые сущности закрываются в конце каждого промежуточного текста.
+    Если текст не продолжает уже обработанный, разбор начинается заново.
+    """
+
+    def __init__(self, parse_mode: str = STREAM_PARSE_MODE):
+        self.parse_mode = parse_mode
+        self._dialect = DIALECTS[parse_mode]
+        self.reset()
+
+    def reset(self):
+        # Обработанный префикс исходного текста и его разметка
+        self._source = ""
+        self._rendered = ""
+        # Открытые сущности внутри строки: "b", "i", "s", "code"
+        self._stack: list[str] = []
+        # Где заканчивается открывающий маркер каждой сущности из стека:
+        # у первых _committed сущностей - позиция в _rendered, у открытых
+        # при текущем разборе - номер следующего фрагмента в out
+        self._opened: list[int] = []
+        self._committed = 0
+        # Язык открытого блока кода ("" - без языка, None - вне блока)
+        self._pre = None
+        # Перевод строки в блоке кода, который выводится, только если за
+        # ним следует еще строка кода, а не закрывающая ```
+        self._pre_newline = False
+
+    def render(self, text: str, final: bool = False) -> str:
+        """
+        Возвращает разметку для текста сообщения.
+
+        Args:
+            text: Весь текст ответа на данный момент
+            final: Ответ завершен - разметка в конце не ждет продолжения
+        """
+        if not text.startswith(self._source):
+            self.reset()
+        out = []
+        position = self._parse(text, len(self._source), final, out)
+        if position > len(self._source):
+            self._commit(out)
+            self._source = text[:position]
+        dialect = self._dialect
+        tail = text[position:]
+        rendered = self._rendered
+        open_count = len(self._stack)
+        if tail:
+            tail = dialect.escape(tail) if self._pre is None and "code" not in self._stack else dialect.escape_code(tail)
+        else:
+            # Сущности, открытые в самом конце, пока пусты и не выводятся
+            while open_count and self._opened[open_count - 1] == len(rendered):
+                rendered = rendered[:-len(dialect.tags[self._stack[open_count - 1]][0])]
+                open_count -= 1
+        # Незакрытые сущности закрываются только в отправляемом тексте
+        suffix = [tail]
+        for tag in reversed(self._stack[:open_count]):
+            self._marker(dialect.tags[tag][1], suffix, rendered)
+        if self._pre is not None:
+            suffix.append(dialect.close_pre(self._pre))
+        return rendered + "".join(suffix)
+
+    def _commit(self, out: list):
+        """Добавляет разметку разобранного текста к _rendered."""
+        length = len(self._rendered)
+        chunk = 0
+        for index in range(self._committed, len(self._stack)):
+            # Номер фрагмента в out заменяется позицией в _rendered
+            while chunk < self._opened[index]:
+                length += len(out[chunk])
+                chunk += 1
+            self._opened[index] = length
+        self._committed = len(self._stack)
+        self._rendered += "".join(out)
+
+    def _marker(self, marker: str, out: list, rendered: Optional[str] = None):
+        # В MarkdownV2 два "_" подряд означают подчеркивание, а не границы
+        # двух курсивов: Telegram советует разделять их символом \r
+        if marker == "_" and self.parse_mode == MARKDOWN_V2:
+            last = next((chunk for chunk in reversed(out) if chunk),
+                        self._rendered if rendered is None else rendered)
+            if last.endswith("_"):
+                out.append("\r")
+        out.append(marker)
+
+    def _open(self, tag: str, out: list):
+        self._stack.append(tag)
+        self._marker(self._dialect.tags[tag][0], out)
+        self._opened.append(len(out))
+
+    def _is_empty(self, index: int, out: list) -> bool:
+        """После открывающего маркера сущности еще ничего не выведено."""
+        if index < self._committed:
+            return self._opened[index] == len(self._rendered) and not any(out)
+        return not any(out[self._opened[index]:])
+
+    def _pop(self, out: list):
+        """Закрывает последнюю открытую сущность; пустая сущность не выводится."""
+        top = len(self._stack) - 1
+        tag = self._stack.pop()
+        if self._is_empty(top, out):
+            # Открывающий маркер мог попасть в _rendered при прошлой правке
+            if top < self._committed:
+                self._rendered = self._rendered[:-len(self._dialect.tags[tag][0])]
+            else:
+                del out[self._opened[top] - 1]
+        else:
+            self._marker(self._dialect.tags[tag][1], out)
+        self._opened.pop()
+        self._committed = min(self._committed, top)
+
+    def _close(self, tag: str, out: list):
+        """Закрывает сущность; вложенные в нее закрываются и открываются заново."""
+        index = len(self._stack) - 1 - self._stack[::-1].index(tag)
+        reopen = self._stack[index + 1:]
+        while len(self._stack) > index:
+            self._pop(out)
+        for open_tag in reopen:
+            self._open(open_tag, out)
+
+    def _close_all(self, out: list):
+        while self._stack:
+            self._close(self._stack[-1], out)
+
+    def _parse(self, text: str, i: int, final: bool, out: list) -> int:
+        """Разбирает text с позиции i, возвращает позицию первого необработанного символа."""
+        dialect = self._dialect
+        n = len(text)
+        while i < n:
+            if self._pre is not None:
+                i = self._parse_pre(text, i, final, out)
+                if i < 0:
+                    return -i - 1
+                continue
+            if self._stack and self._stack[-1] == "code":
+                # Фрагмент кода заканчивается обратной кавычкой или концом строки
+                match = _CODE_END.search(text, i)
+                if match is None:
+                    out.append(dialect.escape_code(text[i:]))
+                    return n
+                end = match.start()
+                out.append(dialect.escape_code(text[i:end]))
+                self._close("code", out)
+                i = end + 1 if text[end] == "`" else end
+                continue
+            match = _SPECIAL.search(text, i)
+            if match is None:
+                out.append(dialect.escape(text[i:]))
+                return n
+            start = match.start()
+            if start > i:
+                out.append(dialect.escape(text[i:start]))
+            i = self._parse_special(text, start, final, out)
+            if i < 0:
+                return -i - 1
+        return i
+
+    def _parse_pre(self, text: str, i: int, final: bool, out: list) -> int:
+        """Содержимое блока кода: до закрывающей строки ```."""
+        dialect = self._dialect
+        line_start = i == 0 or text[i - 1] == "\n"
+        if line_start and text.startswith("`", i):
+            fence = _FENCE_CLOSE.match(text, i)
+            if fence is not None and (fence.group(1) or final):
+                out.append(dialect.close_pre(self._pre))
+                if fence.group(1):
+                    out.append("\n")
+                self._pre = None
+                self._pre_newline = False
+                return fence.end()
+            rest = text[i:]
+            if not final and ("```".startswith(rest) or (rest.startswith("```") and not rest[3:].strip(" \t"))):
+                # Закрывающая строка еще не пришла целиком
+                return -i - 1
+        if self._pre_newline:
+            out.append("\n")
+            self._pre_newline = False
+        end = text.find("\n", i)
+        if end < 0:
+            out.append(dialect.escape_code(text[i:]))
+            return len(text)
+        out.append(dialect.escape_code(text[i:end]))
+        self._pre_newline = True
+        return end + 1
+
+    def _parse_special(self, text: str, i: int, final: bool, out: list) -> int:
+        """
+        Разбирает разметку, начинающуюся с text[i].
+
+        Возвращает позицию после нее или -(i + 1), если для решения нужно
+        продолжение текста.
+        """
+        dialect = self._dialect
+        n = len(text)
+        char = text[i]
+        line_start = i == 0 or text[i - 1] == "\n"
+        hold = -i - 1
+
+        if char == "\n":
+            # Выделение не переносится на следующую строку
+            self._close_all(out)
+            out.append("\n")
+            return i + 1
+
+        if char == "\\":
+            if i + 1 >= n:
+                if not final:
+                    return hold
+                out.append(dialect.escape(char))
+                return n
+            if text[i + 1] in _PUNCTUATION:
+                out.append(dialect.escape(text[i + 1]))
+                return i + 2
+            out.append(dialect.escape(char))
+            return i + 1
+
+        if char == "#":
+            end = i
+            while end < n and text[end] == "#":
+                end += 1
+            if not line_start:
+                out.append(dialect.escape(text[i:end]))
+                return end
+            if end >= n and not final:
+                return hold
+            if end - i <= 6 and end < n and text[end] == " ":
+                # Заголовок выделяется жирным до конца строки
+                if "b" not in self._stack:
+                    self._open("b", out)
+                return end + 1
+            out.append(dialect.escape(text[i:end]))
+            return end
+
+        if char == "`":
+            if line_start and text.startswith("```", i):
+                newline = text.find("\n", i)
+                if newline < 0 and not final:
+                    return hold
+                end = n if newline < 0 else newline
+                language = _LANGUAGE.match(text[i + 3:end].strip())
+                self._close_all(out)
+                self._pre = language.group(0) if language else ""
+                out.append(dialect.open_pre(self._pre))
+                return end if newline < 0 else newline + 1
+            if i + 1 >= n:
+                if not final:
+                    return hold
+                out.append(dialect.escape(char))
+                return n
+            if line_start and text[i + 1] == "`" and i + 2 >= n and not final:
+                return hold
+            if text[i + 1] == "`":
+                # Пустой фрагмент кода Telegram не принимает
+                out.append(dialect.escape("``"))
+                return i + 2
+            self._open("code", out)
+            return i + 1
+
+        if char == "[":
+            match = _LINK.match(text, i)
+            if match is not None and match.group(1) and match.group(2).startswith(_LINK_SCHEMES):
+                out.append(dialect.link(match.group(1), match.group(2)))
+                return match.end()
+            if match is None and not final and n - i <= MAX_LINK_LENGTH and _PARTIAL_LINK.match(text, i):
+                return hold
+            out.append(dialect.escape(char))
+            return i + 1
+
+        # "*", "_", "~": выделение
+        end = i
+        while end < n and end - i < 2 and text[end] == char:
+            end += 1
+        if end >= n and not final:
+            return hold
+        if char == "*" and end - i == 1 and line_start and end < n and text[end] == " ":
+            out.append(dialect.escape("•"))
+            return end
+        if end - i == 2:
+            tag = "s" if char == "~" else "b"
+        elif char == "~":
+            out.append(dialect.escape(char))
+            return end
+        else:
+            tag = "i"
+        before = text[i - 1] if i else " "
+        after = text[end] if end < n else " "
+        # Маркеры внутри слов (snake_case, 2*3) не считаются разметкой
+        if tag in self._stack and not before.isspace() and not after.isalnum():
+            self._close(tag, out)
+            return end
+        if tag not in self._stack and not after.isspace() and not before.isalnum():
+            self._open(tag, out)
+            return end
+        out.append(dialect.escape(text[i:end]))
+        return end
+
+
+def split_page(text: str, limit: int, start: int = 0) -> tuple[int, str]:
+    """
+    Выбирает, где закончить страницу длинного ответа.
+
+    Страница заканчивается не дальше limit символов: по возможности после
+    пустой строки вне блока кода, затем на границе строки вне блока кода,
+    затем на любой границе строки или после пробела, иначе ровно на limit.
+    Если страница заканчивается внутри блока кода, следующая должна
+    начинаться со строки ```, открывающей блок заново.
+
+    Args:
+        text: Текст страницы
+        limit: Максимальная длина страницы
+        start: Начало нового текста на странице (после строки ```,
+            перенесенной с предыдущей страницы); страница не может
+            закончиться раньше
+
+    Returns:
+        tuple: (позиция конца страницы, начало следующей страницы)
+    """
+    window = max(start + 1, limit // 2)
+    # (начало строки, внутри блока кода, язык блока)
+    lines = []
+    position, in_code, language = 0, False, ""
+    while position <= limit and position < len(text):
+        lines.append((position, in_code, language))
+        end = text.find("\n", position)
+        line = text[position:end if end >= 0 else len(text)]
+        if line.startswith("```"):
+            if not in_code:
+                in_code = True
+                match = _LANGUAGE.match(line[3:].strip())
+                language = match.group(0) if match else ""
+            elif not line[3:].strip(" \t"):
+                in_code = False
+        if end < 0:
+            break
+        position = end + 1
+    else:
+        if position <= limit:
+            lines.append((position, in_code, language))
+
+    candidates = [line for line in lines if window <= line[0] <= limit]
+    for accept in (
+        lambda line: not line[1] and text[line[0] - 2:line[0]] == "\n\n",
+        lambda line: not line[1],
+        lambda line: True,
+    ):
+        found = [line for line in candidates if accept(line)]
+        if found:
+            cut, in_code, language = found[-1]
+            return cut, f"```{language}\n" if in_code else ""
+
+    # Одна длинная строка: режем после пробела или ровно по лимиту
+    space = text.rfind(" ", window, limit)
+    cut = space + 1 if space >= 0 else max(limit, start + 1)
+    _, in_code, language = next(line for line in reversed(lines) if line[0] <= cut)
+    return cut, f"```{language}\n" if in_code else ""
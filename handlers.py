@@ -1,11 +1,21 @@
+import asyncio
 import os
+import functools
 import logging
 from settings import DEBUG
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from loguru import logger
 import json
-from settings import SettingsManager
+from settings import settings_manager
+from context_window import context_builder
+from summarizer import context_messages
+from access import access_control
+from state import maintenance_flag
+from outbox import BroadcastJob, broadcaster
+from images import ImageQueueFull, ImageRequest, image_pipeline
+from chat_queue import chat_queue
+import metrics
 from utils import (
     create_settings_keyboard,
     create_text_settings_keyboard,
@@ -16,14 +26,22 @@ from utils import (
     format_settings_for_display,
     log_handler_call,
     create_menu_keyboard,
+    create_choice_keyboard,
     check_user_access_decorator,
     check_user_access
 )
 import sys
 
-settings_manager = SettingsManager()
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
+# Ввод, которого бот ждет от пользователя после кнопки в меню настроек.
+# Хранится в context.user_data под ключом PENDING_INPUT (не больше одного)
+PENDING_INPUT = "pending_input"
+INPUT_CUSTOM_MODEL = "custom_model"
+INPUT_BASE_URL = "base_url"
+INPUT_IMAGE_BASE_URL = "image_base_url"
+INPUT_SETTINGS_FILE = "settings_file"
+
 # Базовые команды
 @check_user_access_decorator
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -167,7 +185,6 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         )
         return
     
-    settings = settings_manager.get_user_settings(user_id)
     is_group = update.effective_chat.type in ['group', 'supergroup']
     
     # В группах обрабатываем только сообщения, начинающиеся с /gpt или @имя_бота
@@ -188,12 +205,32 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     else:
         actual_message = update.message.text
     
+    # Запросы одного пользователя выполняются по очереди: сообщения, пришедшие
+    # во время генерации, попадут в следующий запрос одним пакетом
+    await chat_queue.submit(
+        user_id,
+        update.effective_chat.id,
+        (update, actual_message),
+        lambda batch: reply_to_messages(batch, context, user_id)
+    )
+
+async def reply_to_messages(batch: list, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
+    """
+    Отвечает одним запросом к модели на одно или несколько сообщений.
+
+    Args:
+        batch: Список пар (update, текст сообщения) из одного чата
+        context: Контекст бота
+        user_id: ID пользователя
+    """
+    update = batch[-1][0]
     try:
-        # Добавляем сообщение пользователя в историю
-        settings.message_history.append({
-            "role": "user",
-            "content": actual_message
-        })
+        # Добавляем сообщения пользователя в историю
+        for _, actual_message in batch:
+            settings_manager.append_message(user_id, {
+                "role": "user",
+                "content": actual_message
+            })
         
         # Отправляем начальное сообщение
         initial_message = await update.message.reply_text(
@@ -203,17 +240,27 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         # Получаем экземпляр GPTBot из контекста
         gpt_bot = context.application.bot_data['gpt_bot']
         
+        # Отправляем в модель краткое содержание старой части диалога и
+        # последние сообщения, укладывающиеся в бюджет токенов
+        settings = settings_manager.get_user_settings(user_id)
+        messages = context_builder.build_for_settings(
+            context_messages(settings.message_history),
+            settings.text_settings
+        )
+        logger.debug(
+            "Запрос к модели {}: сообщений пользователя {}, в контексте {}",
+            settings.text_settings.effective_model, len(batch), len(messages)
+        )
+        
         # Отправляем запрос к модели с использованием streaming
         await gpt_bot.stream_chat_completion(
-            messages=settings.message_history,
+            messages=messages,
             chat_id=update.effective_chat.id,
             message_id=initial_message.message_id,
-            context=context
+            context=context,
+            user_id=user_id
         )
         
-        # Сохраняем обновленную историю
-        settings_manager.save_settings()
-        
     except Exception as e:
         logger.error(f"Ошибка при обработке текстового сообщения: {e}")
         await update.message.reply_text(
@@ -245,24 +292,44 @@ async def handle_image_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     prompt = command_parts[1]
+    image_settings = settings.image_settings
+    # Получаем экземпляр GPTBot из контекста
+    gpt_bot = context.application.bot_data['gpt_bot']
+    request = ImageRequest(
+        prompt=prompt,
+        model=image_settings.model,
+        size=image_settings.size,
+        quality=image_settings.quality,
+        style=image_settings.style,
+        base_url=gpt_bot.client_pool.resolve_base_url(image_settings.base_url)
+    )
+    caption = f"🎨 Сгенерировано по запросу: {prompt}"
     
     try:
+        # Повторный запрос отправляем сразу из кэша, без обращения к API
+        file_id = image_pipeline.get_cached(request)
+        if file_id is not None:
+            await update.message.reply_photo(photo=file_id, caption=caption)
+            return
+        
         # Отправляем начальное сообщение
         initial_message = await update.message.reply_text(
             "🎨 Генерирую изображение..."
         )
         
-        # Получаем экземпляр GPTBot из контекста
-        gpt_bot = context.application.bot_data['gpt_bot']
-        
-        # Генерируем изображение
-        image_url = await gpt_bot.create_image(
-            prompt=prompt,
-            model=settings.image_settings.model,
-            size=settings.image_settings.size,
-            quality=settings.image_settings.quality,
-            style=settings.image_settings.style,
-            hdr=settings.image_settings.hdr
+        # Генерируем изображение в общей очереди
+        result = await image_pipeline.submit(
+            user_id,
+            request,
+            lambda: gpt_bot.create_image(
+                prompt=prompt,
+                base_url=image_settings.base_url,
+                model=image_settings.model,
+                size=image_settings.size,
+                quality=image_settings.quality,
+                style=image_settings.style,
+                hdr=image_settings.hdr
+            )
         )
         
         # Отправляем изображение
@@ -270,11 +337,19 @@ async def handle_image_command(update: Update, context: ContextTypes.DEFAULT_TYP
             chat_id=update.effective_chat.id,
             message_id=initial_message.message_id
         )
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=f"🎨 Сгенерировано по запросу: {prompt}"
+        message = await update.message.reply_photo(
+            photo=result.photo,
+            caption=caption
         )
+        if not result.cached and message.photo:
+            image_pipeline.remember(request, message.photo[-1].file_id)
         
+    except ImageQueueFull:
+        await context.bot.edit_message_text(
+            chat_id=update.effective_chat.id,
+            message_id=initial_message.message_id,
+            text="⏳ У вас уже генерируются изображения. Дождитесь их завершения и повторите запрос."
+        )
     except Exception as e:
         logger.error(f"Ошибка при генерации изображения: {e}")
         await update.message.reply_text(
@@ -318,15 +393,30 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         # Получаем файл изображения
         file = await context.bot.get_file(image.file_id)
         
-        # Генерируем новое изображение на основе существующего
-        image_url = await gpt_bot.create_image(
-            prompt=caption,
-            model=settings.image_settings.model,
-            size=settings.image_settings.size,
-            quality=settings.image_settings.quality,
-            style=settings.image_settings.style,
-            hdr=settings.image_settings.hdr,
-            reference_image_url=file.file_path
+        # Генерируем новое изображение на основе существующего. Результат
+        # зависит от исходного изображения, поэтому кэш не используем
+        image_settings = settings.image_settings
+        result = await image_pipeline.submit(
+            user_id,
+            ImageRequest(
+                prompt=caption,
+                model=image_settings.model,
+                size=image_settings.size,
+                quality=image_settings.quality,
+                style=image_settings.style,
+                base_url=gpt_bot.client_pool.resolve_base_url(image_settings.base_url)
+            ),
+            lambda: gpt_bot.create_image(
+                prompt=caption,
+                base_url=image_settings.base_url,
+                model=image_settings.model,
+                size=image_settings.size,
+                quality=image_settings.quality,
+                style=image_settings.style,
+                hdr=image_settings.hdr,
+                reference_image_url=file.file_path
+            ),
+            use_cache=False
         )
         
         # Отправляем новое изображение
@@ -335,10 +425,16 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             message_id=initial_message.message_id
         )
         await update.message.reply_photo(
-            photo=image_url,
+            photo=result.photo,
             caption=f"🎨 Изображение изменено согласно описанию: {caption}"
         )
         
+    except ImageQueueFull:
+        await context.bot.edit_message_text(
+            chat_id=update.effective_chat.id,
+            message_id=initial_message.message_id,
+            text="⏳ У вас уже генерируются изображения. Дождитесь их завершения и повторите запрос."
+        )
     except Exception as e:
         logger.error(f"Ошибка при обработке изображения: {e}")
         await update.message.reply_text(
@@ -356,14 +452,14 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
     settings = settings_manager.get_user_settings(user_id)
     
     if query.data == "text_settings":
-        keyboard = create_text_settings_keyboard(settings.text_settings.dict())
+        keyboard = create_text_settings_keyboard(settings.text_settings)
         await query.edit_message_text(
             "📝 Настройки текстовой модели:",
             reply_markup=keyboard
         )
     
     elif query.data == "image_settings":
-        keyboard = create_image_settings_keyboard(settings.image_settings.dict())
+        keyboard = create_image_settings_keyboard(settings.image_settings)
         await query.edit_message_text(
             "🎨 Настройки модели изображений:",
             reply_markup=keyboard
@@ -390,7 +486,7 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text(
             "📥 Отправьте файл с настройками в формате JSON"
         )
-        context.user_data["waiting_for_settings"] = True
+        context.user_data[PENDING_INPUT] = INPUT_SETTINGS_FILE
     
     elif query.data == "close_settings":
         await query.delete_message()
@@ -428,11 +524,9 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
     
     if query.data == "change_text_model":
         models = settings.text_settings.available_models
-        current_model = settings.text_settings.effective_model
-        buttons = [[InlineKeyboardButton(f"{model} {'✓' if model == current_model else ''}", 
-                   callback_data=f"set_text_model_{model}")] for model in models]
-        buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="text_settings")])
-        keyboard = InlineKeyboardMarkup(buttons)
+        keyboard = create_choice_keyboard(
+            models, settings.text_settings.effective_model, "set_text_model_", "text_settings"
+        )
         await query.edit_message_text(
             "Выберите модель:\n\n"
             "gpt-4o-mini - базовая модель (по умолчанию)\n"
@@ -446,7 +540,7 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
         model = query.data.replace("set_text_model_", "")
         if model == "Custom Model":
             # Сохраняем состояние ожидания ввода пользовательской модели
-            context.user_data["waiting_for_custom_model"] = True
+            context.user_data[PENDING_INPUT] = INPUT_CUSTOM_MODEL
             await query.edit_message_text(
                 "Пожалуйста, введите название модели.\n"
                 "Например: gpt-3.5-turbo\n\n"
@@ -454,7 +548,7 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
             )
         else:
             settings_manager.update_text_settings(user_id, model=model)
-            keyboard = create_text_settings_keyboard(settings.text_settings.dict())
+            keyboard = create_text_settings_keyboard(settings.text_settings)
             await query.edit_message_text(
                 "📝 Настройки текстовой модели:",
                 reply_markup=keyboard
@@ -462,11 +556,10 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
     
     elif query.data == "change_temperature":
         temp_values = ["0.0", "0.3", "0.5", "0.7", "1.0", "1.5", "2.0"]
-        current_temp = str(settings.text_settings.temperature)
-        buttons = [[InlineKeyboardButton(f"🌡 {temp} {'✓' if temp == current_temp else ''}", 
-                   callback_data=f"set_temp_{temp}")] for temp in temp_values]
-        buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="text_settings")])
-        keyboard = InlineKeyboardMarkup(buttons)
+        keyboard = create_choice_keyboard(
+            temp_values, str(settings.text_settings.temperature), "set_temp_", "text_settings",
+            label_prefix="🌡 "
+        )
         await query.edit_message_text(
             "Выберите значение температуры:\n\n"
             "0.0 - наиболее предсказуемые ответы\n"
@@ -478,7 +571,7 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
     elif query.data.startswith("set_temp_"):
         temp = float(query.data.replace("set_temp_", ""))
         settings_manager.update_text_settings(user_id, temperature=temp)
-        keyboard = create_text_settings_keyboard(settings.text_settings.dict())
+        keyboard = create_text_settings_keyboard(settings.text_settings)
         await query.edit_message_text(
             "📝 Настройки текстовой модели:",
             reply_markup=keyboard
@@ -486,11 +579,10 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
     
     elif query.data == "change_max_tokens":
         token_values = ["500", "1000", "2000", "3000", "4000"]
-        current_tokens = str(settings.text_settings.max_tokens)
-        buttons = [[InlineKeyboardButton(f"📊 {token} {'✓' if token == current_tokens else ''}", 
-                   callback_data=f"set_tokens_{token}")] for token in token_values]
-        buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="text_settings")])
-        keyboard = InlineKeyboardMarkup(buttons)
+        keyboard = create_choice_keyboard(
+            token_values, str(settings.text_settings.max_tokens), "set_tokens_", "text_settings",
+            label_prefix="📊 "
+        )
         await query.edit_message_text(
             "Выберите максимальное количество токенов:\n\n"
             "500 - короткие ответы\n"
@@ -502,7 +594,7 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
     elif query.data.startswith("set_tokens_"):
         tokens = int(query.data.replace("set_tokens_", ""))
         settings_manager.update_text_settings(user_id, max_tokens=tokens)
-        keyboard = create_text_settings_keyboard(settings.text_settings.dict())
+        keyboard = create_text_settings_keyboard(settings.text_settings)
         await query.edit_message_text(
             "📝 Настройки текстовой модели:",
             reply_markup=keyboard
@@ -510,7 +602,7 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
     
     elif query.data == "change_base_url":
         # Сохраняем состояние ожидания ввода base_url
-        context.user_data["waiting_for_base_url"] = True
+        context.user_data[PENDING_INPUT] = INPUT_BASE_URL
         await query.edit_message_text(
             "Введите новый Base URL.\n\n"
             "По умолчанию: https://api.openai.com/v1\n\n"
@@ -521,16 +613,13 @@ async def handle_text_model_settings(update: Update, context: ContextTypes.DEFAU
 @check_user_access_decorator
 async def handle_custom_model_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ввода пользовательской модели."""
-    if not context.user_data.get("waiting_for_custom_model"):
-        return
-
     user_id = update.effective_user.id
     custom_model = update.message.text
 
     if custom_model.lower() == '/cancel':
-        context.user_data["waiting_for_custom_model"] = False
+        context.user_data.pop(PENDING_INPUT, None)
         keyboard = create_text_settings_keyboard(
-            settings_manager.get_user_settings(user_id).text_settings.dict()
+            settings_manager.get_user_settings(user_id).text_settings
         )
         await update.message.reply_text(
             "📝 Настройки текстовой модели:",
@@ -543,11 +632,11 @@ async def handle_custom_model_input(update: Update, context: ContextTypes.DEFAUL
         model="Custom Model",
         custom_model=custom_model
     )
-    context.user_data["waiting_for_custom_model"] = False
+    context.user_data.pop(PENDING_INPUT, None)
     
     keyboard = create_text_settings_keyboard(
-        settings_manager.get_user_settings(user_id).text_settings.dict()
-    )
+            settings_manager.get_user_settings(user_id).text_settings
+        )
     await update.message.reply_text(
         f"✅ Установлена пользовательская модель: {custom_model}\n\n"
         "📝 Настройки текстовой модели:",
@@ -565,11 +654,9 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     
     if query.data == "change_image_model":
         models = settings.image_settings.available_models
-        current_model = settings.image_settings.model
-        buttons = [[InlineKeyboardButton(f"{model} {'✓' if model == current_model else ''}", 
-                   callback_data=f"set_image_model_{model}")] for model in models]
-        buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="image_settings")])
-        keyboard = InlineKeyboardMarkup(buttons)
+        keyboard = create_choice_keyboard(
+            models, settings.image_settings.model, "set_image_model_", "image_settings"
+        )
         await query.edit_message_text(
             "Выберите модель:",
             reply_markup=keyboard
@@ -578,7 +665,7 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     elif query.data.startswith("set_image_model_"):
         model = query.data.replace("set_image_model_", "")
         settings_manager.update_image_settings(user_id, model=model)
-        keyboard = create_image_settings_keyboard(settings.image_settings.dict())
+        keyboard = create_image_settings_keyboard(settings.image_settings)
         await query.edit_message_text(
             "🎨 Настройки модели изображений:",
             reply_markup=keyboard
@@ -586,7 +673,7 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     
     elif query.data == "change_image_base_url":
         # Сохраняем состояние ожидания ввода base_url для изображений
-        context.user_data["waiting_for_image_base_url"] = True
+        context.user_data[PENDING_INPUT] = INPUT_IMAGE_BASE_URL
         await query.edit_message_text(
             "Введите новый Base URL для модели изображений.\n\n"
             "По умолчанию: https://api.openai.com/v1\n\n"
@@ -595,11 +682,9 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     
     elif query.data == "change_size":
         sizes = settings.image_settings.available_sizes
-        current_size = settings.image_settings.size
-        buttons = [[InlineKeyboardButton(f"{size} {'✓' if size == current_size else ''}", 
-                   callback_data=f"set_size_{size}")] for size in sizes]
-        buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="image_settings")])
-        keyboard = InlineKeyboardMarkup(buttons)
+        keyboard = create_choice_keyboard(
+            sizes, settings.image_settings.size, "set_size_", "image_settings"
+        )
         await query.edit_message_text(
             "Выберите размер изображения:\n\n"
             "1024x1024 - квадратное изображение\n"
@@ -611,7 +696,7 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     elif query.data.startswith("set_size_"):
         size = query.data.replace("set_size_", "")
         settings_manager.update_image_settings(user_id, size=size)
-        keyboard = create_image_settings_keyboard(settings.image_settings.dict())
+        keyboard = create_image_settings_keyboard(settings.image_settings)
         await query.edit_message_text(
             "🎨 Настройки модели изображений:",
             reply_markup=keyboard
@@ -619,11 +704,9 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     
     elif query.data == "change_quality":
         qualities = settings.image_settings.available_qualities
-        current_quality = settings.image_settings.quality
-        buttons = [[InlineKeyboardButton(f"{quality} {'✓' if quality == current_quality else ''}", 
-                   callback_data=f"set_quality_{quality}")] for quality in qualities]
-        buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="image_settings")])
-        keyboard = InlineKeyboardMarkup(buttons)
+        keyboard = create_choice_keyboard(
+            qualities, settings.image_settings.quality, "set_quality_", "image_settings"
+        )
         await query.edit_message_text(
             "Выберите качество изображения:\n\n"
             "standard - стандартное качество (быстрее)\n"
@@ -634,7 +717,7 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     elif query.data.startswith("set_quality_"):
         quality = query.data.replace("set_quality_", "")
         settings_manager.update_image_settings(user_id, quality=quality)
-        keyboard = create_image_settings_keyboard(settings.image_settings.dict())
+        keyboard = create_image_settings_keyboard(settings.image_settings)
         await query.edit_message_text(
             "🎨 Настройки модели изображений:",
             reply_markup=keyboard
@@ -642,11 +725,9 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     
     elif query.data == "change_style":
         styles = settings.image_settings.available_styles
-        current_style = settings.image_settings.style
-        buttons = [[InlineKeyboardButton(f"{style} {'✓' if style == current_style else ''}", 
-                   callback_data=f"set_style_{style}")] for style in styles]
-        buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="image_settings")])
-        keyboard = InlineKeyboardMarkup(buttons)
+        keyboard = create_choice_keyboard(
+            styles, settings.image_settings.style, "set_style_", "image_settings"
+        )
         await query.edit_message_text(
             "Выберите стиль изображения:\n\n"
             "natural - естественный, реалистичный стиль\n"
@@ -657,7 +738,7 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     elif query.data.startswith("set_style_"):
         style = query.data.replace("set_style_", "")
         settings_manager.update_image_settings(user_id, style=style)
-        keyboard = create_image_settings_keyboard(settings.image_settings.dict())
+        keyboard = create_image_settings_keyboard(settings.image_settings)
         await query.edit_message_text(
             "🎨 Настройки модели изображений:",
             reply_markup=keyboard
@@ -666,7 +747,7 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
     elif query.data == "toggle_hdr":
         current_hdr = settings.image_settings.hdr
         settings_manager.update_image_settings(user_id, hdr=not current_hdr)
-        keyboard = create_image_settings_keyboard(settings.image_settings.dict())
+        keyboard = create_image_settings_keyboard(settings.image_settings)
         await query.edit_message_text(
             "🎨 Настройки модели изображений:",
             reply_markup=keyboard
@@ -676,16 +757,13 @@ async def handle_image_model_settings(update: Update, context: ContextTypes.DEFA
 @check_user_access_decorator
 async def handle_image_base_url_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ввода base_url для модели изображений."""
-    if not context.user_data.get("waiting_for_image_base_url"):
-        return
-
     user_id = update.effective_user.id
     new_base_url = update.message.text
 
     if new_base_url.lower() == '/cancel':
-        context.user_data["waiting_for_image_base_url"] = False
+        context.user_data.pop(PENDING_INPUT, None)
         keyboard = create_image_settings_keyboard(
-            settings_manager.get_user_settings(user_id).image_settings.dict()
+            settings_manager.get_user_settings(user_id).image_settings
         )
         await update.message.reply_text(
             "🎨 Настройки модели изображений:",
@@ -702,11 +780,11 @@ async def handle_image_base_url_input(update: Update, context: ContextTypes.DEFA
         return
 
     settings_manager.update_image_settings(user_id, base_url=new_base_url)
-    context.user_data["waiting_for_image_base_url"] = False
+    context.user_data.pop(PENDING_INPUT, None)
     
     keyboard = create_image_settings_keyboard(
-        settings_manager.get_user_settings(user_id).image_settings.dict()
-    )
+            settings_manager.get_user_settings(user_id).image_settings
+        )
     await update.message.reply_text(
         f"✅ Установлен новый Base URL для модели изображений: {new_base_url}\n\n"
         "🎨 Настройки модели изображений:",
@@ -717,16 +795,13 @@ async def handle_image_base_url_input(update: Update, context: ContextTypes.DEFA
 @check_user_access_decorator
 async def handle_base_url_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ввода base_url для текстовой модели."""
-    if not context.user_data.get("waiting_for_base_url"):
-        return
-
     user_id = update.effective_user.id
     new_base_url = update.message.text
 
     if new_base_url.lower() == '/cancel':
-        context.user_data["waiting_for_base_url"] = False
+        context.user_data.pop(PENDING_INPUT, None)
         keyboard = create_text_settings_keyboard(
-            settings_manager.get_user_settings(user_id).text_settings.dict()
+            settings_manager.get_user_settings(user_id).text_settings
         )
         await update.message.reply_text(
             "📝 Настройки текстовой модели:",
@@ -743,11 +818,11 @@ async def handle_base_url_input(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     settings_manager.update_text_settings(user_id, base_url=new_base_url)
-    context.user_data["waiting_for_base_url"] = False
+    context.user_data.pop(PENDING_INPUT, None)
     
     keyboard = create_text_settings_keyboard(
-        settings_manager.get_user_settings(user_id).text_settings.dict()
-    )
+            settings_manager.get_user_settings(user_id).text_settings
+        )
     await update.message.reply_text(
         f"✅ Установлен новый Base URL для текстовой модели: {new_base_url}\n\n"
         "📝 Настройки текстовой модели:",
@@ -758,7 +833,7 @@ async def handle_base_url_input(update: Update, context: ContextTypes.DEFAULT_TY
 @check_user_access_decorator
 async def handle_settings_import(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик импорта настроек из JSON файла."""
-    if not context.user_data.get("waiting_for_settings"):
+    if context.user_data.get(PENDING_INPUT) != INPUT_SETTINGS_FILE:
         return
 
     try:
@@ -810,7 +885,37 @@ async def handle_settings_import(update: Update, context: ContextTypes.DEFAULT_T
         )
     finally:
         # Сбрасываем состояние ожидания
-        context.user_data["waiting_for_settings"] = False 
+        context.user_data.pop(PENDING_INPUT, None) 
+
+# Обработчики текстового ввода по ожидаемому вводу пользователя
+PENDING_INPUT_HANDLERS = {
+    INPUT_CUSTOM_MODEL: handle_custom_model_input,
+    INPUT_BASE_URL: handle_base_url_input,
+    INPUT_IMAGE_BASE_URL: handle_image_base_url_input,
+}
+
+async def route_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Единая точка входа для текстовых сообщений.
+
+    Если в личном чате бот ждет ввода из меню настроек, сообщение
+    передается обработчику этого ввода, иначе - запросом к модели.
+    """
+    if update.effective_chat.type == 'private':
+        handler = PENDING_INPUT_HANDLERS.get(context.user_data.get(PENDING_INPUT))
+        if handler is not None:
+            return await handler(update, context)
+    return await handle_text(update, context)
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /cancel: отмена ожидаемого ввода."""
+    pending = context.user_data.get(PENDING_INPUT)
+    handler = PENDING_INPUT_HANDLERS.get(pending)
+    if handler is not None:
+        # Обработчик ввода сам возвращает пользователя в меню настроек
+        return await handler(update, context)
+    context.user_data.pop(PENDING_INPUT, None)
+    await update.message.reply_text("✅ Ввод отменен" if pending else "ℹ️ Нечего отменять")
 
 @check_user_access_decorator
 async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -850,6 +955,7 @@ def is_admin(user_id: int) -> bool:
 
 def admin_required(func):
     """Декоратор для проверки прав администратора."""
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user_id = update.effective_user.id
         if not is_admin(user_id):
@@ -863,8 +969,13 @@ def admin_required(func):
 @admin_required
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает статистику использования бота."""
-    total_users = len(settings_manager.users)
-    total_messages = sum(len(settings.message_history) for settings in settings_manager.users.values())
+    try:
+        total_users = len(settings_manager.user_ids())
+        # Подсчет выполняет хранилище, без обхода истории каждого пользователя
+        total_messages = await asyncio.to_thread(settings_manager.storage.count_messages)
+    except Exception as e:
+        logger.error(f"Ошибка при подсчете статистики: {e}")
+        total_users, total_messages = len(settings_manager.users), "неизвестно"
     
     stats_text = (
         "📊 Статистика бота:\n\n"
@@ -872,6 +983,9 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         f"💬 Всего сообщений: {total_messages}\n"
         f"🕒 Бот работает с: {context.bot_data.get('start_time', 'неизвестно')}"
     )
+    summary = metrics.summary()
+    if summary:
+        stats_text += "\n\n" + summary
     await update.message.reply_text(stats_text)
 
 @admin_required
@@ -880,49 +994,53 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if len(context.args) == 0:
         await update.message.reply_text(
             "Пожалуйста, добавьте текст сообщения после команды.\n"
-            "Пример: /broadcast Технические работы сегодня в 18:00"
+            "Пример: /broadcast Технические работы сегодня в 18:00\n\n"
+            "/broadcast stop - остановить текущую рассылку\n"
+            "/broadcast resume - продолжить прерванную рассылку"
         )
         return
     
-    broadcast_message = " ".join(context.args)
-    success_count = 0
-    fail_count = 0
-    sender_id = update.effective_user.id
+    subcommand = context.args[0].lower() if len(context.args) == 1 else None
     
-    # Отправляем сообщение всем пользователям
-    for user_id in settings_manager.users:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"📢 Сообщение от администратора:\n\n{broadcast_message}"
-            )
-            success_count += 1
-            logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-            fail_count += 1
-    
-    # Отправляем отчет о результатах
-    report = (
-        f"✅ Сообщение отправлено {success_count} пользователям\n"
-        f"❌ Не удалось отправить {fail_count} пользователям\n\n"
-        f"📝 Текст сообщения:\n{broadcast_message}"
-    )
+    if subcommand == "stop":
+        if broadcaster.cancel():
+            await update.message.reply_text("⏹ Рассылка будет остановлена. Продолжить: /broadcast resume")
+        else:
+            await update.message.reply_text("ℹ️ Сейчас нет активной рассылки")
+        return
     
-    try:
-        # Отправляем отчет в чат, где была вызвана команда
-        await update.message.reply_text(report)
-        logger.info(f"Отчет о рассылке отправлен в чат {update.effective_chat.id}")
-    except Exception as e:
-        logger.error(f"Ошибка при отправке отчета в чат {update.effective_chat.id}: {e}")
-        # Пробуем отправить отчет администратору лично
-        try:
-            await context.bot.send_message(
-                chat_id=sender_id,
-                text=f"❌ Не удалось отправить отчет в чат, но вот результаты:\n\n{report}"
+    if broadcaster.is_running:
+        await update.message.reply_text(
+            "ℹ️ Рассылка уже выполняется. Остановить: /broadcast stop"
+        )
+        return
+    
+    if subcommand == "resume":
+        job = broadcaster.resume(context.application)
+        if job is None:
+            await update.message.reply_text("ℹ️ Нет прерванной рассылки")
+        else:
+            logger.info(f"Продолжена рассылка с позиции {job.cursor} из {len(job.recipients)}")
+            await update.message.reply_text(
+                f"▶️ Рассылка продолжена с позиции {job.cursor} из {len(job.recipients)}"
             )
-        except Exception as e2:
-            logger.error(f"Не удалось отправить отчет администратору {sender_id}: {e2}")
+        return
+    
+    broadcast_message = " ".join(context.args)
+    recipients = settings_manager.user_ids()
+    
+    # Статусное сообщение обновляется по ходу рассылки
+    status_message = await update.message.reply_text(
+        f"📢 Рассылка: 0/{len(recipients)}"
+    )
+    job = BroadcastJob(
+        text=f"📢 Сообщение от администратора:\n\n{broadcast_message}",
+        recipients=recipients,
+        report_chat_id=update.effective_chat.id,
+        status_message_id=status_message.message_id
+    )
+    broadcaster.start(context.application, job)
+    logger.info(f"Запущена рассылка для {len(recipients)} пользователей")
 
 @admin_required
 async def logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -973,38 +1091,17 @@ async def manage_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
     command = update.message.text.split()[0][1:]  # Получаем имя команды без /
     logger.debug(f"Вызвана команда управления пользователями: {command}")
     
-    def load_users() -> list:
-        """Загружает список разрешенных пользователей из файла."""
-        try:
-            if os.path.exists('allowed_users.json'):
-                with open('allowed_users.json', 'r') as f:
-                    return json.load(f)
-            return []
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке списка пользователей: {e}")
-            return []
-    
-    def save_users(users: list) -> None:
-        """Сохраняет список разрешенных пользователей в файл."""
-        try:
-            with open('allowed_users.json', 'w') as f:
-                json.dump(users, f)
-            logger.info("Список пользователей успешно сохранен")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении списка пользователей: {e}")
-    
-    # Загружаем текущий список пользователей
-    allowed_users = load_users()
-    logger.debug(f"Загруженный список пользователей: {allowed_users}")
+    allowed_users = access_control.users
     
     if command == "listusers":
-        if not allowed_users:
+        user_ids = allowed_users.list()
+        if not user_ids:
             await update.message.reply_text("📋 Список разрешенных пользователей пуст")
             logger.debug("Отправлено сообщение: список пользователей пуст")
         else:
-            users_list = "📋 Список разрешенных пользователей:\n\n" + "\n".join(allowed_users)
+            users_list = "📋 Список разрешенных пользователей:\n\n" + "\n".join(map(str, user_ids))
             await update.message.reply_text(users_list)
-            logger.debug(f"Отправлен список пользователей: {users_list}")
+            logger.debug(f"Отправлен список пользователей: {len(user_ids)} записей")
         return
     
     if not context.args:
@@ -1023,18 +1120,14 @@ async def manage_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
             await update.message.reply_text("❌ ID пользователя должен быть числом")
             return
         
-        if user_id not in allowed_users:
-            allowed_users.append(user_id)
-            save_users(allowed_users)
+        if allowed_users.add(int(user_id)):
             logger.info(f"Добавлен новый пользователь: {user_id}")
             await update.message.reply_text(f"✅ Пользователь {user_id} добавлен")
         else:
             await update.message.reply_text("ℹ️ Этот пользователь уже в списке разрешенных")
     
     elif command == "removeuser":
-        if user_id in allowed_users:
-            allowed_users.remove(user_id)
-            save_users(allowed_users)
+        if user_id.isdigit() and allowed_users.remove(int(user_id)):
             logger.info(f"Удален пользователь: {user_id}")
             await update.message.reply_text(f"✅ Пользователь {user_id} удален")
         else:
@@ -1043,44 +1136,23 @@ async def manage_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         await update.message.reply_text("❌ Неизвестная команда")
 
-def load_groups() -> list:
-    """Загружает список разрешенных групп из файла."""
-    try:
-        if os.path.exists('allowed_groups.json'):
-            with open('allowed_groups.json', 'r') as f:
-                return json.load(f)
-        return []
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке списка групп: {e}")
-        return []
-
-def save_groups(groups: list) -> None:
-    """Сохраняет список разрешенных групп в файл."""
-    try:
-        with open('allowed_groups.json', 'w') as f:
-            json.dump(groups, f)
-        logger.info("Список групп успешно сохранен")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении списка групп: {e}")
-
 @admin_required
 async def manage_groups_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Управление списком разрешенных групп."""
     command = update.message.text.split()[0][1:]  # Получаем имя команды без /
     logger.debug(f"Вызвана команда управления группами: {command}")
     
-    # Загружаем список разрешенных групп из файла
-    allowed_groups = load_groups()
-    logger.debug(f"Загруженный список групп: {allowed_groups}")
+    allowed_groups = access_control.groups
     
     if command == "listgroups":
-        if not allowed_groups:
+        group_ids = allowed_groups.list()
+        if not group_ids:
             await update.message.reply_text("📋 Список разрешенных групп пуст")
             logger.debug("Отправлено сообщение: список групп пуст")
         else:
-            groups_list = "📋 Список разрешенных групп:\n\n" + "\n".join(allowed_groups)
+            groups_list = "📋 Список разрешенных групп:\n\n" + "\n".join(map(str, group_ids))
             await update.message.reply_text(groups_list)
-            logger.debug(f"Отправлен список групп: {groups_list}")
+            logger.debug(f"Отправлен список групп: {len(group_ids)} записей")
         return
     
     if not context.args:
@@ -1095,22 +1167,18 @@ async def manage_groups_command(update: Update, context: ContextTypes.DEFAULT_TY
     group_id = context.args[0]
     
     if command == "addgroup":
-        if not group_id.startswith('-100'):
+        if not group_id.startswith('-100') or not group_id[1:].isdigit():
             await update.message.reply_text("❌ ID группы должен начинаться с -100")
             return
         
-        if group_id not in allowed_groups:
-            allowed_groups.append(group_id)
-            save_groups(allowed_groups)
+        if allowed_groups.add(int(group_id)):
             logger.info(f"Добавлена новая группа: {group_id}")
             await update.message.reply_text(f"✅ Группа {group_id} добавлена")
         else:
             await update.message.reply_text("ℹ️ Эта группа уже в списке разрешенных")
     
     elif command == "removegroup":
-        if group_id in allowed_groups:
-            allowed_groups.remove(group_id)
-            save_groups(allowed_groups)
+        if group_id.lstrip('-').isdigit() and allowed_groups.remove(int(group_id)):
             logger.info(f"Удалена группа: {group_id}")
             await update.message.reply_text(f"✅ Группа {group_id} удалена")
         else:
@@ -1125,18 +1193,19 @@ async def restart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text("🔄 Перезапуск бота...")
     logger.info("Получена команда перезапуска от администратора")
     
+    # Прерываем текущую рассылку - ее можно будет продолжить после перезапуска
+    broadcaster.cancel()
+    
     # Отправляем сообщение всем пользователям
-    for user_id in settings_manager.users:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="🔄 Бот перезапускается для обновления. Пожалуйста, подождите несколько минут."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+    await broadcaster.notify_all(
+        context.bot,
+        settings_manager.user_ids(),
+        "🔄 Бот перезапускается для обновления. Пожалуйста, подождите несколько минут."
+    )
     
-    # Сохраняем все настройки
-    settings_manager.save_settings()
+    # Записываем накопленные изменения настроек и истории, дождавшись
+    # фоновой записи: os.execl прервал бы ее на середине
+    await settings_manager.drain()
     
     # Перезапускаем программу
     os.execl(sys.executable, sys.executable, *sys.argv)
@@ -1153,46 +1222,35 @@ async def maintenance_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     mode = context.args[0].lower()
-    maintenance_file = "maintenance_mode"
     
     if mode == "on":
         # Включаем режим обслуживания
-        with open(maintenance_file, 'w') as f:
-            f.write('1')
+        maintenance_flag.set(True)
         
-        # Отправляем сообщение всем пользователям
-        for user_id in settings_manager.users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="🛠 Бот переходит в режим обслуживания. Некоторые функции могут быть недоступны."
-                )
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+        # Отправляем сообщение всем пользователям в фоне
+        context.application.create_task(broadcaster.notify_all(
+            context.bot,
+            settings_manager.user_ids(),
+            "🛠 Бот переходит в режим обслуживания. Некоторые функции могут быть недоступны."
+        ))
         
         await update.message.reply_text("✅ Режим обслуживания включен")
         logger.info("Включен режим обслуживания")
     
     else:
         # Выключаем режим обслуживания
-        try:
-            os.remove(maintenance_file)
-        except FileNotFoundError:
-            pass
+        maintenance_flag.set(False)
         
-        # Отправляем сообщение всем пользователям
-        for user_id in settings_manager.users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="✅ Бот вернулся к нормальной работе."
-                )
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+        # Отправляем сообщение всем пользователям в фоне
+        context.application.create_task(broadcaster.notify_all(
+            context.bot,
+            settings_manager.user_ids(),
+            "✅ Бот вернулся к нормальной работе."
+        ))
         
         await update.message.reply_text("✅ Режим обслуживания выключен")
         logger.info("Выключен режим обслуживания")
 
 def check_maintenance_mode() -> bool:
     """Проверяет, включен ли режим обслуживания."""
-    return os.path.exists("maintenance_mode") 
\ No newline at end of file
+    return maintenance_flag.is_set() 
\ No newline at end of file
@@ -0,0 +1,206 @@
+import os
+import sys
+import zlib
+from collections.abc import MutableSequence
+from typing import Iterable, Union
+
+# Максимальное количество сообщений в истории пользователя (0 - без ограничения)
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', '200'))
+# Сколько последних сообщений хранить несжатыми; текст более старых
+# сжимается zlib (0 - не сжимать)
+HISTORY_HOT_MESSAGES = int(os.getenv('HISTORY_HOT_MESSAGES', '20'))
+# Сообщения короче этого размера не сжимаются: выигрыш меньше накладных расходов
+COMPRESS_MIN_CHARS = 256
+
+# Примерный размер объекта Message без текста (байты)
+_MESSAGE_OVERHEAD = sys.getsizeof(object()) + 3 * 8
+
+
+class Message:
+    """
+    Сообщение истории.
+
+    Занимает меньше памяти, чем словарь: атрибуты хранятся в слотах,
+    а строки ролей общие для всех сообщений. Текст старых сообщений может
+    храниться сжатым и распаковывается только при чтении. Поддерживает
+    чтение как словарь (message["content"], message.get("role")).
+    """
+
+    __slots__ = ("role", "_content", "tokens")
+
+    def __init__(self, role: str, content: Union[str, bytes]):
+        self.role = sys.intern(role)
+        self._content = content
+        # (токенизатор, количество токенов), заполняет ContextWindowBuilder:
+        # для подсчета не нужно распаковывать текст
+        self.tokens = None
+
+    @classmethod
+    def coerce(cls, message: Union["Message", dict]) -> "Message":
+        if isinstance(message, Message):
+            return message
+        return cls(message["role"], message["content"])
+
+    @property
+    def content(self) -> str:
+        if isinstance(self._content, bytes):
+            return zlib.decompress(self._content).decode('utf-8')
+        return self._content
+
+    @property
+    def compressed(self) -> bool:
+        return isinstance(self._content, bytes)
+
+    @property
+    def nbytes(self) -> int:
+        return _MESSAGE_OVERHEAD + sys.getsizeof(self._content)
+
+    def compress(self) -> int:
+        """Сжимает текст, если это выгодно. Возвращает изменение размера в байтах."""
+        if self.compressed or len(self._content) < COMPRESS_MIN_CHARS:
+            return 0
+        before = sys.getsizeof(self._content)
+        packed = zlib.compress(self._content.encode('utf-8'))
+        if sys.getsizeof(packed) >= before:
+            return 0
+        self._content = packed
+        return sys.getsizeof(packed) - before
+
+    def __getitem__(self, key: str) -> str:
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Message, dict)):
+            return self.role == other["role"] and self.content == other["content"]
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Message({self.role!r}, {self.content[:40]!r})"
+
+
+def message_dict(message: Union[Message, dict]) -> dict:
+    """Возвращает сообщение в виде словаря для API и хранилища."""
+    return message.to_dict() if isinstance(message, Message) else message
+
+
+class MessageHistory(MutableSequence):
+    """
+    История сообщений пользователя.
+
+    Хранит не больше max_messages последних сообщений. Сообщения старше
+    hot_messages последних сжимаются по одному в момент, когда выходят из
+    "горячего" окна, поэтому добавление сообщения остается O(1), а при
+    сборке контекста распаковываются только действительно нужные.
+    """
+
+    def __init__(
+        self,
+        messages: Iterable[Union[Message, dict]] = (),
+        max_messages: int = HISTORY_MAX_MESSAGES,
+        hot_messages: int = HISTORY_HOT_MESSAGES
+    ):
+        self.max_messages = max_messages
+        self.hot_messages = hot_messages
+        self._items: list[Message] = []
+        self.nbytes = 0
+        self.extend(messages)
+
+    @classmethod
+    def coerce(cls, value) -> "MessageHistory":
+        """Создает историю из списка словарей (валидатор pydantic)."""
+        if isinstance(value, MessageHistory):
+            return value
+        return cls(value or ())
+
+    def to_dicts(self) -> list[dict]:
+        return [message.to_dict() for message in self._items]
+
+    def _compress_aged(self, count: int):
+        """Сжимает сообщения, вышедшие из горячего окна после добавления count новых."""
+        if not self.hot_messages:
+            return
+        end = len(self._items) - self.hot_messages
+        for message in self._items[max(0, end - count):max(0, end)]:
+            self.nbytes += message.compress()
+
+    def _enforce_cap(self):
+        excess = len(self._items) - self.max_messages if self.max_messages else 0
+        if excess > 0:
+            self.nbytes -= sum(message.nbytes for message in self._items[:excess])
+            del self._items[:excess]
+
+    def append(self, message: Union[Message, dict]):
+        message = Message.coerce(message)
+        self._items.append(message)
+        self.nbytes += message.nbytes
+        self._compress_aged(1)
+        self._enforce_cap()
+
+    def extend(self, messages: Iterable[Union[Message, dict]]):
+        added = [Message.coerce(message) for message in messages]
+        if not added:
+            return
+        self._items.extend(added)
+        self.nbytes += sum(message.nbytes for message in added)
+        self._enforce_cap()
+        self._compress_aged(len(added))
+
+    def insert(self, index: int, message: Union[Message, dict]):
+        message = Message.coerce(message)
+        self._items.insert(index, message)
+        self.nbytes += message.nbytes
+        self._enforce_cap()
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __reversed__(self):
+        return reversed(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            if index == slice(None):
+                # Полная замена истории (например, после слияния с хранилищем)
+                self.clear()
+                self.extend(value)
+                return
+            value = [Message.coerce(message) for message in value]
+        else:
+            value = Message.coerce(value)
+        self._items[index] = value
+        self.nbytes = sum(message.nbytes for message in self._items)
+
+    def __delitem__(self, index):
+        del self._items[index]
+        self.nbytes = sum(message.nbytes for message in self._items)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (MessageHistory, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"MessageHistory({len(self)} сообщений, {self.nbytes} байт)"
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, NamedTuple, Optional, Union
+from loguru import logger
+
+# Максимум одновременных запросов к API генерации изображений
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '4'))
+# Максимум запросов одного пользователя в очереди и в работе
+IMAGE_QUEUE_PER_USER = int(os.getenv('IMAGE_QUEUE_PER_USER', '2'))
+# Размер кэша file_id сгенерированных изображений
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', '1000'))
+
+
+class ImageQueueFull(Exception):
+    """У пользователя слишком много запросов на генерацию в очереди."""
+
+
+class ImageRequest(NamedTuple):
+    prompt: str
+    model: str
+    size: str
+    quality: str
+    style: str
+    # Фактический base_url API: одинаковые параметры у разных провайдеров
+    # дают разные изображения
+    base_url: str
+
+    @property
+    def cache_key(self) -> str:
+        """Адрес изображения в кэше: хэш от параметров генерации."""
+        raw = "\x1f".join((self.prompt.strip(), self.model, self.size, self.quality, self.style, self.base_url))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ImageResult(NamedTuple):
+    # file_id из Telegram, байты изображения или URL
+    photo: Union[str, bytes]
+    cached: bool
+
+
+class ImagePipeline:
+    """
+    Очередь генерации изображений.
+
+    Ограничивает число одновременных запросов к API и глубину очереди
+    каждого пользователя. Одинаковые запросы, выполняющиеся одновременно,
+    объединяются. Для уже сгенерированных изображений хранится file_id
+    Telegram, поэтому повторный запрос отправляется сразу, без обращения
+    к API.
+    """
+
+    def __init__(
+        self,
+        workers: int = IMAGE_WORKERS,
+        queue_per_user: int = IMAGE_QUEUE_PER_USER,
+        cache_size: int = IMAGE_CACHE_SIZE
+    ):
+        self.workers = workers
+        self.queue_per_user = queue_per_user
+        self.cache_size = cache_size
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._user_queue: dict[int, int] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def get_cached(self, request: ImageRequest) -> Optional[str]:
+        """Возвращает file_id ранее отправленного изображения."""
+        file_id = self._cache.get(request.cache_key)
+        if file_id is not None:
+            self._cache.move_to_end(request.cache_key)
+        return file_id
+
+    def remember(self, request: ImageRequest, file_id: str):
+        """Сохраняет file_id отправленного изображения."""
+        self._cache[request.cache_key] = file_id
+        self._cache.move_to_end(request.cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def submit(
+        self,
+        user_id: int,
+        request: ImageRequest,
+        generate: Callable[[], Awaitable[Union[str, bytes]]],
+        use_cache: bool = True
+    ) -> ImageResult:
+        """
+        Возвращает изображение из кэша или ставит генерацию в очередь.
+
+        Args:
+            user_id: ID пользователя
+            request: Параметры генерации
+            generate: Корутина-функция, выполняющая запрос к API
+            use_cache: Использовать ли кэш и объединение одинаковых запросов
+
+        Raises:
+            ImageQueueFull: Если у пользователя слишком много запросов
+        """
+        if use_cache:
+            file_id = self.get_cached(request)
+            if file_id is not None:
+                self.cache_hits += 1
+                logger.debug(f"Изображение для пользователя {user_id} взято из кэша")
+                return ImageResult(file_id, True)
+            self.cache_misses += 1
+
+        if self._user_queue.get(user_id, 0) >= self.queue_per_user:
+            raise ImageQueueFull()
+
+        self._user_queue[user_id] = self._user_queue.get(user_id, 0) + 1
+        try:
+            key = request.cache_key
+            if use_cache and key in self._in_flight:
+                # Такое же изображение уже генерируется - ждем его результат
+                return ImageResult(await asyncio.shield(self._in_flight[key]), False)
+
+            future = asyncio.get_running_loop().create_future()
+            if use_cache:
+                self._in_flight[key] = future
+            try:
+                if self._semaphore is None:
+                    self._semaphore = asyncio.Semaphore(self.workers)
+                async with self._semaphore:
+                    photo = await generate()
+                future.set_result(photo)
+                return ImageResult(photo, False)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # Помечаем исключение как полученное, чтобы asyncio не
+                # предупреждал о нем, если одинаковых запросов не было
+                future.exception()
+                raise
+            finally:
+                if use_cache:
+                    self._in_flight.pop(key, None)
+        finally:
+            self._user_queue[user_id] -= 1
+            if not self._user_queue[user_id]:
+                del self._user_queue[user_id]
+
+    def queued(self) -> int:
+        """Количество запросов в очереди и в работе."""
+        return sum(self._user_queue.values())
+
+    def stats(self) -> dict:
+        return {
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_size": len(self._cache),
+            "in_flight": len(self._in_flight)
+        }
+
+
+image_pipeline = ImagePipeline()
@@ -0,0 +1,194 @@
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import traceback
+import zlib
+from datetime import timedelta
+from loguru import logger
+
+# Формат записей: по умолчанию читаемый текст, LOG_JSON=true - одна
+# JSON-запись на строку для систем сбора логов
+LOG_JSON = os.getenv('LOG_JSON', 'False').lower() == 'true'
+# Запись логов в фоновом потоке: обработчики не ждут записи в файл и stderr
+# (записи форматируются в вызывающем потоке, в фоне только пишутся)
+LOG_ENQUEUE = os.getenv('LOG_ENQUEUE', 'True').lower() == 'true'
+# Доля запросов, отладочные записи которых попадают в лог (1 - все)
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1.0'))
+
+# Время подставляется через strftime: форматирование {time:...} в loguru
+# занимает около половины времени записи
+TEXT_FORMAT = (
+    "<green>{extra[time]}</green> | <level>{level: <8}</level> | "
+    "<magenta>{extra[request_id]}</magenta> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>\n{exception}"
+)
+# Значение request_id вне обработки апдейта
+NO_REQUEST = "-"
+DEBUG_LEVEL = logger.level("DEBUG").no
+# Максимум записей в одной операции записи фонового потока
+BACKGROUND_BATCH = 1000
+# Размер файла лога, после которого начинается новый файл (байт)
+LOG_ROTATION_BYTES = 500 * 1000 * 1000
+
+
+def text_format(record) -> str:
+    """Формат loguru: читаемая строка с request_id."""
+    record["extra"]["time"] = record["time"].strftime("%Y-%m-%d %H:%M:%S")
+    return TEXT_FORMAT
+
+
+def json_format(record) -> str:
+    """Формат loguru: запись лога одной строкой JSON."""
+    entry = {
+        "time": record["time"].isoformat(timespec="milliseconds"),
+        "level": record["level"].name,
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "message": record["message"],
+    }
+    for key, value in record["extra"].items():
+        if key not in ("json", "time") and value is not None and value != NO_REQUEST:
+            entry[key] = value
+    if record["exception"] is not None:
+        error_type, error, tb = record["exception"]
+        entry["exception"] = "".join(traceback.format_exception(error_type, error, tb))
+    record["extra"]["json"] = json.dumps(entry, ensure_ascii=False, default=str)
+    return "{extra[json]}\n"
+
+
+class DebugSampler:
+    """
+    Фильтр loguru, пропускающий долю отладочных записей.
+
+    Решение принимается по request_id, поэтому отладочные записи одного
+    запроса попадают в лог все вместе или не попадают совсем. Записи вне
+    запросов выбираются случайно, записи уровня INFO и выше не фильтруются.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.threshold = int(rate * 0x100000000)
+        self.random = random.Random()
+
+    def __call__(self, record) -> bool:
+        if record["level"].no > DEBUG_LEVEL:
+            return True
+        request_id = record["extra"].get("request_id", NO_REQUEST)
+        if request_id == NO_REQUEST:
+            return self.random.random() < self.rate
+        return zlib.crc32(str(request_id).encode()) < self.threshold
+
+
+class BackgroundSink:
+    """
+    Sink loguru, который пишет записи в фоновом потоке.
+
+    Вызывающий поток только кладет отформатированную запись в очередь;
+    фоновый поток забирает накопившиеся записи и пишет их в target одной
+    операцией. Используется для stderr: enqueue=True в loguru передает
+    записи через канал между процессами, и когда сборщик логов не успевает
+    читать stderr, канал заполняется и запись блокирует обработчики.
+    """
+
+    def __init__(self, target, name: str = "log-writer"):
+        self.target = target
+        self._flush = getattr(target, "flush", None)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def isatty(self) -> bool:
+        # По нему loguru решает, раскрашивать ли вывод
+        isatty = getattr(self.target, "isatty", None)
+        return bool(isatty and isatty())
+
+    def write(self, message: str):
+        self._queue.put(message)
+
+    def stop(self):
+        """Дописывает очередь и останавливает поток (вызывается loguru при remove)."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < BACKGROUND_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                self.target.write("".join(batch))
+                if self._flush is not None:
+                    self._flush()
+            except Exception:
+                traceback.print_exc(file=sys.__stderr__)
+
+
+def setup_logging(
+    debug: bool = False,
+    json_logs: bool = LOG_JSON,
+    enqueue: bool = LOG_ENQUEUE,
+    debug_sample_rate: float = LOG_DEBUG_SAMPLE_RATE
+):
+    """
+    Настраивает обработчики loguru: файл в logs/ и stderr.
+
+    Файл пишет sink loguru (при enqueue - в фоновом потоке), stderr -
+    BackgroundSink. Ротирует файл только основной процесс:
+    процессы-обработчики webhook (запускаются через spawn и настраивают
+    логи заново) дописывают в тот же файл и открывают его заново после
+    ротации (watch=True), иначе каждый процесс переименовывал бы общий
+    файл сам.
+    """
+    logger.remove()  # Удаляем стандартный обработчик
+    logger.configure(extra={"request_id": NO_REQUEST})
+    log_format = json_format if json_logs else text_format
+    log_filter = DebugSampler(debug_sample_rate) if debug and debug_sample_rate < 1 else None
+    level = "DEBUG" if debug else "INFO"
+    retention = timedelta(days=10 if debug else 30)
+    file_path = "logs/debug.log" if debug else "logs/production.log"
+
+    if multiprocessing.parent_process() is None:
+        file_options = dict(rotation=LOG_ROTATION_BYTES, compression="zip", retention=retention)
+    else:
+        # Процесс-обработчик webhook
+        file_options = dict(watch=True)
+    logger.add(file_path, format=log_format, level=level, filter=log_filter, enqueue=enqueue, **file_options)
+    stderr_sink = BackgroundSink(sys.stderr, name="log-stderr") if enqueue else sys.stderr
+    logger.add(stderr_sink, format=log_format, level=level, filter=log_filter)
+
+    # Создаем директорию для логов, если её нет
+    os.makedirs("logs", exist_ok=True)
+
+
+def with_request_id(func):
+    """
+    Оборачивает обработчик апдейтов: все записи лога при его выполнении,
+    включая запросы к OpenAI и правки сообщений, получают request_id
+    (номер апдейта Telegram) и user_id.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(update, *args, **kwargs):
+        request_id = getattr(update, "update_id", None)
+        user = getattr(update, "effective_user", None)
+        with logger.contextualize(
+            request_id=NO_REQUEST if request_id is None else request_id,
+            user_id=getattr(user, "id", None)
+        ):
+            return await func(update, *args, **kwargs)
+    return wrapper
@@ -1,4 +1,5 @@
 from bot import GPTBot
+from settings import settings_manager
 from loguru import logger
 import os
 import signal
@@ -57,6 +58,9 @@ def initialize_allowed_groups():
 def signal_handler(signum, frame):
     """Обработчик сигналов для корректного завершения."""
     logger.info(f"Получен сигнал {signum}, завершаем работу...")
+    # Записываем накопленные изменения настроек перед выходом; flush()
+    # дожидается записи, которая уже идет в фоновом потоке
+    settings_manager.flush()
     sys.exit(0)
 
 def main():
@@ -80,6 +84,11 @@ def main():
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}")
         sys.exit(1)
+    finally:
+        # run_polling сам обрабатывает SIGINT/SIGTERM, поэтому сохраняем
+        # изменения и после его штатного завершения (в том числе дожидаемся
+        # фоновой записи, если event loop остановлен посреди нее)
+        settings_manager.flush()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,500 @@
+import asyncio
+import bisect
+import functools
+import os
+import time
+from typing import Callable, Optional
+from loguru import logger
+
+# Порт HTTP-сервера с метриками в формате Prometheus. По умолчанию сервер
+# не запускается: стандартные порты экспортеров (9100 и др.) на хостах с
+# мониторингом обычно заняты
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Адрес сервера метрик: по умолчанию доступен только локально
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PATH = '/metrics'
+# Как часто измерять задержку event loop (секунды)
+LOOP_LAG_INTERVAL = 0.5
+
+# Границы корзин гистограмм длительности (секунды)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Границы корзин для количества правок одного ответа
+EDIT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+# Границы корзин задержки event loop (секунды)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple([labels.get(name, "") for name in self.labelnames]) if labels else ()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+            *self._samples()
+        ])
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def items(self) -> list[tuple[tuple, float]]:
+        return list(self._values.items())
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    """
+    Текущее значение.
+
+    Значения можно задавать явно (set) или получать при сборе метрик от
+    функций, зарегистрированных через track - так отслеживается глубина
+    очередей без накладных расходов в самих очередях.
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._functions: dict[tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def track(self, function: Callable[[], float], **labels):
+        """Регистрирует функцию, возвращающую значение при сборе метрик."""
+        self._functions[self._key(labels)] = function
+
+    def items(self) -> list[tuple[tuple, float]]:
+        values = dict(self._values)
+        for key, function in self._functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logger.debug(f"Не удалось получить значение метрики {self.name}{key}: {e}")
+        return list(values.items())
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self.items()
+        ]
+
+
+class _HistogramState:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """Распределение значений по фиксированным корзинам."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._states: dict[tuple, _HistogramState] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _HistogramState(len(self.buckets) + 1)
+        # Корзина хранит количество значений только в своем интервале,
+        # накопленные суммы считаются при выводе
+        state.counts[bisect.bisect_left(self.buckets, value)] += 1
+        state.sum += value
+        state.count += 1
+
+    def count(self, **labels) -> int:
+        state = self._states.get(self._key(labels))
+        return state.count if state else 0
+
+    def mean(self, **labels) -> Optional[float]:
+        state = self._states.get(self._key(labels))
+        return state.sum / state.count if state and state.count else None
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Оценивает квантиль линейной интерполяцией внутри корзины."""
+        state = self._states.get(self._key(labels))
+        if not state or not state.count:
+            return None
+        rank = q * state.count
+        cumulative = 0
+        for index, count in enumerate(state.counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for key, state in self._states.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(state.sum)}")
+            samples.append(f"{self.name}_count{labels} {state.count}")
+        return samples
+
+
+class MetricsRegistry:
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DURATION_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+handler_calls = registry.counter(
+    "bot_handler_calls_total", "Вызовы обработчиков апдейтов", ("handler", "status"))
+handler_duration = registry.histogram(
+    "bot_handler_duration_seconds", "Время работы обработчиков апдейтов", ("handler",))
+openai_first_token = registry.histogram(
+    "bot_openai_time_to_first_token_seconds", "Время от запроса до первого токена ответа модели")
+openai_stream_duration = registry.histogram(
+    "bot_openai_stream_duration_seconds", "Полное время потоковой генерации ответа")
+openai_request_duration = registry.histogram(
+    "bot_openai_request_duration_seconds", "Время непотоковых запросов к OpenAI", ("kind",))
+openai_errors = registry.counter(
+    "bot_openai_errors_total", "Ошибки запросов к OpenAI", ("kind", "error"))
+edits_per_response = registry.histogram(
+    "bot_edits_per_response", "Количество правок сообщения за один потоковый ответ",
+    buckets=EDIT_BUCKETS)
+telegram_errors = registry.counter(
+    "bot_telegram_errors_total", "Ошибки запросов к Telegram Bot API", ("endpoint", "error"))
+flood_waits = registry.counter(
+    "bot_telegram_flood_waits_total", "Ответы Telegram RetryAfter", ("source",))
+flood_wait_seconds = registry.counter(
+    "bot_telegram_flood_wait_seconds_total", "Суммарная пауза по RetryAfter", ("source",))
+rate_limit_wait = registry.histogram(
+    "bot_telegram_rate_limit_wait_seconds", "Ожидание в ограничителе исходящих запросов")
+response_cache_lookups = registry.counter(
+    "bot_response_cache_lookups_total", "Поиск ответа в кэше: exact, similar или miss", ("result",))
+response_cache_entries = registry.gauge(
+    "bot_response_cache_entries", "Количество ответов в кэше")
+client_pool_requests = registry.counter(
+    "bot_openai_client_pool_requests_total", "Выдача клиентов OpenAI из пула: hit или miss", ("result",))
+client_pool_evictions = registry.counter(
+    "bot_openai_client_pool_evictions_total", "Клиенты OpenAI, закрытые после простоя")
+client_pool_size = registry.gauge(
+    "bot_openai_client_pool_size", "Количество клиентов OpenAI в пуле")
+route_requests = registry.counter(
+    "bot_route_requests_total",
+    "Запросы по маршрутам модели: ok, fallback, error, hedged или cancelled", ("route", "result"))
+route_breaker_open = registry.gauge(
+    "bot_route_breaker_open", "1, если цепь маршрута модели разомкнута", ("route",))
+summaries = registry.counter(
+    "bot_summaries_total", "Составление краткого содержания истории: done, discarded или error", ("result",))
+queue_depth = registry.gauge(
+    "bot_queue_depth", "Глубина внутренних очередей", ("queue",))
+loop_lag = registry.histogram(
+    "bot_event_loop_lag_seconds", "Задержка срабатывания таймера event loop", buckets=LAG_BUCKETS)
+loop_lag_max = registry.gauge(
+    "bot_event_loop_lag_max_seconds", "Максимальная задержка event loop с момента запуска")
+process_start_time = registry.gauge(
+    "bot_process_start_time_seconds", "Время запуска процесса (unix time)")
+process_start_time.set(time.time())
+
+
+def track_handler(func):
+    """Оборачивает обработчик апдейтов: считает вызовы, ошибки и время работы."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            handler_calls.inc(handler=name, status=status)
+            handler_duration.observe(time.perf_counter() - started, handler=name)
+    return wrapper
+
+
+class StreamTimer:
+    """Замеряет время до первого токена и полное время потокового ответа."""
+
+    __slots__ = ("started", "first_token")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.started
+            openai_first_token.observe(self.first_token)
+
+    def finish(self, edit_count: int):
+        openai_stream_duration.observe(time.perf_counter() - self.started)
+        edits_per_response.observe(edit_count)
+
+
+class LoopLagMonitor:
+    """Периодически измеряет, насколько позже срабатывает таймер event loop."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            loop_lag.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+                loop_lag_max.set(lag)
+
+
+loop_lag_monitor = LoopLagMonitor()
+
+
+class MetricsServer:
+    """
+    Минимальный HTTP-сервер, отдающий метрики по GET /metrics.
+
+    Работает в event loop бота; сбор метрик занимает доли миллисекунды,
+    поэтому отдельный поток не нужен.
+    """
+
+    def __init__(self, host: str = METRICS_LISTEN, port: int = METRICS_PORT,
+                 metrics_registry: MetricsRegistry = registry):
+        self.host = host
+        self.port = port
+        self.registry = metrics_registry
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> bool:
+        """
+        Запускает сервер.
+
+        Returns:
+            bool: False, если порт занят или недоступен
+        """
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            logger.warning(
+                f"Сервер метрик не запущен: не удалось занять {self.host}:{self.port} ({e}). "
+                f"Укажите свободный порт в METRICS_PORT"
+            )
+            return False
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}{METRICS_PATH}")
+        return True
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса не нужны, но их нужно дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == METRICS_PATH:
+                status, body = "200 OK", self.registry.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Ошибка при обработке запроса метрик: {e}")
+        finally:
+            writer.close()
+
+
+def format_duration(value: Optional[float]) -> str:
+    if value is None:
+        return "—"
+    if value < 1:
+        return f"{value * 1000:.0f} мс"
+    return f"{value:.1f} с"
+
+
+def summary() -> str:
+    """Краткая сводка метрик для команды /stats."""
+    lines = []
+
+    calls = {}
+    errors = 0
+    for (handler, status), value in handler_calls.items():
+        calls[handler] = calls.get(handler, 0) + value
+        if status == "error":
+            errors += value
+    if calls:
+        lines.append(f"⚙️ Вызовов обработчиков: {int(sum(calls.values()))}, ошибок: {int(errors)}")
+        for handler, count in sorted(calls.items(), key=lambda item: -item[1])[:5]:
+            lines.append(
+                f"  • {handler}: {int(count)}, p50 {format_duration(handler_duration.quantile(0.5, handler=handler))}, "
+                f"p95 {format_duration(handler_duration.quantile(0.95, handler=handler))}"
+            )
+
+    if openai_stream_duration.count():
+        lines.append(
+            f"🤖 Ответов модели: {openai_stream_duration.count()}, первый токен p50 "
+            f"{format_duration(openai_first_token.quantile(0.5))} / p95 "
+            f"{format_duration(openai_first_token.quantile(0.95))}, генерация p95 "
+            f"{format_duration(openai_stream_duration.quantile(0.95))}"
+        )
+        lines.append(f"✏️ Правок на ответ: в среднем {edits_per_response.mean():.1f}")
+    lookups = response_cache_lookups.total()
+    if lookups:
+        hits = lookups - response_cache_lookups.value(result="miss")
+        lines.append(
+            f"🗂 Кэш ответов: {int(hits)} попаданий из {int(lookups)} ({hits / lookups:.0%}), "
+            f"похожих вопросов {int(response_cache_lookups.value(result='similar'))}"
+        )
+    fallbacks = sum(value for (_, result), value in route_requests.items() if result == "fallback")
+    hedged = sum(value for (_, result), value in route_requests.items() if result == "hedged")
+    open_routes = [key[0] for key, value in route_breaker_open.items() if value]
+    if fallbacks or hedged or open_routes:
+        lines.append(
+            f"🔀 Ответов по запасным маршрутам: {int(fallbacks)}, параллельных запросов: {int(hedged)}"
+            + (f", отключены: {', '.join(open_routes)}" if open_routes else "")
+        )
+    if summaries.total():
+        lines.append(
+            f"📝 Кратких содержаний истории: {int(summaries.value(result='done'))}, "
+            f"ошибок {int(summaries.value(result='error'))}"
+        )
+    if openai_errors.total():
+        lines.append(f"⚠️ Ошибок OpenAI: {int(openai_errors.total())}")
+
+    if telegram_errors.total():
+        by_type = {}
+        for (_, error), value in telegram_errors.items():
+            by_type[error] = by_type.get(error, 0) + value
+        lines.append("📡 Ошибки Telegram: " + ", ".join(
+            f"{error} {int(count)}" for error, count in sorted(by_type.items(), key=lambda item: -item[1])
+        ))
+    if flood_waits.total():
+        lines.append(
+            f"🐢 Ограничения Telegram: {int(flood_waits.total())}, "
+            f"суммарная пауза {flood_wait_seconds.total():.1f} с"
+        )
+
+    depths = [f"{key[0]} {int(value)}" for key, value in queue_depth.items()]
+    if depths:
+        lines.append("📥 Очереди: " + ", ".join(depths))
+    if loop_lag.count():
+        lines.append(
+            f"⏱ Задержка event loop: p99 {format_duration(loop_lag.quantile(0.99))}, "
+            f"макс. {format_duration(loop_lag_monitor.max_lag)}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, Callable, Optional
+from loguru import logger
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+import metrics
+
+# Общий лимит Telegram на исходящие сообщения бота (в секунду)
+GLOBAL_SEND_RATE = float(os.getenv('GLOBAL_SEND_RATE', '25'))
+# Лимит сообщений в секунду для одного личного чата
+PRIVATE_CHAT_SEND_RATE = 1.0
+# Лимит сообщений в секунду для одной группы (20 в минуту)
+GROUP_CHAT_SEND_RATE = 20 / 60
+# Максимальное количество одновременных запросов к Telegram
+MAX_CONCURRENT_SENDS = int(os.getenv('MAX_CONCURRENT_SENDS', '16'))
+# Количество повторов после RetryAfter
+MAX_SEND_RETRIES = 3
+# Скорость массовой рассылки, чтобы оставить запас для ответов пользователям
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '15'))
+
+BROADCAST_STATE_FILE = 'broadcast_job.json'
+
+# Методы, частоту которых регулирует EditScheduler
+EDIT_ENDPOINTS = {'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption'}
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """Забирает токен, если он доступен."""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        """Время до появления следующего токена."""
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    async def acquire(self):
+        """Ожидает и забирает токен."""
+        while not self.try_acquire():
+            await asyncio.sleep(self.wait_time())
+
+    def is_idle(self) -> bool:
+        """Bucket полностью восстановился и его можно удалить."""
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class _ChatLimit:
+    """Лимит отправок одного чата и пауза после RetryAfter в нем."""
+
+    __slots__ = ("bucket", "blocked_until")
+
+    def __init__(self, rate: float):
+        self.bucket = TokenBucket(rate, capacity=3)
+        self.blocked_until = 0.0
+
+    def block(self, retry_after: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    async def wait_unblocked(self):
+        """Ожидает окончания паузы, назначенной Telegram для чата."""
+        while (delay := self.blocked_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def is_idle(self) -> bool:
+        return self.blocked_until <= time.monotonic() and self.bucket.is_idle()
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Ограничитель всех исходящих запросов бота к Telegram.
+
+    Подключается через Application.builder().rate_limiter(...) и поэтому
+    применяется ко всем отправкам: ответам, рассылкам и уведомлениям.
+    Использует общий token bucket и bucket на каждый чат, ограничивает
+    число одновременных запросов и повторяет запрос после RetryAfter.
+    RetryAfter приостанавливает отправки только в тот чат, для которого
+    Telegram его вернул, остальные чаты продолжают получать сообщения.
+    Правки сообщений проходят только через общий лимит - их частоту в
+    чате и обработку RetryAfter берет на себя EditScheduler.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_SEND_RATE,
+        max_concurrency: int = MAX_CONCURRENT_SENDS,
+        max_retries: int = MAX_SEND_RETRIES
+    ):
+        self.global_bucket = TokenBucket(global_rate)
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._chats: dict[int, _ChatLimit] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_limit(self, chat_id: int) -> _ChatLimit:
+        limit = self._chats.get(chat_id)
+        if limit is None:
+            if len(self._chats) > 10000:
+                for idle_id in [c for c, state in self._chats.items() if state.is_idle()]:
+                    del self._chats[idle_id]
+            rate = GROUP_CHAT_SEND_RATE if chat_id < 0 else PRIVATE_CHAT_SEND_RATE
+            limit = self._chats[chat_id] = _ChatLimit(rate)
+        return limit
+
+    async def process_request(
+        self,
+        callback: Callable,
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: Optional[int]
+    ):
+        try:
+            return await self._process(callback, args, kwargs, endpoint, data, rate_limit_args)
+        except TelegramError as e:
+            metrics.telegram_errors.inc(endpoint=endpoint, error=type(e).__name__)
+            raise
+
+    async def _process(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id) if chat_id is not None else None
+        except (TypeError, ValueError):
+            chat_id = None
+
+        # Запросы без чата (getUpdates, answerCallbackQuery и т.п.) не ограничиваем
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        is_edit = endpoint in EDIT_ENDPOINTS
+        max_retries = 0 if is_edit else (rate_limit_args if rate_limit_args is not None else self.max_retries)
+
+        for attempt in range(max_retries + 1):
+            waiting_since = time.perf_counter()
+            chat_limit = self._chat_limit(chat_id)
+            await chat_limit.wait_unblocked()
+            if not is_edit:
+                await chat_limit.bucket.acquire()
+            await self.global_bucket.acquire()
+            metrics.rate_limit_wait.observe(time.perf_counter() - waiting_since)
+            try:
+                async with self._semaphore:
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                retry_after = float(e.retry_after) + 0.1
+                metrics.flood_waits.inc(source="outbox")
+                metrics.flood_wait_seconds.inc(retry_after, source="outbox")
+                logger.warning(
+                    f"Превышен лимит Telegram при {endpoint} в чат {chat_id}, "
+                    f"повтор через {retry_after:.1f} с"
+                )
+                # Отправки в этот чат ждут до конца паузы, указанной Telegram
+                self._chat_limit(chat_id).block(retry_after)
+
+
+class BroadcastJob:
+    """
+    Фоновая рассылка сообщения списку пользователей.
+
+    Позиция в списке получателей периодически сохраняется в файл, поэтому
+    прерванную (например, перезапуском) рассылку можно продолжить с места
+    остановки. Ход рассылки отображается правкой статусного сообщения.
+    """
+
+    def __init__(
+        self,
+        text: str,
+        recipients: list[int],
+        report_chat_id: Optional[int] = None,
+        status_message_id: Optional[int] = None,
+        cursor: int = 0,
+        success_count: int = 0,
+        fail_count: int = 0,
+        state_file: Optional[str] = BROADCAST_STATE_FILE,
+        rate: float = BROADCAST_RATE
+    ):
+        self.text = text
+        self.recipients = recipients
+        self.report_chat_id = report_chat_id
+        self.status_message_id = status_message_id
+        self.cursor = cursor
+        self.success_count = success_count
+        self.fail_count = fail_count
+        self.state_file = state_file
+        self.cancelled = False
+        self._bucket = TokenBucket(rate, capacity=1)
+
+    @classmethod
+    def load(cls, state_file: str = BROADCAST_STATE_FILE) -> Optional["BroadcastJob"]:
+        """Загружает прерванную рассылку из файла состояния."""
+        if not os.path.exists(state_file):
+            return None
+        try:
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return cls(state_file=state_file, **state)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке состояния рассылки: {e}")
+            return None
+
+    def save_state(self):
+        """Атомарно сохраняет позицию рассылки."""
+        if not self.state_file:
+            return
+        state = {
+            "text": self.text,
+            "recipients": self.recipients,
+            "report_chat_id": self.report_chat_id,
+            "status_message_id": self.status_message_id,
+            "cursor": self.cursor,
+            "success_count": self.success_count,
+            "fail_count": self.fail_count
+        }
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_file)
+
+    def clear_state(self):
+        if self.state_file and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    @property
+    def progress_text(self) -> str:
+        return (
+            f"📢 Рассылка: {self.cursor}/{len(self.recipients)}\n"
+            f"✅ Отправлено: {self.success_count}\n"
+            f"❌ Ошибок: {self.fail_count}"
+        )
+
+    async def _report_progress(self, bot):
+        if self.report_chat_id is None or self.status_message_id is None:
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=self.report_chat_id,
+                message_id=self.status_message_id,
+                text=self.progress_text
+            )
+        except Exception as e:
+            logger.debug(f"Не удалось обновить статус рассылки: {e}")
+
+    async def run(self, bot, progress_interval: float = 5.0, save_every: int = 25):
+        """Отправляет сообщение оставшимся получателям."""
+        last_report = time.monotonic()
+        self.save_state()
+
+        while self.cursor < len(self.recipients) and not self.cancelled:
+            user_id = self.recipients[self.cursor]
+            await self._bucket.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=self.text)
+                self.success_count += 1
+            except Forbidden as e:
+                # Пользователь заблокировал бота - повторять бессмысленно
+                logger.debug(f"Пользователь {user_id} недоступен для рассылки: {e}")
+                self.fail_count += 1
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+                self.fail_count += 1
+            self.cursor += 1
+
+            if self.cursor % save_every == 0:
+                self.save_state()
+            if time.monotonic() - last_report >= progress_interval:
+                await self._report_progress(bot)
+                last_report = time.monotonic()
+
+        if self.cancelled:
+            self.save_state()
+        else:
+            self.clear_state()
+        await self._report_progress(bot)
+        logger.info(
+            f"Рассылка {'остановлена' if self.cancelled else 'завершена'}: "
+            f"{self.success_count} отправлено, {self.fail_count} ошибок"
+        )
+
+
+class Broadcaster:
+    """Запускает рассылки в фоне, не более одной одновременно."""
+
+    def __init__(self, state_file: str = BROADCAST_STATE_FILE):
+        self.state_file = state_file
+        self.current: Optional[BroadcastJob] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, application, job: BroadcastJob) -> BroadcastJob:
+        """Запускает рассылку фоновой задачей приложения."""
+        if self.is_running:
+            raise RuntimeError("Рассылка уже выполняется")
+        self.current = job
+        self._task = application.create_task(job.run(application.bot))
+        return job
+
+    def resume(self, application) -> Optional[BroadcastJob]:
+        """Продолжает прерванную рассылку, если она есть."""
+        job = BroadcastJob.load(self.state_file)
+        if job is None:
+            return None
+        return self.start(application, job)
+
+    def cancel(self) -> bool:
+        if not self.is_running:
+            return False
+        self.current.cancelled = True
+        return True
+
+    async def notify_all(self, bot, recipients: list[int], text: str):
+        """Отправляет уведомление всем получателям, дожидаясь завершения."""
+        job = BroadcastJob(text, recipients, state_file=None)
+        await job.run(bot)
+        return job
+
+
+broadcaster = Broadcaster()
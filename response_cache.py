@@ -0,0 +1,349 @@
+import asyncio
+import operator
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+from loguru import logger
+import metrics
+from routing import RoutedStream
+
+# Кэш ответов на одинаковые вопросы (по умолчанию выключен)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'False').lower() == 'true'
+# Максимальное количество ответов в кэше
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+# Время жизни ответа в кэше (секунды)
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+# Порог косинусной близости для поиска похожих вопросов по эмбеддингам
+# (0 - искать только точные совпадения)
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0'))
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv('RESPONSE_CACHE_EMBEDDING_MODEL', 'text-embedding-3-small')
+# Размерность эмбеддингов (поддерживается моделями text-embedding-3)
+RESPONSE_CACHE_EMBEDDING_DIMENSIONS = int(os.getenv('RESPONSE_CACHE_EMBEDDING_DIMENSIONS', '256'))
+# Сколько последних записей раздела сравнивается при поиске похожего вопроса
+RESPONSE_CACHE_SCAN_LIMIT = int(os.getenv('RESPONSE_CACHE_SCAN_LIMIT', '1000'))
+# Пауза перед повторной попыткой получить эмбеддинги от endpoint после ошибки
+EMBEDDING_RETRY_INTERVAL = 600
+# Размер фрагментов, которыми ответ из кэша передается в потоковую отправку
+REPLAY_CHUNK_CHARS = 80
+
+_SPACES = re.compile(r"\s+")
+
+Embed = Callable[[str], Awaitable[list[float]]]
+
+
+def normalize_prompt(text: str) -> str:
+    """Приводит вопрос к виду, в котором несущественные различия не важны."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _SPACES.sub(" ", text).strip()
+    return text.rstrip(" .!?…")
+
+
+def _unit(vector: list[float]) -> list[float]:
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector] if norm else vector
+
+
+class CacheKey(NamedTuple):
+    # (base_url, модель, температура, max_tokens): ответы из разных
+    # разделов не подменяют друг друга
+    partition: tuple
+    prompt: str
+
+
+def _best_match(embedding: list[float], candidates: list[tuple[CacheKey, list[float]]],
+                threshold: float) -> Optional[tuple[CacheKey, float]]:
+    """Самый близкий вопрос с близостью не ниже порога."""
+    best_key, best_score = None, threshold
+    for key, candidate in candidates:
+        score = sum(map(operator.mul, embedding, candidate))
+        if score >= best_score:
+            best_key, best_score = key, score
+    return (best_key, best_score) if best_key is not None else None
+
+
+class _Entry:
+    __slots__ = ("response", "partition", "embedding", "created")
+
+    def __init__(self, response: str, partition: tuple, embedding: Optional[list[float]]):
+        self.response = response
+        self.partition = partition
+        self.embedding = embedding
+        self.created = time.monotonic()
+
+
+class ResponseCache:
+    """
+    Кэш ответов модели на вопросы без предыстории.
+
+    Ответ ищется сначала по точному совпадению нормализованного вопроса,
+    затем (если задан порог similarity) по близости эмбеддингов среди
+    вопросов с теми же моделью и параметрами. Записи вытесняются по LRU
+    и удаляются по истечении ttl.
+
+    Похожий вопрос ищется параллельно с запросом к модели (см. stream):
+    эмбеддинг не задерживает ответ, а сравнение с сохраненными вопросами
+    выполняется в отдельном потоке и ограничено scan_limit записями.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        size: int = RESPONSE_CACHE_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL,
+        similarity: float = RESPONSE_CACHE_SIMILARITY,
+        scan_limit: int = RESPONSE_CACHE_SCAN_LIMIT
+    ):
+        self.enabled = enabled
+        self.size = size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.scan_limit = scan_limit
+        self._entries: OrderedDict[CacheKey, _Entry] = OrderedDict()
+        # Поиски похожих вопросов, чей эмбеддинг будет добавлен к записи
+        self._pending_embeddings: set[asyncio.Future] = set()
+        # Время последней ошибки получения эмбеддингов по base_url
+        self._embedding_failures: dict[str, float] = {}
+
+    def key_for(self, history: list[dict], base_url: str, model: str,
+                temperature: float, max_tokens: int) -> Optional[CacheKey]:
+        """
+        Возвращает ключ кэша или None, если ответ зависит от предыстории.
+
+        Кэшируются только диалоги из одних вопросов пользователя: после
+        ответа модели следующий вопрос может ссылаться на этот ответ.
+        """
+        if not self.enabled or not history:
+            return None
+        if any(message.get("role") != "user" for message in history):
+            return None
+        prompt = normalize_prompt("\n".join(message["content"] for message in history))
+        if not prompt:
+            return None
+        return CacheKey((base_url, model, temperature, max_tokens), prompt)
+
+    def _get_entry(self, key: CacheKey) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key: CacheKey) -> Optional[str]:
+        """Ответ на точно такой же вопрос."""
+        entry = self._get_entry(key)
+        return entry.response if entry else None
+
+    def _candidates(self, partition: tuple) -> list[tuple[CacheKey, list[float]]]:
+        """Эмбеддинги последних scan_limit живых записей раздела."""
+        candidates, expired = [], []
+        now = time.monotonic()
+        for key, entry in reversed(self._entries.items()):
+            if entry.partition != partition or entry.embedding is None:
+                continue
+            if now - entry.created > self.ttl:
+                expired.append(key)
+                continue
+            candidates.append((key, entry.embedding))
+            if len(candidates) >= self.scan_limit:
+                break
+        for key in expired:
+            del self._entries[key]
+        return candidates
+
+    async def _embed(self, key: CacheKey, embed: Embed) -> Optional[list[float]]:
+        base_url = key.partition[0]
+        failed_at = self._embedding_failures.get(base_url)
+        if failed_at is not None and time.monotonic() - failed_at < EMBEDDING_RETRY_INTERVAL:
+            return None
+        try:
+            return _unit(await embed(key.prompt))
+        except Exception as e:
+            # Пользовательский endpoint может не поддерживать эмбеддинги
+            self._embedding_failures[base_url] = time.monotonic()
+            logger.warning(f"Не удалось получить эмбеддинг для кэша ответов ({base_url}): {e}")
+            return None
+
+    def lookup(self, key: CacheKey) -> Optional[str]:
+        """Ищет ответ на точно такой же вопрос и учитывает попадание в метриках."""
+        response = self.get(key)
+        if response is not None:
+            metrics.response_cache_lookups.inc(result="exact")
+        return response
+
+    async def lookup_similar(self, key: CacheKey, embed: Embed) -> tuple[Optional[str], Optional[list[float]]]:
+        """
+        Ищет ответ на похожий вопрос по эмбеддингам.
+
+        Returns:
+            tuple: (ответ или None, эмбеддинг вопроса для последующего put)
+        """
+        embedding = await self._embed(key, embed)
+        if embedding is None:
+            return None, None
+        candidates = self._candidates(key.partition)
+        if not candidates:
+            return None, embedding
+        # Сравнение с сотнями векторов заняло бы event loop на миллисекунды
+        found = await asyncio.to_thread(_best_match, embedding, candidates, self.similarity)
+        if found is None:
+            return None, embedding
+        similar_key, score = found
+        # Запись могла быть вытеснена, пока шло сравнение
+        entry = self._get_entry(similar_key)
+        if entry is None:
+            return None, embedding
+        logger.debug(f"Найден ответ на похожий вопрос (близость {score:.3f})")
+        return entry.response, embedding
+
+    def stream(self, key: Optional[CacheKey], open_stream: Callable[[], RoutedStream],
+               embed: Optional[Embed] = None) -> "CachedStream":
+        """Ответ из кэша или поток модели (см. CachedStream)."""
+        return CachedStream(self, key, open_stream, embed)
+
+    def put(self, key: CacheKey, response: str, embedding: Optional[list[float]] = None):
+        self._entries[key] = _Entry(response, key.partition, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def attach_embedding(self, key: CacheKey, lookup: asyncio.Future):
+        """Добавляет к записи эмбеддинг вопроса, когда поиск похожего завершится."""
+        entry = self._entries.get(key)
+
+        def attach(task: asyncio.Future):
+            self._pending_embeddings.discard(task)
+            if task.cancelled() or task.exception() is not None:
+                return
+            embedding = task.result()[1]
+            # Запись могла быть вытеснена или заменена, пока шел поиск
+            if embedding is not None and self._entries.get(key) is entry:
+                entry.embedding = embedding
+
+        self._pending_embeddings.add(lookup)
+        lookup.add_done_callback(attach)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    async def replay(text: str, chunk_chars: int = REPLAY_CHUNK_CHARS) -> AsyncIterator[str]:
+        """Отдает сохраненный ответ фрагментами, как поток модели."""
+        start = 0
+        while start < len(text):
+            end = min(len(text), start + chunk_chars)
+            # Не разрываем слова между фрагментами
+            space = text.rfind(" ", start, end) if end < len(text) else -1
+            if space > start:
+                end = space + 1
+            yield text[start:end]
+            start = end
+
+
+class CachedStream:
+    """
+    Фрагменты ответа из кэша или от модели.
+
+    При точном совпадении модель не запрашивается. Иначе запрос к модели
+    начинается сразу, а похожий вопрос ищется параллельно: если он найден
+    раньше первого токена модели, запрос отменяется и отдается ответ из
+    кэша. Иначе поиск продолжается, и его эмбеддинг добавляется к записи
+    с ответом модели (put): по ней найдутся следующие похожие вопросы.
+    Без ключа кэша это просто поток модели.
+    """
+
+    def __init__(self, cache: ResponseCache, key: Optional[CacheKey],
+                 open_stream: Callable[[], RoutedStream], embed: Optional[Embed] = None):
+        self.cache = cache
+        self.key = key
+        # Ответ из кэша (None - ответ модели)
+        self.cached: Optional[str] = None
+        # Эмбеддинг вопроса, если поиск похожего успел его получить
+        self.embedding: Optional[list[float]] = None
+        self._open_stream = open_stream
+        self._embed = embed
+        self._stream: Optional[RoutedStream] = None
+        self._similar: Optional[asyncio.Future] = None
+        self._iterator = self._run()
+
+    @property
+    def fallback(self) -> bool:
+        """Ответ получен не от маршрута, выбранного пользователем."""
+        return self._stream is not None and self._stream.fallback
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        return await self._iterator.__anext__()
+
+    async def aclose(self):
+        await self._iterator.aclose()
+
+    def put(self, response: str):
+        """Сохраняет ответ модели в кэш вместе с эмбеддингом вопроса, когда тот будет получен."""
+        similar = self._similar
+        if self.embedding is None and similar is not None and similar.done() \
+                and not similar.cancelled() and similar.exception() is None:
+            self.embedding = similar.result()[1]
+        self.cache.put(self.key, response, self.embedding)
+        if self.embedding is None and similar is not None and not similar.done():
+            self.cache.attach_embedding(self.key, similar)
+
+    async def _race(self) -> tuple[Optional[str], Optional[asyncio.Future]]:
+        """Ждет первый токен модели или ответ на похожий вопрос, что придет раньше."""
+        first = asyncio.ensure_future(self._stream.__anext__())
+        similar = self._similar = asyncio.ensure_future(self.cache.lookup_similar(self.key, self._embed))
+        try:
+            await asyncio.wait((first, similar), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            first.cancel()
+            similar.cancel()
+            raise
+        # Если модель ответила раньше, поиск продолжается ради эмбеддинга для put
+        if not first.done():
+            response, self.embedding = similar.result()
+            if response is not None:
+                first.cancel()
+                await asyncio.gather(first, return_exceptions=True)
+                metrics.response_cache_lookups.inc(result="similar")
+                return response, None
+        return None, first
+
+    async def _run(self) -> AsyncIterator[str]:
+        response = self.cache.lookup(self.key) if self.key is not None else None
+        first = None
+        if response is None:
+            self._stream = self._open_stream()
+        try:
+            if response is None and self.key is not None:
+                if self.cache.similarity > 0 and self._embed is not None:
+                    response, first = await self._race()
+                if response is None:
+                    metrics.response_cache_lookups.inc(result="miss")
+            if response is not None:
+                self.cached = response
+                if self._stream is not None:
+                    await self._stream.aclose()
+                    self._stream = None
+                async for piece in self.cache.replay(response):
+                    yield piece
+                return
+            if first is not None:
+                try:
+                    yield await first
+                except StopAsyncIteration:
+                    return
+            async for piece in self._stream:
+                yield piece
+        finally:
+            if self._stream is not None:
+                await self._stream.aclose()
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,309 @@
+import asyncio
+import os
+import time
+from typing import AsyncIterator, Callable, NamedTuple, Optional
+from urllib.parse import urlsplit
+from loguru import logger
+import openai
+import metrics
+
+# Запасные модели через запятую. "model" - та же модель на endpoint
+# пользователя (только для основного endpoint), "model@base_url" - модель
+# на указанном endpoint (для всех пользователей). По умолчанию запасных
+# моделей нет: ответ другой модели не должен подменять выбранную молча
+ROUTING_FALLBACKS = os.getenv('ROUTING_FALLBACKS', '')
+# Через сколько секунд без первого токена отправлять параллельный запрос
+# следующему маршруту (0 - не отправлять)
+ROUTING_HEDGE_DELAY = float(os.getenv('ROUTING_HEDGE_DELAY', '0'))
+# Сколько ошибок подряд размыкают цепь маршрута
+ROUTING_BREAKER_FAILURES = int(os.getenv('ROUTING_BREAKER_FAILURES', '3'))
+# Сколько секунд разомкнутый маршрут не используется до пробного запроса
+ROUTING_BREAKER_COOLDOWN = float(os.getenv('ROUTING_BREAKER_COOLDOWN', '30'))
+# Вес нового измерения в скользящих средних задержки и доли ошибок
+EWMA_ALPHA = 0.2
+# Оценка времени до первого токена для маршрута без измерений (секунды)
+DEFAULT_TTFT = 1.0
+
+# Ошибки в самом запросе (например, слишком длинный контекст) и в доступе
+# (неверный ключ, нет доступа к модели, неверное имя модели): пользователь
+# должен увидеть ошибку, а не ответ другой модели; здоровье endpoint они
+# не характеризуют
+CLIENT_ERRORS = (
+    openai.BadRequestError,
+    openai.UnprocessableEntityError,
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+)
+
+
+class Route(NamedTuple):
+    base_url: str
+    model: str
+
+    @property
+    def label(self) -> str:
+        return f"{self.model}@{urlsplit(self.base_url).netloc or self.base_url}"
+
+
+OpenStream = Callable[[Route, bool], AsyncIterator[str]]
+
+
+def parse_fallbacks(value: str) -> list[tuple[str, Optional[str]]]:
+    """Разбирает ROUTING_FALLBACKS в список (модель, base_url или None)."""
+    fallbacks = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        model, _, base_url = item.partition('@')
+        fallbacks.append((model.strip(), base_url.strip().rstrip('/') or None))
+    return fallbacks
+
+
+class RouteHealth:
+    """
+    Состояние маршрута: скользящие средние и автоматический выключатель.
+
+    После breaker_failures ошибок подряд цепь размыкается и маршрут не
+    используется cooldown секунд. Затем пропускается один пробный запрос:
+    успех замыкает цепь, ошибка снова размыкает ее.
+    """
+
+    __slots__ = ("route", "ttft", "error_rate", "failures", "opened_at", "probing")
+
+    def __init__(self, route: Route):
+        self.route = route
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    def available(self, cooldown: float) -> bool:
+        if self.opened_at is None:
+            return True
+        return not self.probing and time.monotonic() - self.opened_at >= cooldown
+
+    def acquire(self):
+        """Отмечает начало запроса; для разомкнутой цепи это пробный запрос."""
+        if self.opened_at is not None:
+            self.probing = True
+
+    def release(self):
+        """Запрос отменен до результата (проиграл параллельному)."""
+        self.probing = False
+
+    def success(self, ttft: float):
+        self.ttft = ttft if self.ttft is None else self.ttft + EWMA_ALPHA * (ttft - self.ttft)
+        self.error_rate -= EWMA_ALPHA * self.error_rate
+        self.failures = 0
+        self.probing = False
+        if self.opened_at is not None:
+            self.opened_at = None
+            metrics.route_breaker_open.set(0, route=self.route.label)
+            logger.info(f"Маршрут {self.route.label} снова доступен")
+
+    def failure(self, breaker_failures: int):
+        self.error_rate += EWMA_ALPHA * (1 - self.error_rate)
+        self.failures += 1
+        was_probing, self.probing = self.probing, False
+        if was_probing or (self.opened_at is None and self.failures >= breaker_failures):
+            self.opened_at = time.monotonic()
+            metrics.route_breaker_open.set(1, route=self.route.label)
+            logger.warning(f"Маршрут {self.route.label} отключен после {self.failures} ошибок подряд")
+
+    @property
+    def score(self) -> float:
+        """Чем меньше, тем лучше: задержка с поправкой на долю ошибок."""
+        return (self.ttft if self.ttft is not None else DEFAULT_TTFT) * (1 + 4 * self.error_rate)
+
+
+class ModelRouter:
+    """
+    Выбор маршрута (endpoint и модель) для потокового ответа.
+
+    Первым пробуется маршрут из настроек пользователя, затем запасные в
+    порядке их задержки и доли ошибок. Маршруты с разомкнутой цепью
+    пропускаются. Если запрос завершился ошибкой до первого токена,
+    запрос повторяется по следующему маршруту; если первый токен не пришел
+    за hedge_delay секунд, параллельно отправляется запрос следующему
+    маршруту, и ответ берется у того, кто ответит первым.
+    """
+
+    def __init__(
+        self,
+        fallbacks: str = ROUTING_FALLBACKS,
+        hedge_delay: float = ROUTING_HEDGE_DELAY,
+        breaker_failures: int = ROUTING_BREAKER_FAILURES,
+        breaker_cooldown: float = ROUTING_BREAKER_COOLDOWN
+    ):
+        self.fallbacks = parse_fallbacks(fallbacks)
+        self.hedge_delay = hedge_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self._health: dict[Route, RouteHealth] = {}
+
+    def health(self, route: Route) -> RouteHealth:
+        health = self._health.get(route)
+        if health is None:
+            health = self._health[route] = RouteHealth(route)
+        return health
+
+    def candidates(self, base_url: str, model: str, default_endpoint: bool) -> list[Route]:
+        """Маршруты в порядке попыток."""
+        primary = Route(base_url, model)
+        fallbacks = []
+        for fallback_model, fallback_url in self.fallbacks:
+            if fallback_url is None and not default_endpoint:
+                # На пользовательском endpoint запасной модели может не быть
+                continue
+            route = Route(fallback_url or base_url, fallback_model)
+            if route != primary and route not in fallbacks:
+                fallbacks.append(route)
+        fallbacks.sort(key=lambda route: self.health(route).score)
+        routes = [
+            route for route in [primary] + fallbacks
+            if self.health(route).available(self.breaker_cooldown)
+        ]
+        # Если отключены все маршруты, пробуем выбранный пользователем
+        return routes or [primary]
+
+    def open_circuits(self) -> int:
+        return sum(1 for health in self._health.values() if health.opened_at is not None)
+
+    def stream(self, open_stream: OpenStream, base_url: str, model: str,
+               default_endpoint: bool = True) -> "RoutedStream":
+        """
+        Начинает потоковый ответ по первому подходящему маршруту.
+
+        Args:
+            open_stream: Функция (маршрут, разрешить повторы клиента) ->
+                асинхронный итератор фрагментов ответа
+        """
+        return RoutedStream(
+            self, Route(base_url, model), self.candidates(base_url, model, default_endpoint), open_stream
+        )
+
+
+class RoutedStream:
+    """Фрагменты ответа с переключением маршрутов до первого токена."""
+
+    def __init__(self, router: ModelRouter, primary: Route, routes: list[Route], open_stream: OpenStream):
+        self.router = router
+        # Маршрут из настроек пользователя
+        self.primary = primary
+        # Маршрут, от которого получен ответ
+        self.route: Optional[Route] = None
+        self._routes = list(routes)
+        self._open_stream = open_stream
+        self._iterator = self._run()
+
+    @property
+    def fallback(self) -> bool:
+        """Ответ получен не от маршрута, выбранного пользователем."""
+        return self.route is not None and self.route != self.primary
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        return await self._iterator.__anext__()
+
+    async def aclose(self):
+        await self._iterator.aclose()
+
+    def _start(self, attempts: dict):
+        route = self._routes.pop(0)
+        health = self.router.health(route)
+        health.acquire()
+        # Повторы внутри клиента OpenAI нужны только последнему маршруту,
+        # остальные ошибки обрабатывает переключение маршрута
+        stream = self._open_stream(route, not self._routes)
+        task = asyncio.ensure_future(stream.__anext__())
+        attempts[task] = (route, stream, time.monotonic())
+
+    async def _cancel(self, attempts: dict):
+        for task, (route, stream, _) in attempts.items():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await stream.aclose()
+            self.router.health(route).release()
+            metrics.route_requests.inc(route=route.label, result="cancelled")
+        attempts.clear()
+
+    async def _run(self) -> AsyncIterator[str]:
+        attempts: dict[asyncio.Future, tuple[Route, AsyncIterator[str], float]] = {}
+        router = self.router
+        winner = None
+        first = None
+        last_error: Optional[BaseException] = None
+        try:
+            self._start(attempts)
+            hedged = False
+            while attempts and winner is None:
+                can_hedge = router.hedge_delay > 0 and not hedged and self._routes
+                done, _ = await asyncio.wait(
+                    attempts, timeout=router.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Первый токен задерживается: параллельный запрос следующему маршруту
+                    hedged = True
+                    route = next(iter(attempts.values()))[0]
+                    metrics.route_requests.inc(route=route.label, result="hedged")
+                    logger.debug(f"Нет первого токена от {route.label} за {router.hedge_delay} с, "
+                                 f"параллельный запрос к {self._routes[0].label}")
+                    self._start(attempts)
+                    continue
+                for task in done:
+                    route, stream, started = attempts.pop(task)
+                    health = router.health(route)
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        if winner is None:
+                            winner = (route, stream)
+                            first = task.result() if error is None else None
+                            health.success(time.monotonic() - started)
+                        else:
+                            attempts[task] = (route, stream, started)
+                        continue
+                    if isinstance(error, CLIENT_ERRORS):
+                        health.release()
+                        raise error
+                    last_error = error
+                    health.failure(router.breaker_failures)
+                    metrics.route_requests.inc(route=route.label, result="error")
+                    logger.warning(f"Ошибка маршрута {route.label}: {type(error).__name__}: {error}")
+                if winner is None and not attempts and self._routes:
+                    self._start(attempts)
+            # Параллельные запросы, которые не успели ответить первыми
+            await self._cancel(attempts)
+
+            if winner is None:
+                raise last_error
+            route, stream = winner
+            self.route = route
+            metrics.route_requests.inc(route=route.label, result="fallback" if self.fallback else "ok")
+            if self.fallback:
+                logger.info(f"Ответ получен по запасному маршруту {route.label} вместо {self.primary.label}")
+            if first is None:
+                return
+            try:
+                yield first
+                async for piece in stream:
+                    yield piece
+            except (GeneratorExit, asyncio.CancelledError):
+                raise
+            except Exception:
+                # Часть ответа уже отправлена: переключить маршрут нельзя
+                router.health(route).failure(router.breaker_failures)
+                metrics.route_requests.inc(route=route.label, result="error")
+                raise
+            finally:
+                await stream.aclose()
+        finally:
+            await self._cancel(attempts)
+
+
+router = ModelRouter()
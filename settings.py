@@ -1,9 +1,16 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Literal, NamedTuple, Optional
+from collections import OrderedDict
+import asyncio
 import json
+import threading
+import time
 from loguru import logger
 import os
 from dotenv import load_dotenv
+from state import state_backend
+from storage import StateBackend
+from history import HISTORY_MAX_MESSAGES, Message, MessageHistory, message_dict
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -11,18 +18,81 @@ load_dotenv()
 # Включение/выключение режима отладки
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
+# Задержка перед записью накопленных изменений настроек (секунды)
+SETTINGS_FLUSH_DELAY = float(os.getenv('SETTINGS_FLUSH_DELAY', '1.0'))
+# Сколько раз повторять запись при параллельных изменениях из других процессов
+MAX_WRITE_ATTEMPTS = 5
+# Бюджет памяти на историю загруженных пользователей (МБ, 0 - без ограничения).
+# При превышении история давно неактивных пользователей выгружается и
+# загружается из хранилища при следующем обращении
+HISTORY_MEMORY_BUDGET_MB = float(os.getenv('HISTORY_MEMORY_BUDGET_MB', '256'))
+# Как часто проверять бюджет памяти (секунды)
+MEMORY_CHECK_INTERVAL = 10.0
+# Примерный размер настроек пользователя в памяти без истории (байты)
+USER_OVERHEAD_BYTES = 4096
+
 # Настройка логирования теперь происходит в bot.py
 
-class TextModelSettings(BaseModel):
-    base_url: str = "https://api.openai.com/v1"
-    model: str = "gpt-4o-mini"
-    temperature: float = 0.7
-    max_tokens: int = 1000
-    custom_model: Optional[str] = None
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+TEXT_MODELS = ("gpt-4o-mini", "gpt-4o", "gpt-4", "Custom Model")
+
+
+class ImageModelCapabilities(NamedTuple):
+    sizes: tuple[str, ...]
+    qualities: tuple[str, ...]
+    styles: tuple[str, ...]
+    hdr: bool
+
+
+# Возможности моделей изображений; таблица строится один раз при импорте
+IMAGE_MODEL_CAPABILITIES = {
+    "dall-e-3": ImageModelCapabilities(
+        sizes=("1024x1024", "1024x1792", "1792x1024"),
+        qualities=("standard", "hd"),
+        styles=("natural", "vivid"),
+        hdr=True
+    ),
+    "dall-e-2": ImageModelCapabilities(
+        sizes=("1024x1024", "512x512", "256x256"),
+        qualities=("standard",),
+        styles=(),
+        hdr=False
+    ),
+}
+IMAGE_MODELS = tuple(IMAGE_MODEL_CAPABILITIES)
+DEFAULT_IMAGE_MODEL = "dall-e-3"
+
+
+class TextModelSettings:
+    """
+    Настройки текстовой модели пользователя.
+
+    Обычный объект со слотами: настройки читаются на каждое сообщение, а
+    проверка типов pydantic нужна только при импорте и экспорте
+    (TextSettingsSchema). В хранилище пишутся только поля из __slots__.
+    """
+
+    __slots__ = ("base_url", "model", "temperature", "max_tokens", "custom_model")
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, model: str = "gpt-4o-mini",
+                 temperature: float = 0.7, max_tokens: int = 1000, custom_model: Optional[str] = None):
+        self.base_url = base_url
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.custom_model = custom_model
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TextModelSettings":
+        """Создает настройки из словаря хранилища; лишние ключи (старые вычисляемые поля) пропускаются."""
+        return cls(**{key: data[key] for key in cls.__slots__ if key in data})
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
 
     @property
-    def available_models(self):
-        return ["gpt-4o-mini", "gpt-4o", "gpt-4", "Custom Model"]
+    def available_models(self) -> tuple[str, ...]:
+        return TEXT_MODELS
 
     @property
     def effective_model(self):
@@ -31,137 +101,553 @@ class TextModelSettings(BaseModel):
             return self.custom_model
         return self.model
 
-    def dict(self, *args, **kwargs):
-        """Переопределяем метод dict для включения свойств в сериализацию"""
-        d = super().dict(*args, **kwargs)
-        d['available_models'] = self.available_models
-        d['effective_model'] = self.effective_model
-        return d
+class ImageModelSettings:
+    """Настройки модели изображений пользователя (см. TextModelSettings)."""
 
-class ImageModelSettings(BaseModel):
-    base_url: str = "https://api.openai.com/v1"
-    model: str = "dall-e-3"
-    size: str = "1024x1024"
-    quality: str = "standard"
-    style: str = "natural"
-    hdr: bool = False
+    __slots__ = ("base_url", "model", "size", "quality", "style", "hdr")
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, model: str = DEFAULT_IMAGE_MODEL, size: str = "1024x1024",
+                 quality: str = "standard", style: str = "natural", hdr: bool = False):
+        self.base_url = base_url
+        self.model = model
+        self.size = size
+        self.quality = quality
+        self.style = style
+        self.hdr = hdr
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ImageModelSettings":
+        values = {key: data[key] for key in cls.__slots__ if key in data}
+        model = values.get("model", DEFAULT_IMAGE_MODEL)
+        if model not in IMAGE_MODEL_CAPABILITIES:
+            # Модель убрана из таблицы: размер, качество и стиль от нее тоже не годятся,
+            # поэтому сбрасываем все параметры модели, сохраняя только адрес API
+            logger.warning(f"Неизвестная модель изображений {model!r}, используется {DEFAULT_IMAGE_MODEL}")
+            values = {key: values[key] for key in ("base_url",) if key in values}
+        return cls(**values)
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
 
     @property
-    def available_models(self):
-        return ["dall-e-3", "dall-e-2"]
+    def available_models(self) -> tuple[str, ...]:
+        return IMAGE_MODELS
 
     @property
-    def model_capabilities(self):
-        return {
-            "dall-e-3": {
-                "sizes": ["1024x1024", "1024x1792", "1792x1024"],
-                "qualities": ["standard", "hd"],
-                "styles": ["natural", "vivid"],
-                "hdr": True
-            },
-            "dall-e-2": {
-                "sizes": ["1024x1024", "512x512", "256x256"],
-                "qualities": ["standard"],
-                "styles": [],
-                "hdr": False
-            }
-        }
+    def capabilities(self) -> ImageModelCapabilities:
+        capabilities = IMAGE_MODEL_CAPABILITIES.get(self.model)
+        return capabilities if capabilities is not None else IMAGE_MODEL_CAPABILITIES[DEFAULT_IMAGE_MODEL]
 
     @property
-    def available_sizes(self):
-        return self.model_capabilities[self.model]["sizes"]
+    def available_sizes(self) -> tuple[str, ...]:
+        return self.capabilities.sizes
 
     @property
-    def available_qualities(self):
-        return self.model_capabilities[self.model]["qualities"]
+    def available_qualities(self) -> tuple[str, ...]:
+        return self.capabilities.qualities
 
     @property
-    def available_styles(self):
-        return self.model_capabilities[self.model]["styles"]
+    def available_styles(self) -> tuple[str, ...]:
+        return self.capabilities.styles
 
     @property
-    def supports_hdr(self):
-        return self.model_capabilities[self.model]["hdr"]
-
-    def dict(self, *args, **kwargs):
-        """Переопределяем метод dict для включения свойств в сериализацию"""
-        d = super().dict(*args, **kwargs)
-        d['available_models'] = self.available_models
-        d['available_sizes'] = self.available_sizes
-        d['available_qualities'] = self.available_qualities
-        d['available_styles'] = self.available_styles
-        d['supports_hdr'] = self.supports_hdr
-        return d
-
-class UserSettings(BaseModel):
+    def supports_hdr(self) -> bool:
+        return self.capabilities.hdr
+
+class UserSettings:
+    """Настройки и история сообщений пользователя."""
+
+    __slots__ = ("user_id", "text_settings", "image_settings", "message_history")
+
+    def __init__(self, user_id: int, text_settings: Optional[TextModelSettings] = None,
+                 image_settings: Optional[ImageModelSettings] = None,
+                 message_history: Optional[MessageHistory] = None):
+        self.user_id = user_id
+        self.text_settings = text_settings if text_settings is not None else TextModelSettings()
+        self.image_settings = image_settings if image_settings is not None else ImageModelSettings()
+        # В памяти - компактная MessageHistory, при сериализации - список словарей
+        self.message_history = message_history if message_history is not None else MessageHistory()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserSettings":
+        """Создает пользователя из словаря хранилища (данные уже проверены при записи)."""
+        return cls(
+            user_id=data["user_id"],
+            text_settings=TextModelSettings.from_dict(data.get("text_settings") or {}),
+            image_settings=ImageModelSettings.from_dict(data.get("image_settings") or {}),
+            message_history=MessageHistory.coerce(data.get("message_history"))
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "text_settings": self.text_settings.to_dict(),
+            "image_settings": self.image_settings.to_dict(),
+            "message_history": self.message_history.to_dicts(),
+        }
+
+
+# Схемы pydantic для проверки настроек на границе: импорт файла
+# пользователя и экспорт. Неизвестные ключи (в том числе вычисляемые поля
+# из старых файлов экспорта) отбрасываются
+class TextSettingsSchema(BaseModel):
+    base_url: str = DEFAULT_BASE_URL
+    model: str = "gpt-4o-mini"
+    temperature: float = 0.7
+    max_tokens: int = 1000
+    custom_model: Optional[str] = None
+
+class ImageSettingsSchema(BaseModel):
+    base_url: str = DEFAULT_BASE_URL
+    model: Literal[IMAGE_MODELS] = DEFAULT_IMAGE_MODEL
+    size: str = "1024x1024"
+    quality: str = "standard"
+    style: str = "natural"
+    hdr: bool = False
+
+class MessageSchema(BaseModel):
+    role: str
+    content: str
+
+class UserSettingsSchema(BaseModel):
     user_id: int
-    text_settings: TextModelSettings = TextModelSettings()
-    image_settings: ImageModelSettings = ImageModelSettings()
-    message_history: list = []
+    text_settings: TextSettingsSchema = Field(default_factory=TextSettingsSchema)
+    image_settings: ImageSettingsSchema = Field(default_factory=ImageSettingsSchema)
+    message_history: list[MessageSchema] = Field(default_factory=list)
 
 class SettingsManager:
-    def __init__(self, settings_file="user_settings.json"):
+    """
+    Единый для процесса менеджер настроек и истории пользователей.
+
+    Изменения не записываются сразу: пользователи помечаются как измененные,
+    а запись выполняется одной транзакцией после короткой паузы в фоновом
+    потоке. Так серия обновлений за это время превращается в одну запись.
+
+    Если хранилище общее для нескольких процессов, каждая запись проверяет
+    версию пользователя. Когда другой процесс успел изменить историю,
+    добавленные здесь сообщения не теряются: пользователь перечитывается
+    из хранилища, сообщения добавляются поверх и записываются повторно.
+
+    При запуске читается только список ID пользователей, а настройки и
+    история каждого загружаются при первом обращении.
+    """
+
+    def __init__(self, settings_file="user_settings.json", storage: Optional[StateBackend] = None,
+                 flush_delay: float = SETTINGS_FLUSH_DELAY,
+                 memory_budget_mb: float = HISTORY_MEMORY_BUDGET_MB):
+        # settings_file - старый JSON-файл, данные из которого переносятся в базу
         self.settings_file = settings_file
+        self.storage = storage if storage is not None else state_backend
+        self.flush_delay = flush_delay
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
         self.users: dict[int, UserSettings] = {}
+        # Порядок последнего обращения к загруженным пользователям (LRU)
+        self._last_used: OrderedDict[int, None] = OrderedDict()
+        # Пользователи, которые есть в хранилище, но не загружены в память:
+        # еще не обращались после запуска или выгружены по бюджету памяти
+        self._unloaded: set[int] = set()
+        self._memory_checked_at = 0.0
+        # Версии пользователей в хранилище, на которых основан кэш
+        self.versions: dict[int, int] = {}
+        # Пользователи, чьи изменения сейчас записываются
+        self._writing: set[int] = set()
+        # Сколько раз запись натыкалась на изменения другого процесса
+        self.conflicts = 0
+        # Пользователи, чьи настройки нужно записать
+        self._dirty_settings: set[int] = set()
+        # Сообщения, добавленные с момента последней записи
+        self._pending_messages: dict[int, list[dict]] = {}
+        # Пользователи, чью историю нужно переписать целиком (очистка, импорт)
+        self._reset_history: set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        # Занята, пока пачка изменений записывается в хранилище (в том числе
+        # в фоновом потоке): синхронная запись при выходе дожидается ее
+        self._write_lock = threading.RLock()
         self.load_settings()
 
     def load_settings(self):
         try:
-            if os.path.exists(self.settings_file):
-                with open(self.settings_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for user_id, settings in data.items():
-                        self.users[int(user_id)] = UserSettings.parse_obj(settings)
-                logger.info("Настройки успешно загружены")
+            self.storage.migrate_from_json(self.settings_file)
+        except Exception as e:
+            logger.error(f"Ошибка при переносе настроек из {self.settings_file}: {e}")
+        try:
+            # При запуске читается только список пользователей; настройки и
+            # история загружаются при первом обращении (sync_user)
+            self._unloaded = set(self.storage.user_ids())
+            logger.info(f"Найдено пользователей в хранилище: {len(self._unloaded)}")
         except Exception as e:
             logger.error(f"Ошибка при загрузке настроек: {e}")
 
+    def _load_user(self, user_id: int) -> Optional[dict]:
+        """Загружает пользователя из хранилища; история - не больше, чем хранится в памяти."""
+        return self.storage.load_user(user_id, history_limit=HISTORY_MAX_MESSAGES or None)
+
     def save_settings(self):
+        """Полностью перезаписывает настройки и историю всех пользователей."""
         try:
-            data = {str(user_id): settings.dict() for user_id, settings in self.users.items()}
-            with open(self.settings_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+            self.storage.replace_all({
+                user_id: settings.to_dict() for user_id, settings in self.users.items()
+            })
+            for user_id in self.users:
+                self.versions[user_id] = self.versions.get(user_id, 0) + 1
+            self._dirty_settings.clear()
+            self._pending_messages.clear()
+            self._reset_history.clear()
             logger.info("Настройки успешно сохранены")
         except Exception as e:
             logger.error(f"Ошибка при сохранении настроек: {e}")
 
+    def _take_pending(self):
+        """Забирает накопленные изменения, копируя данные для записи и версии."""
+        settings_rows = {}
+        for user_id in self._dirty_settings:
+            settings = self.users.get(user_id)
+            if settings is not None:
+                settings_rows[user_id] = (
+                    settings.text_settings.to_dict(),
+                    settings.image_settings.to_dict()
+                )
+        # Хранилищу передаются обычные словари
+        histories = {
+            user_id: self.users[user_id].message_history.to_dicts()
+            for user_id in self._reset_history if user_id in self.users
+        }
+        appended = {
+            user_id: [message_dict(message) for message in messages]
+            for user_id, messages in self._pending_messages.items()
+        }
+        self._dirty_settings = set()
+        self._pending_messages = {}
+        self._reset_history = set()
+        versions = {
+            user_id: self.versions.get(user_id, 0)
+            for user_id in set(settings_rows) | set(appended) | set(histories)
+        }
+        return settings_rows, appended, histories, versions
+
+    def _restore_pending(self, settings_rows, appended, histories, versions):
+        """Возвращает изменения в очередь после неудачной записи."""
+        self._dirty_settings.update(settings_rows)
+        self._reset_history.update(histories)
+        for user_id, messages in appended.items():
+            self._pending_messages[user_id] = messages + self._pending_messages.get(user_id, [])
+
+    @property
+    def has_pending_changes(self) -> bool:
+        return bool(self._dirty_settings or self._pending_messages or self._reset_history)
+
+    def pending_count(self) -> int:
+        """Количество пользователей с незаписанными изменениями."""
+        return len(self._dirty_settings | set(self._pending_messages) | self._reset_history)
+
+    def _has_local_changes(self, user_id: int) -> bool:
+        return (
+            user_id in self._dirty_settings or user_id in self._pending_messages
+            or user_id in self._reset_history or user_id in self._writing
+        )
+
+    def _merge_user(self, user_id: int, data: Optional[dict], withheld: list[dict], keep_settings: bool):
+        """
+        Обновляет кэш пользователя данными из хранилища.
+
+        Args:
+            data: Пользователь из хранилища (None, если его там нет)
+            withheld: Сообщения, не записанные из-за несовпадения версии
+            keep_settings: Оставить локальные настройки (они уже записаны)
+        """
+        data = data or {"user_id": user_id, "text_settings": {}, "image_settings": {},
+                        "message_history": [], "version": 0}
+        newer = self._pending_messages.get(user_id, [])
+        settings = self.users.get(user_id)
+        if settings is None:
+            settings = UserSettings.from_dict(data)
+            settings.message_history.extend(withheld + newer)
+            self._set_user(user_id, settings)
+        elif user_id not in self._reset_history:
+            # Меняем список на месте: обработчики могут держать ссылку на него
+            settings.message_history[:] = data["message_history"] + withheld + newer
+            if not keep_settings and user_id not in self._dirty_settings:
+                settings.text_settings = TextModelSettings.from_dict(data["text_settings"])
+                settings.image_settings = ImageModelSettings.from_dict(data["image_settings"])
+        if withheld:
+            self._pending_messages[user_id] = withheld + newer
+        self.versions[user_id] = data["version"]
+
+    def _apply_write_result(self, batch, result, loaded: dict[int, Optional[dict]]):
+        """Запоминает новые версии и объединяет историю устаревших пользователей."""
+        settings_rows, appended, histories, versions = batch
+        new_versions, stale = result
+        self.versions.update(new_versions)
+        self.conflicts += len(stale)
+        for user_id in stale:
+            withheld = appended.get(user_id, []) if user_id not in histories else []
+            self._merge_user(user_id, loaded.get(user_id), withheld, keep_settings=user_id in settings_rows)
+            logger.info(f"Пользователь {user_id} изменен другим процессом, изменения объединены")
+        logger.debug(f"Записаны изменения {len(settings_rows)} настроек и истории {len(appended) + len(histories)} пользователей")
+
+    def _write_and_load(self, batch):
+        """Записывает пачку изменений и перечитывает пользователей с устаревшей версией."""
+        with self._write_lock:
+            result = self.storage.write_batch(*batch)
+            return result, {user_id: self._load_user(user_id) for user_id in result[1]}
+
+    def flush(self):
+        """
+        Синхронно записывает все накопленные изменения.
+
+        Запись, начатая в фоне, к этому моменту уже убрана из очереди, поэтому
+        сначала дожидаемся ее окончания. Из event loop перед остановкой или
+        перезапуском процесса нужно вызывать drain().
+        """
+        with self._write_lock:
+            pass
+        # Повторяем запись, если часть сообщений отложена из-за несовпадения версии
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            if not self.has_pending_changes:
+                return
+            batch = self._take_pending()
+            try:
+                result, loaded = self._write_and_load(batch)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении настроек: {e}")
+                self._restore_pending(*batch)
+                return
+            self._apply_write_result(batch, result, loaded)
+        self._enforce_memory_budget()
+
+    async def _flush_later(self):
+        # Задача остается в _flush_task до конца записи: новые изменения
+        # дождутся ее, а drain() может дождаться записи перед остановкой
+        try:
+            await asyncio.sleep(self.flush_delay)
+            await self._write_pending()
+        finally:
+            self._flush_task = None
+        if self.has_pending_changes:
+            self._schedule_flush()
+        # Выгружать можно только пользователей, чьи изменения уже записаны
+        self._enforce_memory_budget()
+
+    async def _write_pending(self):
+        if not self.has_pending_changes:
+            return
+        batch = self._take_pending()
+        self._writing = set(batch[3])
+        try:
+            # Запись в базу выполняется вне event loop
+            result, loaded = await asyncio.to_thread(self._write_and_load, batch)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении настроек: {e}")
+            self._restore_pending(*batch)
+            return
+        finally:
+            self._writing = set()
+        self._apply_write_result(batch, result, loaded)
+
+    async def drain(self):
+        """
+        Дожидается отложенной записи и записывает оставшиеся изменения.
+
+        Вызывается перед остановкой event loop: если прервать запись на
+        середине, сообщения, отложенные из-за несовпадения версии, не
+        вернутся в очередь и будут потеряны.
+        """
+        while self._flush_task is not None:
+            task = self._flush_task
+            if not self._writing:
+                # Задача еще ждет flush_delay - записываем сразу
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            # Задача, отмененная до запуска, не сбрасывает _flush_task сама
+            if self._flush_task is task:
+                self._flush_task = None
+        self.flush()
+
+    async def sync_user(self, user_id: int):
+        """
+        Подгружает пользователя из хранилища перед обработкой его сообщения.
+
+        Загружает пользователя, которого еще нет в памяти (первое обращение
+        после запуска или выгрузка по бюджету памяти), а для общего
+        хранилища - еще и изменения, сделанные другим процессом.
+        """
+        if user_id in self._unloaded:
+            try:
+                data = await asyncio.to_thread(self._load_user, user_id)
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке пользователя {user_id} из хранилища: {e}")
+                return
+            # Пока шел запрос, пользователь мог быть загружен синхронно
+            if user_id in self._unloaded:
+                self._restore_user(user_id, data)
+            return
+        if not self.storage.shared or self._has_local_changes(user_id):
+            return
+        try:
+            version = await asyncio.to_thread(self.storage.get_version, user_id)
+            if version == self.versions.get(user_id, 0):
+                return
+            data = await asyncio.to_thread(self._load_user, user_id)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке пользователя {user_id} из хранилища: {e}")
+            return
+        # Пока шел запрос, пользователь мог измениться локально
+        if data is not None and not self._has_local_changes(user_id):
+            self._merge_user(user_id, data, [], keep_settings=False)
+
+    def user_ids(self) -> list[int]:
+        """ID всех пользователей, включая выгруженных и созданных другими процессами."""
+        if self.storage.shared:
+            return self.storage.user_ids()
+        return list(self.users) + list(self._unloaded)
+
+    def _set_user(self, user_id: int, settings: UserSettings):
+        self.users[user_id] = settings
+        self._unloaded.discard(user_id)
+        self._last_used[user_id] = None
+        self._last_used.move_to_end(user_id)
+
+    def _restore_user(self, user_id: int, data: Optional[dict]):
+        """Загружает в память пользователя, прочитанного из хранилища."""
+        self._unloaded.discard(user_id)
+        if data is None:
+            return
+        self._set_user(user_id, UserSettings.from_dict(data))
+        self.versions[user_id] = data.get("version", 0)
+        self._enforce_memory_budget()
+
+    def memory_usage(self) -> int:
+        """Примерный объем памяти, занятый загруженными пользователями (байты)."""
+        return sum(
+            settings.message_history.nbytes + USER_OVERHEAD_BYTES
+            for settings in self.users.values()
+        )
+
+    def _enforce_memory_budget(self, force: bool = False):
+        """
+        Выгружает давно неактивных пользователей, если превышен бюджет памяти.
+
+        Выгружаются только пользователи без незаписанных изменений: их
+        данные уже есть в хранилище. Бюджет проверяется не чаще
+        MEMORY_CHECK_INTERVAL секунд.
+        """
+        if not self.memory_budget:
+            return
+        now = time.monotonic()
+        if not force and now - self._memory_checked_at < MEMORY_CHECK_INTERVAL:
+            return
+        self._memory_checked_at = now
+        usage = self.memory_usage()
+        if usage <= self.memory_budget:
+            return
+        # Выгружаем с запасом, чтобы не проверять бюджет на каждом шаге
+        target = self.memory_budget * 0.9
+        evicted = 0
+        for user_id in list(self._last_used):
+            if usage <= target:
+                break
+            if self._has_local_changes(user_id):
+                continue
+            settings = self.users.pop(user_id, None)
+            del self._last_used[user_id]
+            if settings is None:
+                continue
+            usage -= settings.message_history.nbytes + USER_OVERHEAD_BYTES
+            self.versions.pop(user_id, None)
+            self._unloaded.add(user_id)
+            evicted += 1
+        logger.info(
+            f"Выгружено из памяти пользователей: {evicted}, "
+            f"занято {usage / 1024 / 1024:.1f} из {self.memory_budget / 1024 / 1024:.0f} МБ"
+        )
+
+    def _schedule_flush(self):
+        """Планирует отложенную запись, объединяя изменения за flush_delay."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (скрипты, миграции) пишем сразу
+            self.flush()
+            return
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_later())
+
+    def mark_dirty(self, user_id: int):
+        """Помечает настройки пользователя как измененные."""
+        self._dirty_settings.add(user_id)
+        self._schedule_flush()
+
     def get_user_settings(self, user_id: int) -> UserSettings:
-        if user_id not in self.users:
-            self.users[user_id] = UserSettings(user_id=user_id)
+        settings = self.users.get(user_id)
+        if settings is not None:
+            self._last_used.move_to_end(user_id)
+            return settings
+        if user_id in self._unloaded:
+            # Обычно пользователя заранее загружает sync_user, здесь - запасной путь
+            try:
+                self._restore_user(user_id, self._load_user(user_id))
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке пользователя {user_id} из хранилища: {e}")
+            if user_id in self.users:
+                return self.users[user_id]
+        self._set_user(user_id, UserSettings(user_id=user_id))
+        self.mark_dirty(user_id)
         return self.users[user_id]
 
+    def append_message(self, user_id: int, message: dict):
+        """Добавляет сообщение в историю пользователя и планирует его запись."""
+        settings = self.get_user_settings(user_id)
+        message = Message.coerce(message)
+        settings.message_history.append(message)
+        self._pending_messages.setdefault(user_id, []).append(message)
+        self._schedule_flush()
+
     def update_text_settings(self, user_id: int, **kwargs):
         settings = self.get_user_settings(user_id)
         for key, value in kwargs.items():
-            if hasattr(settings.text_settings, key):
+            if key in TextModelSettings.__slots__:
                 setattr(settings.text_settings, key, value)
-        self.save_settings()
+        self.mark_dirty(user_id)
         logger.debug(f"Обновлены текстовые настройки для пользователя {user_id}: {kwargs}")
 
     def update_image_settings(self, user_id: int, **kwargs):
         settings = self.get_user_settings(user_id)
         for key, value in kwargs.items():
-            if hasattr(settings.image_settings, key):
+            if key in ImageModelSettings.__slots__:
                 setattr(settings.image_settings, key, value)
-        self.save_settings()
+        self.mark_dirty(user_id)
         logger.debug(f"Обновлены настройки изображений для пользователя {user_id}: {kwargs}")
 
     def clear_message_history(self, user_id: int):
         settings = self.get_user_settings(user_id)
         settings.message_history.clear()
-        self.save_settings()
+        self._pending_messages.pop(user_id, None)
+        self._reset_history.add(user_id)
+        self._schedule_flush()
         logger.info(f"Очищена история сообщений для пользователя {user_id}")
 
     def export_settings(self, user_id: int) -> str:
         settings = self.get_user_settings(user_id)
-        return json.dumps(settings.dict(), ensure_ascii=False, indent=4)
+        # Экспортируются только сохраняемые поля, без вычисляемых
+        return UserSettingsSchema.model_validate(settings.to_dict()).model_dump_json(indent=4)
 
     def import_settings(self, user_id: int, settings_json: str):
         try:
-            settings_dict = json.loads(settings_json)
-            self.users[user_id] = UserSettings.parse_obj(settings_dict)
-            self.save_settings()
+            schema = UserSettingsSchema.model_validate(json.loads(settings_json))
+            settings = UserSettings.from_dict(dict(schema.model_dump(), user_id=user_id))
+            self._set_user(user_id, settings)
+            self._pending_messages.pop(user_id, None)
+            self._dirty_settings.add(user_id)
+            self._reset_history.add(user_id)
+            self._schedule_flush()
             logger.info(f"Настройки успешно импортированы для пользователя {user_id}")
         except Exception as e:
             logger.error(f"Ошибка при импорте настроек: {e}")
-            raise ValueError("Неверный формат настроек") 
\ No newline at end of file
+            raise ValueError("Неверный формат настроек")
+
+
+# Единственный экземпляр менеджера настроек для всего процесса
+settings_manager = SettingsManager()
@@ -0,0 +1,88 @@
+import os
+import time
+from typing import Optional
+from dotenv import load_dotenv
+from loguru import logger
+from history import HISTORY_MAX_MESSAGES
+from storage import MemoryStorage, RedisStorage, SQLiteStorage, StateBackend
+
+# Загрузка переменных окружения
+load_dotenv()
+
+# Хранилище состояния: sqlite (по умолчанию), redis или memory
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite').lower()
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', 'user_settings.db')
+# Файл SQLite используют несколько процессов бота одновременно
+STATE_SHARED = os.getenv('STATE_SHARED', 'False').lower() == 'true'
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_PREFIX = os.getenv('REDIS_PREFIX', 'gptbot:')
+# Сколько последних сообщений пользователя хранить в журнале истории
+# (0 - без ограничения); не меньше HISTORY_MAX_MESSAGES
+HISTORY_STORED_MESSAGES = int(os.getenv('HISTORY_STORED_MESSAGES', '1000'))
+# Как долго доверять закэшированным спискам доступа и флагам общего хранилища
+STATE_CACHE_TTL = float(os.getenv('STATE_CACHE_TTL', '2'))
+
+
+def create_state_backend(kind: str = STATE_BACKEND) -> StateBackend:
+    """Создает хранилище состояния по имени."""
+    retention = None
+    if HISTORY_STORED_MESSAGES:
+        retention = max(HISTORY_STORED_MESSAGES, HISTORY_MAX_MESSAGES)
+    if kind == 'redis':
+        backend = RedisStorage(REDIS_URL, prefix=REDIS_PREFIX, history_retention=retention)
+    elif kind == 'memory':
+        backend = MemoryStorage(history_retention=retention)
+    elif kind == 'sqlite':
+        backend = SQLiteStorage(STATE_DB_FILE, shared=STATE_SHARED, history_retention=retention)
+    else:
+        raise ValueError(f"Неизвестное хранилище состояния: {kind}")
+    logger.debug(f"Хранилище состояния: {kind} ({backend}), общее: {backend.shared}")
+    return backend
+
+
+class StateFlag:
+    """
+    Флаг состояния бота (например, режим обслуживания).
+
+    Для локального хранилища флаг - файл-маркер, как и раньше. В общем
+    хранилище флаг виден всем репликам; его значение кэшируется на
+    STATE_CACHE_TTL секунд, чтобы не обращаться к хранилищу на каждое
+    сообщение.
+    """
+
+    def __init__(self, name: str, path: str, backend: StateBackend, ttl: float = STATE_CACHE_TTL):
+        self.name = name
+        self.path = path
+        self.backend = backend
+        self.ttl = ttl
+        self._value = False
+        self._loaded_at: Optional[float] = None
+
+    def is_set(self) -> bool:
+        if not self.backend.shared:
+            return os.path.exists(self.path)
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.ttl:
+            self._value = self.backend.get_flag(self.name)
+            self._loaded_at = now
+        return self._value
+
+    def set(self, value: bool):
+        if not self.backend.shared:
+            if value:
+                with open(self.path, 'w') as f:
+                    f.write('1')
+            else:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+            return
+        self.backend.set_flag(self.name, value)
+        self._value = value
+        self._loaded_at = time.monotonic()
+
+
+# Единственное хранилище состояния для всего процесса
+state_backend = create_state_backend()
+maintenance_flag = StateFlag('maintenance', 'maintenance_mode', state_backend)
@@ -0,0 +1,766 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+from typing import Iterable, Optional
+from loguru import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id INTEGER PRIMARY KEY,
+    text_settings TEXT NOT NULL,
+    image_settings TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id);
+CREATE TABLE IF NOT EXISTS state_set_names (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS state_sets (
+    name TEXT NOT NULL,
+    member INTEGER NOT NULL,
+    PRIMARY KEY (name, member)
+);
+CREATE TABLE IF NOT EXISTS state_flags (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Результат записи: новые версии пользователей и пользователи, чья версия
+# в хранилище не совпала с ожидаемой
+WriteResult = tuple[dict[int, int], set[int]]
+
+
+class StateBackend:
+    """
+    Интерфейс хранилища состояния бота.
+
+    Хранит настройки и историю пользователей, именованные множества ID
+    (списки доступа) и флаги (режим обслуживания). У каждого пользователя
+    есть версия, которая увеличивается при каждой записи: по ней несколько
+    процессов, работающих с одним хранилищем, обнаруживают параллельные
+    изменения (оптимистичная блокировка).
+
+    Атрибут shared означает, что хранилище могут одновременно использовать
+    несколько процессов или реплик бота. Атрибут history_retention
+    ограничивает журнал истории каждого пользователя последними
+    сообщениями: более старые удаляются при записи (None - без ограничения).
+    """
+
+    shared = False
+    history_retention: Optional[int] = None
+
+    # Настройки и история пользователей
+
+    def is_empty(self) -> bool:
+        raise NotImplementedError
+
+    def load_all(self) -> dict[int, dict]:
+        """
+        Загружает настройки и историю всех пользователей.
+
+        Returns:
+            dict: {user_id: {"user_id", "text_settings", "image_settings",
+            "message_history", "version"}}
+        """
+        raise NotImplementedError
+
+    def load_user(self, user_id: int, history_limit: Optional[int] = None) -> Optional[dict]:
+        """
+        Загружает одного пользователя в формате load_all или None.
+
+        Args:
+            history_limit: Сколько последних сообщений истории загрузить
+                (None - всю историю)
+        """
+        raise NotImplementedError
+
+    def get_version(self, user_id: int) -> int:
+        """Текущая версия пользователя (0, если его нет в хранилище)."""
+        raise NotImplementedError
+
+    def user_ids(self) -> list[int]:
+        raise NotImplementedError
+
+    def count_messages(self) -> int:
+        """Общее количество сообщений в истории всех пользователей."""
+        raise NotImplementedError
+
+    def replace_all(self, users: dict[int, dict]):
+        """Перезаписывает всех переданных пользователей."""
+        raise NotImplementedError
+
+    def write_batch(self, settings_rows: dict[int, tuple[dict, dict]],
+                    appended: dict[int, list[dict]], histories: dict[int, list[dict]],
+                    versions: Optional[dict[int, int]] = None) -> WriteResult:
+        """
+        Записывает накопленные изменения.
+
+        Args:
+            settings_rows: {user_id: (text_settings, image_settings)}
+            appended: {user_id: сообщения, добавленные в конец истории}
+            histories: {user_id: полная история} для пользователей, чья
+                история была очищена или заменена целиком
+            versions: {user_id: версия, на основе которой сделаны изменения}.
+                Если версия в хранилище отличается, добавленные сообщения
+                этого пользователя не записываются (настройки и замененная
+                целиком история записываются всегда)
+
+        Returns:
+            WriteResult: (новые версии пользователей, пользователи с
+            несовпавшей версией, которых нужно перечитать)
+        """
+        raise NotImplementedError
+
+    def migrate_from_json(self, json_file: str) -> Optional[int]:
+        """
+        Переносит данные из старого файла user_settings.json.
+
+        Перенос выполняется одной записью, после чего исходный файл
+        переименовывается в *.migrated, чтобы не импортировать его повторно.
+
+        Returns:
+            Optional[int]: Количество перенесенных пользователей или None,
+            если переносить нечего
+        """
+        if not os.path.exists(json_file) or not self.is_empty():
+            return None
+
+        with open(json_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        users = {}
+        for user_id, settings in data.items():
+            users[int(user_id)] = {
+                "text_settings": settings.get("text_settings", {}),
+                "image_settings": settings.get("image_settings", {}),
+                "message_history": [
+                    m for m in settings.get("message_history", [])
+                    if isinstance(m, dict) and "role" in m and "content" in m
+                ]
+            }
+        self.replace_all(users)
+        os.replace(json_file, json_file + ".migrated")
+        logger.info(f"Перенесены настройки {len(users)} пользователей из {json_file} в {self}")
+        return len(users)
+
+    # Множества ID и флаги
+
+    def set_members(self, name: str) -> Optional[list[int]]:
+        """Элементы множества или None, если множество еще не создано."""
+        raise NotImplementedError
+
+    def set_add(self, name: str, member: int) -> bool:
+        """Добавляет элемент. Возвращает False, если он уже был в множестве."""
+        raise NotImplementedError
+
+    def set_remove(self, name: str, member: int) -> bool:
+        """Удаляет элемент. Возвращает False, если его не было в множестве."""
+        raise NotImplementedError
+
+    def set_replace(self, name: str, members: Iterable[int]):
+        """Создает множество или заменяет его содержимое."""
+        raise NotImplementedError
+
+    def get_flag(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def set_flag(self, name: str, value: bool):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(StateBackend):
+    """
+    Хранилище настроек и истории сообщений пользователей на базе SQLite.
+
+    Настройки хранятся небольшой записью на пользователя, история - как
+    журнал сообщений, в который только добавляются строки. Каждая пачка
+    изменений записывается одной транзакцией, поэтому сбой процесса не
+    может оставить файл в частично записанном состоянии.
+
+    При shared=True файл базы используют несколько процессов бота на одном
+    сервере (или общем томе с поддержкой блокировок): транзакция записи
+    захватывает базу сразу (BEGIN IMMEDIATE), а версии пользователей
+    проверяются внутри нее.
+
+    Журнал истории обрезается до history_retention сообщений при открытии
+    базы и затем периодически в транзакции записи: у пользователя, которому
+    с прошлой обрезки добавлено не меньше четверти этого числа сообщений.
+    """
+
+    def __init__(self, db_file: str = "user_settings.db", shared: bool = False,
+                 history_retention: Optional[int] = None):
+        self.db_file = db_file
+        self.shared = shared
+        self.history_retention = history_retention
+        # Сколько сообщений добавлено пользователю с последней обрезки журнала
+        self._appended_since_trim: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        # WAL-журнал дает атомарные транзакции без блокировки читателей
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(user_settings)")]
+        if "version" not in columns:
+            # База, созданная до появления версий
+            self._conn.execute("ALTER TABLE user_settings ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        if history_retention:
+            deleted = self._conn.execute(
+                "DELETE FROM messages WHERE id IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER "
+                "(PARTITION BY user_id ORDER BY id DESC) AS position FROM messages) WHERE position > ?)",
+                (history_retention,)
+            ).rowcount
+            if deleted:
+                logger.info(f"Из журнала истории удалено {deleted} старых сообщений")
+        self._conn.commit()
+
+    def __str__(self):
+        return self.db_file
+
+    def is_empty(self) -> bool:
+        """Проверяет, есть ли в хранилище хотя бы один пользователь."""
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM user_settings LIMIT 1").fetchone()
+        return row is None
+
+    def load_all(self) -> dict[int, dict]:
+        users = {}
+        with self._lock:
+            for user_id, text_settings, image_settings, version in self._conn.execute(
+                "SELECT user_id, text_settings, image_settings, version FROM user_settings"
+            ):
+                users[user_id] = {
+                    "user_id": user_id,
+                    "text_settings": json.loads(text_settings),
+                    "image_settings": json.loads(image_settings),
+                    "message_history": [],
+                    "version": version
+                }
+            for user_id, role, content in self._conn.execute(
+                "SELECT user_id, role, content FROM messages ORDER BY id"
+            ):
+                if user_id in users:
+                    users[user_id]["message_history"].append({"role": role, "content": content})
+        return users
+
+    def load_user(self, user_id: int, history_limit: Optional[int] = None) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text_settings, image_settings, version FROM user_settings WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            if history_limit:
+                # Последние сообщения по индексу (user_id, id), без чтения всего журнала
+                rows = self._conn.execute(
+                    "SELECT role, content FROM (SELECT id, role, content FROM messages "
+                    "WHERE user_id = ? ORDER BY id DESC LIMIT ?) ORDER BY id",
+                    (user_id, history_limit)
+                )
+            else:
+                rows = self._conn.execute(
+                    "SELECT role, content FROM messages WHERE user_id = ? ORDER BY id", (user_id,)
+                )
+            history = [{"role": role, "content": content} for role, content in rows]
+        return {
+            "user_id": user_id,
+            "text_settings": json.loads(row[0]),
+            "image_settings": json.loads(row[1]),
+            "message_history": history,
+            "version": row[2]
+        }
+
+    def get_version(self, user_id: int) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM user_settings WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def user_ids(self) -> list[int]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT user_id FROM user_settings")]
+
+    def count_messages(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def replace_all(self, users: dict[int, dict]):
+        """Перезаписывает всех переданных пользователей одной транзакцией."""
+        with self._lock, self._conn:
+            for user_id, data in users.items():
+                self._upsert_settings(user_id, data["text_settings"], data["image_settings"])
+                self._replace_history(user_id, data.get("message_history", []))
+                self._conn.execute(
+                    "UPDATE user_settings SET version = version + 1 WHERE user_id = ?", (user_id,)
+                )
+
+    def _versions(self, user_ids: Iterable[int]) -> dict[int, int]:
+        user_ids = list(user_ids)
+        versions = {}
+        # Ограничение SQLite на количество параметров запроса
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            versions.update(self._conn.execute(
+                f"SELECT user_id, version FROM user_settings WHERE user_id IN ({placeholders})", chunk
+            ))
+        return versions
+
+    def write_batch(self, settings_rows: dict[int, tuple[dict, dict]],
+                    appended: dict[int, list[dict]], histories: dict[int, list[dict]],
+                    versions: Optional[dict[int, int]] = None) -> WriteResult:
+        with self._lock, self._conn:
+            # Захватываем базу до чтения версий, чтобы другой процесс
+            # не записал изменения между проверкой и записью
+            self._conn.execute("BEGIN IMMEDIATE")
+            user_ids = set(settings_rows) | set(appended) | set(histories)
+            current = self._versions(user_ids)
+            stale = set()
+            if versions is not None:
+                stale = {user_id for user_id in user_ids if versions.get(user_id, 0) != current.get(user_id, 0)}
+
+            new_versions = {}
+            for user_id in user_ids:
+                applied = False
+                if user_id in settings_rows:
+                    self._upsert_settings(user_id, *settings_rows[user_id])
+                    applied = True
+                if user_id in histories:
+                    self._replace_history(user_id, histories[user_id])
+                    applied = True
+                elif appended.get(user_id) and user_id not in stale:
+                    self._conn.executemany(
+                        "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+                        [(user_id, m["role"], m["content"]) for m in appended[user_id]]
+                    )
+                    self._trim_history(user_id, len(appended[user_id]))
+                    applied = True
+                if not applied:
+                    continue
+                if user_id not in current and user_id not in settings_rows:
+                    self._upsert_settings(user_id, {}, {})
+                version = current.get(user_id, 0) + 1
+                self._conn.execute(
+                    "UPDATE user_settings SET version = ? WHERE user_id = ?", (version, user_id)
+                )
+                if user_id not in stale:
+                    new_versions[user_id] = version
+        return new_versions, stale
+
+    def _upsert_settings(self, user_id, text_settings, image_settings):
+        self._conn.execute(
+            "INSERT INTO user_settings (user_id, text_settings, image_settings) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET "
+            "text_settings = excluded.text_settings, image_settings = excluded.image_settings",
+            (user_id, json.dumps(text_settings, ensure_ascii=False),
+             json.dumps(image_settings, ensure_ascii=False))
+        )
+
+    def _replace_history(self, user_id, message_history):
+        self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+        if self.history_retention:
+            message_history = message_history[-self.history_retention:]
+            self._appended_since_trim.pop(user_id, None)
+        self._conn.executemany(
+            "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+            [(user_id, m["role"], m["content"]) for m in message_history]
+        )
+
+    def _trim_history(self, user_id: int, added: int):
+        """Удаляет из журнала пользователя сообщения старше history_retention последних."""
+        if not self.history_retention:
+            return
+        added += self._appended_since_trim.get(user_id, 0)
+        if added < max(1, self.history_retention // 4):
+            self._appended_since_trim[user_id] = added
+            return
+        self._appended_since_trim.pop(user_id, None)
+        self._conn.execute(
+            "DELETE FROM messages WHERE user_id = ? AND id <= (SELECT id FROM messages "
+            "WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (user_id, user_id, self.history_retention)
+        )
+
+    def set_members(self, name: str) -> Optional[list[int]]:
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM state_set_names WHERE name = ?", (name,)).fetchone() is None:
+                return None
+            return [row[0] for row in self._conn.execute(
+                "SELECT member FROM state_sets WHERE name = ? ORDER BY rowid", (name,)
+            )]
+
+    def set_add(self, name: str, member: int) -> bool:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO state_set_names (name) VALUES (?)", (name,))
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO state_sets (name, member) VALUES (?, ?)", (name, member)
+            )
+            return cursor.rowcount > 0
+
+    def set_remove(self, name: str, member: int) -> bool:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM state_sets WHERE name = ? AND member = ?", (name, member)
+            )
+            return cursor.rowcount > 0
+
+    def set_replace(self, name: str, members: Iterable[int]):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO state_set_names (name) VALUES (?)", (name,))
+            self._conn.execute("DELETE FROM state_sets WHERE name = ?", (name,))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO state_sets (name, member) VALUES (?, ?)",
+                [(name, member) for member in members]
+            )
+
+    def get_flag(self, name: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state_flags WHERE name = ?", (name,)).fetchone()
+        return bool(row and row[0])
+
+    def set_flag(self, name: str, value: bool):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO state_flags (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                (name, int(value))
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MemoryStorage(StateBackend):
+    """
+    Хранилище в памяти процесса.
+
+    Повторяет поведение общих хранилищ (версии, множества, флаги) и
+    используется как их замена в локальных проверках: несколько
+    SettingsManager с одним MemoryStorage ведут себя как реплики бота
+    с общим хранилищем. Данные не сохраняются между запусками.
+    """
+
+    def __init__(self, shared: bool = True, history_retention: Optional[int] = None):
+        self.shared = shared
+        self.history_retention = history_retention
+        self._lock = threading.Lock()
+        self._users: dict[int, dict] = {}
+        self._sets: dict[str, list[int]] = {}
+        self._flags: dict[str, bool] = {}
+
+    def __str__(self):
+        return "memory"
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not self._users
+
+    def load_all(self) -> dict[int, dict]:
+        with self._lock:
+            return copy.deepcopy(self._users)
+
+    def load_user(self, user_id: int, history_limit: Optional[int] = None) -> Optional[dict]:
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                return None
+            if history_limit:
+                user = {**user, "message_history": user["message_history"][-history_limit:]}
+            return copy.deepcopy(user)
+
+    def get_version(self, user_id: int) -> int:
+        with self._lock:
+            user = self._users.get(user_id)
+            return user["version"] if user else 0
+
+    def user_ids(self) -> list[int]:
+        with self._lock:
+            return list(self._users)
+
+    def count_messages(self) -> int:
+        with self._lock:
+            return sum(len(user["message_history"]) for user in self._users.values())
+
+    def _user(self, user_id: int) -> dict:
+        if user_id not in self._users:
+            self._users[user_id] = {
+                "user_id": user_id,
+                "text_settings": {},
+                "image_settings": {},
+                "message_history": [],
+                "version": 0
+            }
+        return self._users[user_id]
+
+    def replace_all(self, users: dict[int, dict]):
+        with self._lock:
+            for user_id, data in users.items():
+                user = self._user(user_id)
+                user["text_settings"] = copy.deepcopy(data["text_settings"])
+                user["image_settings"] = copy.deepcopy(data["image_settings"])
+                user["message_history"] = copy.deepcopy(data.get("message_history", []))
+                user["version"] += 1
+
+    def write_batch(self, settings_rows: dict[int, tuple[dict, dict]],
+                    appended: dict[int, list[dict]], histories: dict[int, list[dict]],
+                    versions: Optional[dict[int, int]] = None) -> WriteResult:
+        with self._lock:
+            new_versions, stale = {}, set()
+            for user_id in set(settings_rows) | set(appended) | set(histories):
+                current = self._users[user_id]["version"] if user_id in self._users else 0
+                is_stale = versions is not None and versions.get(user_id, 0) != current
+                if is_stale:
+                    stale.add(user_id)
+                applied = False
+                if user_id in settings_rows:
+                    user = self._user(user_id)
+                    user["text_settings"], user["image_settings"] = copy.deepcopy(settings_rows[user_id])
+                    applied = True
+                if user_id in histories:
+                    self._user(user_id)["message_history"] = copy.deepcopy(histories[user_id])
+                    applied = True
+                elif appended.get(user_id) and not is_stale:
+                    self._user(user_id)["message_history"].extend(copy.deepcopy(appended[user_id]))
+                    applied = True
+                if applied:
+                    if self.history_retention:
+                        del self._users[user_id]["message_history"][:-self.history_retention]
+                    self._users[user_id]["version"] = current + 1
+                    if not is_stale:
+                        new_versions[user_id] = current + 1
+            return new_versions, stale
+
+    def set_members(self, name: str) -> Optional[list[int]]:
+        with self._lock:
+            members = self._sets.get(name)
+            return list(members) if members is not None else None
+
+    def set_add(self, name: str, member: int) -> bool:
+        with self._lock:
+            members = self._sets.setdefault(name, [])
+            if member in members:
+                return False
+            members.append(member)
+            return True
+
+    def set_remove(self, name: str, member: int) -> bool:
+        with self._lock:
+            members = self._sets.get(name, [])
+            if member not in members:
+                return False
+            members.remove(member)
+            return True
+
+    def set_replace(self, name: str, members: Iterable[int]):
+        with self._lock:
+            self._sets[name] = list(dict.fromkeys(members))
+
+    def get_flag(self, name: str) -> bool:
+        with self._lock:
+            return self._flags.get(name, False)
+
+    def set_flag(self, name: str, value: bool):
+        with self._lock:
+            self._flags[name] = bool(value)
+
+
+class RedisStorage(StateBackend):
+    """
+    Общее хранилище на Redis (или совместимом сервере: KeyDB, Valkey, Dragonfly).
+
+    Настройки и версия пользователя хранятся в хэше, история - в списке.
+    Запись изменений одного пользователя выполняется транзакцией
+    WATCH/MULTI/EXEC по его хэшу, поэтому реплики не затирают историю
+    друг друга. В той же транзакции список истории обрезается (LTRIM)
+    до history_retention последних сообщений.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "gptbot:", history_retention: Optional[int] = None):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("Для STATE_BACKEND=redis установите пакет redis: pip install redis")
+        self._redis = redis
+        self.url = url
+        self.prefix = prefix
+        self.history_retention = history_retention
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    def __str__(self):
+        return self.url
+
+    def _user_key(self, user_id: int) -> str:
+        return f"{self.prefix}user:{user_id}"
+
+    def _history_key(self, user_id: int) -> str:
+        return f"{self.prefix}history:{user_id}"
+
+    @property
+    def _users_key(self) -> str:
+        return f"{self.prefix}users"
+
+    def is_empty(self) -> bool:
+        return self._client.scard(self._users_key) == 0
+
+    def _parse_user(self, user_id: int, fields: dict, history: list[str]) -> dict:
+        return {
+            "user_id": user_id,
+            "text_settings": json.loads(fields.get("text_settings", "{}")),
+            "image_settings": json.loads(fields.get("image_settings", "{}")),
+            "message_history": [json.loads(m) for m in history],
+            "version": int(fields.get("version", 0))
+        }
+
+    def load_all(self) -> dict[int, dict]:
+        user_ids = self.user_ids()
+        users = {}
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            pipe = self._client.pipeline(transaction=False)
+            for user_id in chunk:
+                pipe.hgetall(self._user_key(user_id))
+                pipe.lrange(self._history_key(user_id), 0, -1)
+            results = pipe.execute()
+            for index, user_id in enumerate(chunk):
+                users[user_id] = self._parse_user(user_id, results[2 * index], results[2 * index + 1])
+        return users
+
+    def load_user(self, user_id: int, history_limit: Optional[int] = None) -> Optional[dict]:
+        pipe = self._client.pipeline(transaction=True)
+        pipe.hgetall(self._user_key(user_id))
+        pipe.lrange(self._history_key(user_id), -history_limit if history_limit else 0, -1)
+        fields, history = pipe.execute()
+        if not fields:
+            return None
+        return self._parse_user(user_id, fields, history)
+
+    def get_version(self, user_id: int) -> int:
+        return int(self._client.hget(self._user_key(user_id), "version") or 0)
+
+    def user_ids(self) -> list[int]:
+        return [int(user_id) for user_id in self._client.smembers(self._users_key)]
+
+    def count_messages(self) -> int:
+        pipe = self._client.pipeline(transaction=False)
+        for user_id in self.user_ids():
+            pipe.llen(self._history_key(user_id))
+        return sum(pipe.execute())
+
+    def replace_all(self, users: dict[int, dict]):
+        pipe = self._client.pipeline(transaction=True)
+        for user_id, data in users.items():
+            self._queue_settings(pipe, user_id, data["text_settings"], data["image_settings"])
+            self._queue_history(pipe, user_id, data.get("message_history", []))
+            pipe.hincrby(self._user_key(user_id), "version", 1)
+        pipe.execute()
+
+    def _queue_settings(self, pipe, user_id, text_settings, image_settings):
+        pipe.hset(self._user_key(user_id), mapping={
+            "text_settings": json.dumps(text_settings, ensure_ascii=False),
+            "image_settings": json.dumps(image_settings, ensure_ascii=False)
+        })
+        pipe.sadd(self._users_key, user_id)
+
+    def _queue_history(self, pipe, user_id, message_history):
+        pipe.delete(self._history_key(user_id))
+        if self.history_retention:
+            message_history = message_history[-self.history_retention:]
+        if message_history:
+            pipe.rpush(self._history_key(user_id), *(
+                json.dumps(m, ensure_ascii=False) for m in message_history
+            ))
+
+    def write_batch(self, settings_rows: dict[int, tuple[dict, dict]],
+                    appended: dict[int, list[dict]], histories: dict[int, list[dict]],
+                    versions: Optional[dict[int, int]] = None) -> WriteResult:
+        new_versions, stale = {}, set()
+        for user_id in set(settings_rows) | set(appended) | set(histories):
+            user_key = self._user_key(user_id)
+            with self._client.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        pipe.watch(user_key)
+                        current = int(pipe.hget(user_key, "version") or 0)
+                        is_stale = versions is not None and versions.get(user_id, 0) != current
+                        append = appended.get(user_id) if user_id not in histories and not is_stale else None
+                        if user_id not in settings_rows and user_id not in histories and not append:
+                            pipe.unwatch()
+                            break
+                        pipe.multi()
+                        if user_id in settings_rows:
+                            self._queue_settings(pipe, user_id, *settings_rows[user_id])
+                        if user_id in histories:
+                            self._queue_history(pipe, user_id, histories[user_id])
+                        elif append:
+                            pipe.rpush(self._history_key(user_id), *(
+                                json.dumps(m, ensure_ascii=False) for m in append
+                            ))
+                            if self.history_retention:
+                                pipe.ltrim(self._history_key(user_id), -self.history_retention, -1)
+                        pipe.hset(user_key, "version", current + 1)
+                        pipe.sadd(self._users_key, user_id)
+                        pipe.execute()
+                        if not is_stale:
+                            new_versions[user_id] = current + 1
+                        break
+                    except self._redis.WatchError:
+                        # Пользователя изменил другой процесс - перечитываем версию
+                        continue
+            if is_stale:
+                stale.add(user_id)
+        return new_versions, stale
+
+    def _set_key(self, name: str) -> str:
+        return f"{self.prefix}set:{name}"
+
+    def set_members(self, name: str) -> Optional[list[int]]:
+        if not self._client.sismember(f"{self.prefix}sets", name):
+            return None
+        return sorted(int(member) for member in self._client.smembers(self._set_key(name)))
+
+    def set_add(self, name: str, member: int) -> bool:
+        pipe = self._client.pipeline(transaction=True)
+        pipe.sadd(f"{self.prefix}sets", name)
+        pipe.sadd(self._set_key(name), member)
+        return pipe.execute()[1] > 0
+
+    def set_remove(self, name: str, member: int) -> bool:
+        return self._client.srem(self._set_key(name), member) > 0
+
+    def set_replace(self, name: str, members: Iterable[int]):
+        members = list(members)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.sadd(f"{self.prefix}sets", name)
+        pipe.delete(self._set_key(name))
+        if members:
+            pipe.sadd(self._set_key(name), *members)
+        pipe.execute()
+
+    def get_flag(self, name: str) -> bool:
+        return self._client.get(f"{self.prefix}flag:{name}") == "1"
+
+    def set_flag(self, name: str, value: bool):
+        if value:
+            self._client.set(f"{self.prefix}flag:{name}", "1")
+        else:
+            self._client.delete(f"{self.prefix}flag:{name}")
+
+    def close(self):
+        self._client.close()
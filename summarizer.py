@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Optional
+from loguru import logger
+import metrics
+from history import message_dict
+from settings import settings_manager
+
+# Сжатие старой части диалога в краткое содержание (по умолчанию выключено)
+SUMMARY_ENABLED = os.getenv('SUMMARY_ENABLED', 'False').lower() == 'true'
+# Сколько сообщений без краткого содержания накапливается до его обновления
+SUMMARY_THRESHOLD = int(os.getenv('SUMMARY_THRESHOLD', '40'))
+# Сколько последних сообщений всегда передается модели без сжатия
+SUMMARY_KEEP_MESSAGES = int(os.getenv('SUMMARY_KEEP_MESSAGES', '10'))
+# Дешевая модель для составления краткого содержания (на основном endpoint)
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '500'))
+# Одновременных запросов на составление краткого содержания
+SUMMARY_CONCURRENCY = 4
+# Пауза перед повторной попыткой для endpoint после ошибки (секунды)
+SUMMARY_RETRY_INTERVAL = 600
+
+# Роль записи с кратким содержанием в истории. Запись хранится в том же
+# журнале, что и сообщения, и заменяет собой все сообщения до нее, кроме
+# последних keep
+SUMMARY_ROLE = "summary"
+SUMMARY_PROMPT = (
+    "Ты составляешь краткое содержание диалога пользователя с ассистентом, "
+    "которое заменит ассистенту старые сообщения. Сохрани факты о пользователе, "
+    "его просьбы, принятые решения, договоренности и незакрытые вопросы. "
+    "Пиши кратко, на языке диалога, без вступлений."
+)
+SUMMARY_CONTEXT_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+Summarize = Callable[[list[dict]], Awaitable[str]]
+
+
+def last_summary(history) -> tuple[int, Optional[dict]]:
+    """Возвращает (позиция, {"text", "keep"}) последней записи с кратким содержанием."""
+    for index in range(len(history) - 1, -1, -1):
+        if history[index]["role"] == SUMMARY_ROLE:
+            try:
+                return index, json.loads(history[index]["content"])
+            except ValueError:
+                logger.warning("Запись с кратким содержанием повреждена и пропущена")
+    return -1, None
+
+
+def unsummarized(history) -> tuple[Optional[str], list]:
+    """
+    Делит историю на краткое содержание и сообщения, которые в него не вошли.
+
+    Returns:
+        tuple: (текст краткого содержания или None, сообщения после него)
+    """
+    index, summary = last_summary(history)
+    if summary is None:
+        return None, [message for message in history if message["role"] != SUMMARY_ROLE]
+    start = max(0, index - summary.get("keep", 0))
+    return summary["text"], [message for message in history[start:] if message["role"] != SUMMARY_ROLE]
+
+
+def context_messages(history) -> list:
+    """История для запроса к модели: краткое содержание вместо старых сообщений."""
+    text, messages = unsummarized(history)
+    if text is None:
+        return messages
+    return [{"role": "system", "content": SUMMARY_CONTEXT_PREFIX + text}] + messages
+
+
+def render_dialog(previous: Optional[str], messages: list) -> str:
+    """Текст запроса на составление краткого содержания."""
+    names = {"user": "Пользователь", "assistant": "Ассистент"}
+    parts = []
+    if previous:
+        parts.append(f"Краткое содержание до этого момента:\n{previous}\n")
+    parts.append("Новые сообщения:")
+    for message in messages:
+        parts.append(f"{names.get(message['role'], message['role'])}: {message['content']}")
+    return "\n".join(parts)
+
+
+class ConversationSummarizer:
+    """
+    Фоновое сжатие длинной истории в краткое содержание.
+
+    Когда у пользователя накапливается threshold сообщений без краткого
+    содержания, все они, кроме последних keep, вместе с предыдущим кратким
+    содержанием пересказываются дешевой моделью. Запрос выполняется в
+    фоновой задаче после ответа пользователю; для одного пользователя
+    одновременно выполняется не больше одной задачи.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = SUMMARY_ENABLED,
+        threshold: int = SUMMARY_THRESHOLD,
+        keep: int = SUMMARY_KEEP_MESSAGES,
+        concurrency: int = SUMMARY_CONCURRENCY
+    ):
+        self.enabled = enabled
+        self.threshold = max(threshold, keep + 1)
+        self.keep = keep
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: dict[int, asyncio.Task] = {}
+        # Время последней ошибки по endpoint
+        self._failures: dict[str, float] = {}
+
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def schedule(self, user_id: int, endpoint: str, summarize: Summarize) -> bool:
+        """
+        Запускает составление краткого содержания, если история достаточно длинная.
+
+        Returns:
+            bool: True, если запущена новая фоновая задача
+        """
+        if not self.enabled or user_id in self._tasks:
+            return False
+        failed_at = self._failures.get(endpoint)
+        if failed_at is not None and time.monotonic() - failed_at < SUMMARY_RETRY_INTERVAL:
+            return False
+        history = settings_manager.get_user_settings(user_id).message_history
+        _, messages = unsummarized(history)
+        if len(messages) < self.threshold:
+            return False
+        task = asyncio.create_task(self._summarize(user_id, endpoint, summarize))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+        return True
+
+    async def _summarize(self, user_id: int, endpoint: str, summarize: Summarize):
+        history = settings_manager.get_user_settings(user_id).message_history
+        previous, messages = unsummarized(history)
+        covered = messages[:-self.keep] if self.keep else messages
+        # Первое сообщение, которое остается без сжатия: по нему находим
+        # границу, даже если за время запроса в историю добавились сообщения
+        boundary = messages[len(covered)] if len(covered) < len(messages) else None
+        started = time.perf_counter()
+        try:
+            async with self._semaphore:
+                text = await summarize([
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": render_dialog(previous, [message_dict(m) for m in covered])}
+                ])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failures[endpoint] = time.monotonic()
+            metrics.openai_errors.inc(kind="summary", error=type(e).__name__)
+            metrics.summaries.inc(result="error")
+            logger.warning(f"Не удалось составить краткое содержание истории пользователя {user_id}: {e}")
+            return
+        metrics.openai_request_duration.observe(time.perf_counter() - started, kind="summary")
+
+        # История могла быть очищена, заменена или перечитана из хранилища
+        history = settings_manager.get_user_settings(user_id).message_history
+        if boundary is None:
+            keep = 0
+            if not history or history[-1] is not covered[-1]:
+                # Пока шел запрос, появились новые сообщения: без границы их не отличить
+                metrics.summaries.inc(result="discarded")
+                return
+        else:
+            position = next((i for i in range(len(history) - 1, -1, -1) if history[i] is boundary), None)
+            if position is None:
+                metrics.summaries.inc(result="discarded")
+                logger.debug(f"История пользователя {user_id} изменилась, краткое содержание отброшено")
+                return
+            keep = len(history) - position
+        settings_manager.append_message(user_id, {
+            "role": SUMMARY_ROLE,
+            "content": json.dumps({"text": text.strip(), "keep": keep}, ensure_ascii=False)
+        })
+        metrics.summaries.inc(result="done")
+        logger.debug(f"История пользователя {user_id}: {len(covered)} сообщений сжато в краткое содержание")
+
+    async def close(self):
+        """Отменяет незавершенные задачи: краткое содержание будет составлено позже."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+summarizer = ConversationSummarizer()
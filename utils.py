@@ -1,9 +1,13 @@
+from collections import OrderedDict
 from typing import Optional, Tuple, Any
+import functools
 from loguru import logger
 import json
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 import os
+from access import access_control
+from settings import settings_manager
 
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
@@ -18,40 +22,26 @@ def check_user_access(user_id: int) -> bool:
         bool: True если пользователь имеет доступ, False в противном случае
     """
     try:
-        # Загружаем список разрешенных пользователей из файла
-        if os.path.exists('allowed_users.json'):
-            with open('allowed_users.json', 'r') as f:
-                allowed_users = json.load(f)
-            
-            # Если список пустой, запрещаем доступ
-            if not allowed_users:
-                logger.warning(f"Список разрешенных пользователей пуст. Доступ запрещен для пользователя {user_id}")
-                return False
-            
-            # Проверяем наличие ID пользователя в списке разрешенных
-            has_access = str(user_id) in allowed_users
-            if not has_access:
-                logger.warning(f"Попытка доступа от неразрешенного пользователя {user_id}")
-            return has_access
-        else:
+        allowed_users = access_control.users
+        if not allowed_users.exists:
             logger.warning("Файл allowed_users.json не найден")
             return False
+        
+        # Если список пустой, запрещаем доступ
+        if allowed_users.is_empty():
+            logger.warning(f"Список разрешенных пользователей пуст. Доступ запрещен для пользователя {user_id}")
+            return False
+        
+        # Проверяем наличие ID пользователя в списке разрешенных
+        has_access = allowed_users.contains(user_id)
+        if not has_access:
+            logger.warning(f"Попытка доступа от неразрешенного пользователя {user_id}")
+        return has_access
             
     except Exception as e:
         logger.error(f"Ошибка при проверке доступа: {e}")
         return False
 
-def load_groups() -> list:
-    """Загружает список разрешенных групп из файла."""
-    try:
-        if os.path.exists('allowed_groups.json'):
-            with open('allowed_groups.json', 'r') as f:
-                return json.load(f)
-        return []
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке списка групп: {e}")
-        return []
-
 def check_group_access(chat_id: int) -> bool:
     """
     Проверяет, имеет ли группа доступ к боту.
@@ -62,21 +52,21 @@ def check_group_access(chat_id: int) -> bool:
     Returns:
         bool: True если группа имеет доступ, False в противном случае
     """
-    # Загружаем список разрешенных групп из файла
-    allowed_groups = load_groups()
+    allowed_groups = access_control.groups
     
     # Если список пустой, разрешаем доступ всем группам
-    if not allowed_groups:
+    if allowed_groups.is_empty():
         return True
     
     # Проверяем наличие ID группы в списке разрешенных
-    has_access = str(chat_id) in allowed_groups
+    has_access = allowed_groups.contains(chat_id)
     if not has_access:
         logger.warning(f"Попытка доступа из неразрешенной группы {chat_id}")
     return has_access
 
 def check_user_access_decorator(func):
     """Декоратор для проверки доступа пользователя к командам бота."""
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
@@ -119,9 +109,49 @@ def check_user_access_decorator(func):
                 )
                 return None
         
+        # Если пользователя изменила другая реплика бота, подгружаем его состояние
+        await settings_manager.sync_user(user_id)
         return await func(update, context, *args, **kwargs)
     return wrapper
 
+# Сколько разных готовых клавиатур меню хранить в памяти
+KEYBOARD_CACHE_SIZE = 1024
+
+
+class KeyboardCache:
+    """
+    Готовые клавиатуры меню настроек.
+
+    Ключ - кортеж отображаемых на кнопках значений, поэтому клавиатура
+    строится один раз для каждой комбинации настроек и используется всеми
+    пользователями с такими же настройками. После изменения настроек ключ
+    меняется сам, и устаревшая клавиатура больше не выдается. Объекты
+    InlineKeyboardMarkup в PTB неизменяемы, поэтому один объект можно
+    отправлять в разные чаты.
+    """
+
+    def __init__(self, max_size: int = KEYBOARD_CACHE_SIZE):
+        self.max_size = max_size
+        self._markups: OrderedDict[tuple, InlineKeyboardMarkup] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, build) -> InlineKeyboardMarkup:
+        """Возвращает клавиатуру по ключу, при промахе строит ее вызовом build()."""
+        markup = self._markups.get(key)
+        if markup is not None:
+            self._markups.move_to_end(key)
+            self.hits += 1
+            return markup
+        self.misses += 1
+        markup = self._markups[key] = build()
+        if len(self._markups) > self.max_size:
+            self._markups.popitem(last=False)
+        return markup
+
+
+keyboard_cache = KeyboardCache()
+
 def create_menu_keyboard(buttons: list[list[tuple[str, str]]]) -> InlineKeyboardMarkup:
     """
     Создает клавиатуру из списка кнопок.
@@ -137,8 +167,7 @@ def create_menu_keyboard(buttons: list[list[tuple[str, str]]]) -> InlineKeyboard
         keyboard.append(keyboard_row)
     return InlineKeyboardMarkup(keyboard)
 
-def create_settings_keyboard() -> InlineKeyboardMarkup:
-    """Создает клавиатуру для главного меню настроек."""
+def _build_settings_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         [("📝 Настройки текста", "text_settings")],
         [("🎨 Настройки изображений", "image_settings")],
@@ -149,58 +178,97 @@ def create_settings_keyboard() -> InlineKeyboardMarkup:
     ]
     return create_menu_keyboard(buttons)
 
-def create_text_settings_keyboard(current_settings: dict) -> InlineKeyboardMarkup:
-    """Создает клавиатуру для настроек текстовой модели."""
-    logger.debug(f"Creating text settings keyboard with settings: {current_settings}")
-    current_model = current_settings.get('effective_model', current_settings.get('model', 'gpt-4o-mini'))
-    current_temp = current_settings.get('temperature', 0.7)
-    current_tokens = current_settings.get('max_tokens', 1000)
-    current_base_url = current_settings.get('base_url', 'https://api.openai.com/v1')
-    
+def create_settings_keyboard() -> InlineKeyboardMarkup:
+    """Создает клавиатуру для главного меню настроек."""
+    return keyboard_cache.get(("settings",), _build_settings_keyboard)
+
+def _display_base_url(base_url: str) -> str:
     # Сокращаем base_url для отображения, если он слишком длинный
-    display_base_url = current_base_url
-    if len(display_base_url) > 30:
-        display_base_url = display_base_url[:27] + "..."
-    
+    if len(base_url) > 30:
+        return base_url[:27] + "..."
+    return base_url
+
+def _build_text_settings_keyboard(model: str, base_url: str, temperature: float,
+                                  max_tokens: int) -> InlineKeyboardMarkup:
     buttons = [
-        [(f"🔄 Модель: {current_model}", "change_text_model")],
-        [(f"🌐 Base URL: {display_base_url}", "change_base_url")],
-        [(f"🌡 Температура: {current_temp}", "change_temperature")],
-        [(f"📊 Макс. токенов: {current_tokens}", "change_max_tokens")],
+        [(f"🔄 Модель: {model}", "change_text_model")],
+        [(f"🌐 Base URL: {_display_base_url(base_url)}", "change_base_url")],
+        [(f"🌡 Температура: {temperature}", "change_temperature")],
+        [(f"📊 Макс. токенов: {max_tokens}", "change_max_tokens")],
         [("🔙 Назад", "back_to_main"), ("❌ Закрыть", "close_settings")]
     ]
     return create_menu_keyboard(buttons)
 
-def create_image_settings_keyboard(current_settings: dict) -> InlineKeyboardMarkup:
-    """Создает клавиатуру для настроек модели изображений."""
-    # Сокращаем base_url для отображения, если он слишком длинный
-    current_base_url = current_settings.get('base_url', 'https://api.openai.com/v1')
-    display_base_url = current_base_url
-    if len(display_base_url) > 30:
-        display_base_url = display_base_url[:27] + "..."
-    
+def create_text_settings_keyboard(text_settings) -> InlineKeyboardMarkup:
+    """Создает клавиатуру для настроек текстовой модели (TextModelSettings)."""
+    key = (
+        text_settings.effective_model,
+        text_settings.base_url,
+        text_settings.temperature,
+        text_settings.max_tokens
+    )
+    return keyboard_cache.get(("text",) + key, lambda: _build_text_settings_keyboard(*key))
+
+def _build_image_settings_keyboard(image_settings) -> InlineKeyboardMarkup:
     buttons = [
-        [(f"🔄 Модель: {current_settings['model']}", "change_image_model")],
-        [(f"🌐 Base URL: {display_base_url}", "change_image_base_url")],
-        [(f"📏 Размер: {current_settings['size']}", "change_size")]
+        [(f"🔄 Модель: {image_settings.model}", "change_image_model")],
+        [(f"🌐 Base URL: {_display_base_url(image_settings.base_url)}", "change_image_base_url")],
+        [(f"📏 Размер: {image_settings.size}", "change_size")]
     ]
     
     # Добавляем кнопку качества только если модель поддерживает разные качества
-    if len(current_settings.get('available_qualities', [])) > 1:
-        buttons.append([(f"✨ Качество: {current_settings['quality']}", "change_quality")])
+    if len(image_settings.available_qualities) > 1:
+        buttons.append([(f"✨ Качество: {image_settings.quality}", "change_quality")])
     
     # Добавляем кнопку стиля только если модель поддерживает стили
-    if current_settings.get('available_styles', []):
-        buttons.append([(f"🎨 Стиль: {current_settings['style']}", "change_style")])
+    if image_settings.available_styles:
+        buttons.append([(f"🎨 Стиль: {image_settings.style}", "change_style")])
     
     # Добавляем кнопку HDR только если модель поддерживает HDR
-    if current_settings.get('supports_hdr', False):
-        hdr_status = 'Вкл' if current_settings['hdr'] else 'Выкл'
+    if image_settings.supports_hdr:
+        hdr_status = 'Вкл' if image_settings.hdr else 'Выкл'
         buttons.append([(f"HDR: {hdr_status}", "toggle_hdr")])
     
     buttons.append([("🔙 Назад", "back_to_main"), ("❌ Закрыть", "close_settings")])
     return create_menu_keyboard(buttons)
 
+def create_image_settings_keyboard(image_settings) -> InlineKeyboardMarkup:
+    """Создает клавиатуру для настроек модели изображений (ImageModelSettings)."""
+    key = (
+        "image",
+        image_settings.model,
+        image_settings.base_url,
+        image_settings.size,
+        image_settings.quality,
+        image_settings.style,
+        image_settings.hdr
+    )
+    return keyboard_cache.get(key, lambda: _build_image_settings_keyboard(image_settings))
+
+def _build_choice_keyboard(options: tuple, current: str, callback_prefix: str,
+                           back: str, label_prefix: str) -> InlineKeyboardMarkup:
+    buttons = [
+        [(f"{label_prefix}{option} {'✓' if option == current else ''}", f"{callback_prefix}{option}")]
+        for option in options
+    ]
+    buttons.append([("🔙 Назад", back)])
+    return create_menu_keyboard(buttons)
+
+def create_choice_keyboard(options, current: str, callback_prefix: str, back: str,
+                           label_prefix: str = "") -> InlineKeyboardMarkup:
+    """
+    Создает клавиатуру выбора одного значения из списка.
+
+    Args:
+        options: Возможные значения
+        current: Текущее значение, отмечается галочкой
+        callback_prefix: Префикс callback_data кнопок (к нему добавляется значение)
+        back: callback_data кнопки "Назад"
+        label_prefix: Префикс текста кнопок
+    """
+    key = ("choice", tuple(options), current, callback_prefix, back, label_prefix)
+    return keyboard_cache.get(key, lambda: _build_choice_keyboard(*key[1:]))
+
 async def send_confirmation_dialog(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -220,7 +288,7 @@ async def send_confirmation_dialog(
         [("✅ Да", f"confirm_{callback_data}"),
          ("❌ Нет", "cancel_confirmation")]
     ]
-    keyboard = create_menu_keyboard(buttons)
+    keyboard = keyboard_cache.get(("confirm", callback_data), lambda: create_menu_keyboard(buttons))
     
     await update.callback_query.edit_message_text(
         f"Вы уверены, что хотите {action}?",
@@ -259,6 +327,7 @@ def validate_max_tokens(value: Any) -> Tuple[bool, int]:
 
 def log_handler_call(func):
     """Декоратор для логирования вызовов обработчиков."""
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         if DEBUG:
             user = update.effective_user
@@ -0,0 +1,333 @@
+import asyncio
+import hmac
+import json
+import multiprocessing
+import os
+import queue
+import signal
+from typing import Awaitable, Callable, Optional
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application
+import metrics
+
+# Публичный адрес, который регистрируется в Telegram через setWebhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Адрес и порт, на которых принимаются запросы от Telegram
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+# Путь, на который Telegram отправляет апдейты
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+# Максимум одновременных соединений Telegram к webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Количество процессов-обработчиков
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))
+# Размер очереди необработанных апдейтов (на каждый процесс-обработчик)
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+
+HEALTH_PATH = '/health'
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+MAX_BODY_SIZE = 1024 * 1024
+
+Dispatch = Callable[[dict], bool]
+
+webhook_requests = metrics.registry.counter(
+    "bot_webhook_requests_total", "Запросы к webhook по коду ответа", ("status",))
+
+
+class WebhookApp:
+    """
+    ASGI-приложение, принимающее апдейты от Telegram.
+
+    Проверяет секретный токен и передает апдейт в dispatch. Если очередь
+    обработки заполнена, отвечает 503: Telegram повторит доставку позже,
+    а апдейт не будет потерян.
+    """
+
+    def __init__(
+        self,
+        dispatch: Dispatch,
+        path: str = WEBHOOK_PATH,
+        secret_token: str = WEBHOOK_SECRET_TOKEN,
+        on_startup: Optional[Callable[[], Awaitable[None]]] = None,
+        on_shutdown: Optional[Callable[[], Awaitable[None]]] = None
+    ):
+        self.dispatch = dispatch
+        self.path = path
+        self.secret_token = secret_token.encode()
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.accepted = 0
+        self.rejected = 0
+        self.forbidden = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            status = await self._handle(scope, receive)
+            webhook_requests.inc(status=str(status))
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"text/plain")]
+            })
+            await send({"type": "http.response.body", "body": str(status).encode()})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    if self.on_startup is not None:
+                        await self.on_startup()
+                except Exception as e:
+                    logger.error(f"Ошибка при запуске webhook: {e}")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                try:
+                    if self.on_shutdown is not None:
+                        await self.on_shutdown()
+                except Exception as e:
+                    logger.error(f"Ошибка при остановке webhook: {e}")
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _read_body(self, receive) -> Optional[bytes]:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > MAX_BODY_SIZE:
+                return None
+            if not message.get("more_body"):
+                return body
+
+    async def _handle(self, scope, receive) -> int:
+        if scope["path"] == HEALTH_PATH:
+            return 200
+        if scope["path"] != self.path:
+            return 404
+        if scope["method"] != "POST":
+            return 405
+
+        if self.secret_token:
+            received = dict(scope["headers"]).get(SECRET_HEADER, b"")
+            if not hmac.compare_digest(received, self.secret_token):
+                self.forbidden += 1
+                logger.warning(f"Запрос к webhook с неверным секретным токеном от {scope.get('client')}")
+                return 403
+
+        body = await self._read_body(receive)
+        if body is None:
+            return 413
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict) or "update_id" not in data:
+                raise ValueError("нет update_id")
+            if not self.dispatch(data):
+                self.rejected += 1
+                logger.warning(f"Очередь апдейтов заполнена, апдейт {data['update_id']} отклонен")
+                return 503
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Некорректный апдейт в webhook: {e}")
+            return 400
+        self.accepted += 1
+        return 200
+
+    def stats(self) -> dict:
+        return {"accepted": self.accepted, "rejected": self.rejected, "forbidden": self.forbidden}
+
+
+def shard_key(data: dict) -> int:
+    """
+    Ключ распределения апдейта по процессам-обработчикам.
+
+    Апдейты одного пользователя всегда попадают в один процесс, поэтому
+    его настройки и история меняются только там, а порядок сообщений
+    сохраняется.
+    """
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat") or value.get("user")
+            if isinstance(sender, dict) and "id" in sender:
+                return int(sender["id"])
+    return int(data["update_id"])
+
+
+def application_dispatch(application: Application) -> Dispatch:
+    """Передает апдейты в ограниченную очередь приложения текущего процесса."""
+    def dispatch(data: dict) -> bool:
+        try:
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+        except asyncio.QueueFull:
+            return False
+        return True
+    return dispatch
+
+
+class WorkerPool:
+    """
+    Процессы-обработчики апдейтов.
+
+    Каждый процесс запускает свой экземпляр бота и получает апдейты через
+    собственную ограниченную очередь. Процесс выбирается по пользователю
+    (см. shard_key).
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS, queue_size: int = UPDATE_QUEUE_SIZE):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processes = [
+            context.Process(target=run_worker, args=(index, worker_queue), name=f"bot-worker-{index}")
+            for index, worker_queue in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"Запущено процессов-обработчиков: {len(self.processes)}")
+
+    def dispatch(self, data: dict) -> bool:
+        worker_queue = self.queues[shard_key(data) % len(self.queues)]
+        try:
+            worker_queue.put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout: float = 30):
+        """Останавливает обработчики после обработки уже принятых апдейтов."""
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился, останавливаем принудительно")
+                process.terminate()
+
+
+def run_worker(index: int, worker_queue):
+    """Точка входа процесса-обработчика."""
+    # Процесс останавливается по команде из основного процесса
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from bot import GPTBot
+    from settings import settings_manager
+
+    gpt_bot = GPTBot()
+    gpt_bot.application.bot_data['gpt_bot'] = gpt_bot
+    # Каждый процесс отдает свои метрики на отдельном порту
+    if gpt_bot.metrics_port:
+        gpt_bot.metrics_port += index + 1
+    try:
+        asyncio.run(_consume(gpt_bot.application, worker_queue))
+    finally:
+        settings_manager.flush()
+    logger.info(f"Процесс-обработчик {index} остановлен")
+
+
+async def _start(application: Application):
+    """Запускает приложение так же, как run_polling, включая post_init."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def _stop(application: Application):
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def _consume(application: Application, worker_queue):
+    await _start(application)
+    try:
+        while True:
+            data = await asyncio.to_thread(worker_queue.get)
+            if data is None:
+                break
+            # Ограниченная очередь приложения задерживает чтение новых
+            # апдейтов, пока обработчики заняты
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        # stop() дожидается обработки апдейтов, уже попавших в очередь
+        await _stop(application)
+
+
+async def _set_webhook(application: Application):
+    if not WEBHOOK_URL:
+        raise ValueError("Не указан WEBHOOK_URL")
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET_TOKEN or None,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+        # Апдейты, накопившиеся за время перезапуска, будут доставлены
+        drop_pending_updates=False
+    )
+    logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+
+def create_webhook_app(application: Application, workers: int = WEBHOOK_WORKERS) -> WebhookApp:
+    """
+    Создает ASGI-приложение webhook.
+
+    При workers == 1 апдейты обрабатываются в текущем процессе, иначе
+    передаются в процессы-обработчики.
+    """
+    if workers <= 1:
+        async def on_startup():
+            await _start(application)
+            await _set_webhook(application)
+
+        async def on_shutdown():
+            await _stop(application)
+
+        return WebhookApp(application_dispatch(application), on_startup=on_startup, on_shutdown=on_shutdown)
+
+    pool = WorkerPool(workers)
+    # Основной процесс отдает метрики webhook на METRICS_PORT,
+    # процессы-обработчики - на следующих портах
+    metrics_server = metrics.MetricsServer() if metrics.METRICS_PORT else None
+    for index, worker_queue in enumerate(pool.queues):
+        metrics.queue_depth.track(worker_queue.qsize, queue=f"worker_{index}")
+
+    async def on_startup():
+        pool.start()
+        if metrics_server is not None:
+            await metrics_server.start()
+        await application.bot.initialize()
+        await _set_webhook(application)
+
+    async def on_shutdown():
+        await asyncio.to_thread(pool.stop)
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await application.bot.shutdown()
+
+    return WebhookApp(pool.dispatch, on_startup=on_startup, on_shutdown=on_shutdown)
+
+
+def run_webhook(application: Application):
+    """Запускает HTTP-сервер webhook (требуется uvicorn)."""
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError("Для режима webhook установите uvicorn: pip install uvicorn")
+
+    app = create_webhook_app(application)
+    logger.info(f"Webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    uvicorn.run(
+        app,
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        lifespan="on",
+        log_level="warning",
+        access_log=False
+    )